@@ -5,10 +5,13 @@ from .user import User
 from .job import Job 
 from .auth import check_view_job, check_edit_job, can_user_edit_job, check_edit_pheno, admin_required
 from .genotype import Genotype
+from .geno_reader import group_by_genotype
+from .result_filter import ResultFilter, read_results_header, format_cursor
+from .tabix_reader import get_tabix_reader
 from .phenotype import Phenotype
 from .notice import Notice
-from .pheno_reader import PhenoReader
-from .slurm_queue import SlurmJob, get_queue
+from .pheno_reader import PhenoIngest, verify_meta
+from .slurm_queue import SlurmJob, get_queue_snapshot
 from .model_factory import ModelFactory
 from .notifier import get_notifier
 from .db_helpers import PagedResult, PageInfo, QueryInfo
@@ -19,7 +22,8 @@ import uuid
 import tabix
 import hashlib
 import shutil
-import collections
+import itertools
+import threading
 import sys, traceback
 import subprocess
 import requests
@@ -265,69 +269,121 @@ def cancel_job(job_id, job=None):
         raise ApiException("COULD NOT UPDATE DB")
     return ApiResult({"message": "Job canceled"})
 
+def store_result_lines(blocks, store, batch_size=10000):
+    # (line, row) for blocks of rows selected from the results store
+    for block in blocks:
+        for i in range(0, len(block), batch_size):
+            part = block[i:i+batch_size]
+            if store.has_lines():
+                lines = store.lines(part)
+            else:
+                cols = [store.values(name, part) for name in store.column_names]
+                lines = ["\t".join(values) for values in zip(*cols)]
+            for row, line in zip(part.tolist(), lines):
+                yield line + "\n", row
+
+def text_result_lines(rows):
+    # (line, cursor) for the rows selected from the text results
+    for fields, cursor in rows:
+        yield "\t".join(fields) + "\n", cursor
+
 @api.route("/jobs/<job_id>/results", methods=["get"])
 @check_view_job
 def get_job_results(job_id, job=None):
-    filters = request.args.to_dict()
-    epacts_filename = job.relative_path("output.epacts.gz")
-    with gzip.open(epacts_filename, "rt") as f:
-        header = f.readline().rstrip('\n').split('\t')
-        if header[1] == "BEG":
-            header[1] = "BEGIN"
-        if header[0] == "#CHROM":
-            header[0] = "CHROM"
-    assert len(header) > 0
-    headerpos = {x:i for i,x in enumerate(header)}
-
-    if filters.get("region", ""):
-        tb = tabix.open(epacts_filename)
-        indata = tb.query(chrom, start_pos, end_pos)
-    else:
-        indata = (x.split("\t") for x in gzip.open(epacts_filename))
-
-    pass_tests = []
-    if filters.get("non-monomorphic", False):
-        if "AC" not in headerpos:
-            raise Exception("Column AC not found")
-        ac_index = headerpos["AC"]
-        def mono_pass(row):
-            if float(row[ac_index])>0:
-                return True
-            else:
-                return False
-        pass_tests.append(mono_pass)
-
-    if "max-pvalue" in filters:
-        if "PVALUE" not in headerpos:
-            raise Exception("Column PVALUE not found")
-        pval_index = headerpos["PVALUE"]
-        thresh = float(filters.get("max-pvalue", 1))
-        def pval_pass(row):
-            if row[pval_index] == "NA":
-                return False
-            if float(row[pval_index])<thresh:
-                return True
-            else:
-                return False
-        pass_tests.append(pval_pass)
-
-    def pass_row(row):
-        if len(pass_tests)==0:
-            return True
-        for f in pass_tests:
-            if not f(row):
-                return False
-        return True
+    results_filename = job.get_output_file_path()
+    if results_filename is None:
+        raise ApiException("RESULTS NOT FOUND", 404)
+    header = read_results_header(results_filename)
+    offset = safe_cast(request.args.get("offset", 0), int, 0)
+    limit = safe_cast(request.args.get("limit", 0), int, 0)
+    max_limit = current_app.config.get("MAX_RESULTS_PAGE_SIZE", 100000)
+    if limit > max_limit:
+        raise ApiException("PAGE SIZE TOO LARGE (max {})".format(max_limit))
+    store = job.get_results_store()
+    try:
+        result_filter = ResultFilter.from_args(request.args)
+        if result_filter.is_empty() and not offset and not limit:
+            records = None
+        elif store is not None:
+            batch_size = min(offset + limit + 1, 10000) if limit else 10000
+            # store_rows and text_rows check the filter before returning
+            records = store_result_lines(result_filter.store_rows(store), store, batch_size)
+        else:
+            records = text_result_lines(result_filter.text_rows(results_filename, header))
+    except ValueError as e:
+        raise ApiException("INVALID FILTER", details=str(e))
+
+    if records is not None and limit:
+        page = list(itertools.islice(records, offset, offset + limit + 1))
+        resp = Response("\t".join(header) + "\n" + "".join(x[0] for x in page[:limit]),
+            mimetype="text/plain")
+        if len(page) > limit:
+            cursor = page[limit-1][1]
+            if store is not None:
+                cursor = ResultFilter.store_cursor(store, cursor)
+            cursor = format_cursor(cursor)
+            args = request.args.to_dict()
+            args.pop("offset", None)
+            args["cursor"] = cursor
+            resp.headers["X-Next-Cursor"] = cursor
+            resp.headers["Link"] = '<{}>; rel="next"'.format(
+                url_for("api.get_job_results", job_id=job_id, **args))
+        return resp
 
     def generate():
         yield "\t".join(header) + "\n"
-        next(indata) #skip header
-        for row in indata:
-            if pass_row(row):
-                yield "\t".join(row)
+        if records is None:
+            with gzip.open(results_filename, "rt") as f:
+                next(f) #skip header
+                for line in f:
+                    yield line
+        else:
+            for line, _ in itertools.islice(records, offset, None):
+                yield line
 
     return Response(generate(), mimetype="text/plain")
 
+@api.route("/jobs/<job_id>/results/chunks", methods=["get"])
+@check_view_job
+def get_job_results_chunks(job_id, job=None):
+    # regions that split the results for parallel downloads
+    results_filename = job.get_output_file_path()
+    if results_filename is None:
+        raise ApiException("RESULTS NOT FOUND", 404)
+    window = safe_cast(request.args.get("window", 0), int, 0)
+    store = job.get_results_store()
+    chroms = []
+    if store is not None:
+        chroms = [(x["name"], x["min_pos"], x["max_pos"]) for x in store.chroms if x["stop"] > x["start"]]
+    else:
+        reader = get_tabix_reader(results_filename)
+        if reader is None:
+            raise ApiException("RESULTS NOT INDEXED")
+        chroms = [(name, 1, max(len(linear), 1) << 14) for name, linear in
+            zip(reader.index.names, reader.index.linear)]
+    if window > 0 and sum((stop - start) // window + 1 for _, start, stop in chroms) > 10000:
+        raise ApiException("WINDOW TOO SMALL")
+    chunks = []
+    for chrom, start, stop in chroms:
+        step = window if window > 0 else stop - start + 1
+        for chunk_start in range(start, stop + 1, step):
+            chunk_stop = min(chunk_start + step - 1, stop)
+            chunk = {"chrom": chrom, "start": chunk_start, "stop": chunk_stop,
+                "region": "{}:{}-{}".format(chrom, chunk_start, chunk_stop)}
+            if store is not None:
+                chunk["rows"] = int(len(store.region_rows(chrom, chunk_start, chunk_stop)))
+            chunks.append(chunk)
+    return ApiResult(chunks)
+
+@api.route("/jobs/<job_id>/results/file", methods=["get"])
+@check_view_job
+def get_job_results_file(job_id, job=None):
+    # compressed results as stored; supports Range requests for resuming
+    results_filename = job.get_output_file_path()
+    if results_filename is None:
+        raise ApiException("RESULTS NOT FOUND", 404)
+    return send_file(results_filename, as_attachment=True, conditional=True)
+
 def get_job_output(job, filename, as_attach=False, mimetype=None, tail=None, head=None):
     try:
         output_file = job.relative_path(filename)
@@ -345,7 +401,7 @@ def get_job_output(job, filename, as_attach=False, mimetype=None, tail=None, hea
                 resp.headers["Content-Type"] = mimetype
             return resp
         else:
-            return send_file(output_file, as_attachment=as_attach, mimetype=mimetype)
+            return send_file(output_file, as_attachment=as_attach, mimetype=mimetype, conditional=True)
     except Exception as e:
         print(e)
         return "File Not Found", 404
@@ -396,6 +452,26 @@ def get_job_zoom(job_id, job=None):
     if chrom == "":
         return ApiResult(None, header={"variant_columns": header})
 
+    store = job.get_results_store()
+    if store is not None and store.is_numeric("PVALUE"):
+        rows = store.region_rows(chrom, start_pos, end_pos)
+        max_points = current_app.config.get("ZOOM_MAX_POINTS", 5000)
+        tiles = None
+        if len(rows) > max_points and store.has_tiles():
+            # wide windows get the top variants of each bin of a coarser level
+            top_n = store.meta["tiles"]["top_n"]
+            level = store.tile_level(start_pos, end_pos, max(max_points // top_n, 1))
+            bins, rows = store.tile_bins(level, chrom, start_pos, end_pos)
+            tiles = {"level": level,
+                "width": store.meta["tiles"]["levels"][level]["width"],
+                "top_n": top_n,
+                "bins": {k: v.tolist() for k, v in bins.items()}}
+        json_response_data = get_store_zoom(store, rows)
+        header = {"variant_columns": list(json_response_data.keys())}
+        if tiles is not None:
+            header["tiles"] = tiles
+        return ApiResult(json_response_data, header=header)
+
     headerpos = {x:i for i,x in enumerate(header)}
     tb = tabix.open(output_filename)
     try:
@@ -446,6 +522,35 @@ def get_job_zoom(job_id, job=None):
                 json_response_data["BETA"].append(r[headerpos["BETA"]])
     return ApiResult(json_response_data, header={"variant_columns": list(json_response_data.keys())}) 
 
+def get_store_zoom(store, rows):
+    # same layout as the tabix based zoom, read from the columnar results
+    rows = rows[~np.isnan(store.column("PVALUE")[rows])]
+    json_response_data = dict()
+    json_response_data["CHROM"] = store.values("CHROM", rows)
+    json_response_data["BEGIN"] = store.values("BEGIN", rows)
+    if store.has_column("MARKER_ID"):
+        json_response_data["MARKER_ID"] = store.values("MARKER_ID", rows)
+    else:
+        ids = ["{}:{}".format(c, b) for c, b in
+            zip(json_response_data["CHROM"], json_response_data["BEGIN"])]
+        if store.has_column("Allele1") and store.has_column("Allele2"):
+            ids = ["{}_{}/{}".format(v, a1, a2) for v, a1, a2 in
+                zip(ids, store.values("Allele1", rows), store.values("Allele2", rows))]
+        json_response_data["MARKER_ID"] = ids
+    json_response_data["PVALUE"] = store.values("PVALUE", rows)
+    for col in ("END", "NS"):
+        if store.has_column(col):
+            json_response_data[col] = store.values(col, rows)
+    if store.is_numeric("MAF"):
+        maf = np.array(store.column("MAF")[rows])
+        maf = np.where(maf > .5, 1-maf, maf)
+        json_response_data["MAF"] = [str(x) for x in maf.tolist()]
+    elif store.has_column("MAF"):
+        json_response_data["MAF"] = store.text("MAF", rows)
+    if store.has_column("BETA"):
+        json_response_data["BETA"] = store.values("BETA", rows)
+    return json_response_data
+
 def merge_info_stats(info, info_stats):
     info_extract = re.compile(r'([A-Z0-9_]+)(?:=([^;]+))?(?:;|$)')
     matches = info_extract.findall(info)
@@ -463,6 +568,35 @@ def merge_info_stats(info, info_stats):
         merged[field] = stats
     return merged
 
+def summarize_observations(obs_array):
+    q1, q2, q3 = np.percentile(obs_array, [25, 50, 75])
+    iqr = (q3-q1)*1.5
+    outliers = obs_array[(obs_array<q1-iqr) | (obs_array>q3+iqr)]
+    upper_whisker = obs_array[obs_array<=q3+iqr].max()
+    lower_whisker = obs_array[obs_array>=q1-iqr].min()
+    return {
+        "min": obs_array.min(),
+        "w1": lower_whisker,
+        "q1": q1,
+        "mean": obs_array.mean(),
+        "q2": q2,
+        "q3": q3,
+        "w3": upper_whisker,
+        "max": obs_array.max(),
+        "n":  int(obs_array.size),
+        "outliers": outliers.tolist()
+    }
+
+def summarize_variant_pheno(variant, pheno_columns, pheno_values, info_stats):
+    # pheno_columns are the genotype columns of the phenotyped samples
+    # (see Job.get_pheno_alignment)
+    codes = variant.pop("GENO_CODES")
+    labels = variant.pop("GENO_LABELS")
+    variant.pop("SAMPLE_INDEX")
+    variant["INFO"] = merge_info_stats(variant["INFO"], info_stats)
+    groups = group_by_genotype(codes, labels, pheno_columns, pheno_values)
+    return {genotype: summarize_observations(obs) for genotype, obs in groups.items()}
+
 @api.route("/jobs/<job_id>/plots/pheno", methods=["GET"])
 @check_view_job
 def get_job_variant_pheno(job_id, job=None):
@@ -475,61 +609,91 @@ def get_job_variant_pheno(job_id, job=None):
     geno = Genotype.get(job.meta["genotype"], current_app.config)
     reader = geno.get_geno_reader(current_app.config)
     try:
-        variant = reader.get_variant(chrom, pos, variant_id, annotate=True)
+        variant = reader.get_variant(chrom, pos, variant_id, annotate=True, as_array=True)
     except Exception as e:
         print(e)
         raise ApiException("Unable to retrieve genotypes", details=str(e))
     info_stats = geno.get_info_stats()
-    info = variant["INFO"]
-    calls = variant["GENOS"]
-    del variant["GENOS"]
-    variant["INFO"] = merge_info_stats(info, info_stats)
-    phenos = job.get_adjusted_phenotypes()
-    call_pheno = collections.defaultdict(list) 
-    for sample, value in phenos.items():
-        sample_geno = calls[sample]
-        call_pheno[sample_geno].append(value)
-    summary = {}
-    for genotype, observations in call_pheno.items():
-        obs_array = np.array(observations)
-        q1 = np.percentile(obs_array, 25)
-        q3 = np.percentile(obs_array, 75)
-        iqr = (q3-q1)*1.5
-        outliers = [x for x in obs_array if x<q1-iqr or x>q3+iqr]
-        upper_whisker = obs_array[obs_array<=q3+iqr].max()
-        lower_whisker = obs_array[obs_array>=q1-iqr].min()
-        summary[genotype] = {
-            "min": np.amin(obs_array),
-            "w1": lower_whisker,
-            "q1": q1,
-            "mean": obs_array.mean(),
-            "q2": np.percentile(obs_array, 50),
-            "q3": q3,
-            "w3": upper_whisker,
-            "max": np.amax(obs_array),
-            "n":  obs_array.size,
-            "outliers": outliers
-        }
+    pheno_columns, pheno_values = job.get_pheno_alignment(variant["SAMPLE_INDEX"])
+    summary = summarize_variant_pheno(variant, pheno_columns, pheno_values, info_stats)
     return ApiResult(summary, header=variant)
 
+def parse_variant_list(variants):
+    # accepts "chrom:pos" or epacts style "chrom:pos_ref/alt" ids
+    positions = []
+    for val in variants:
+        val = val.strip()
+        if not val:
+            continue
+        m = re.match(r'^([^:]+):(\d+)(_.+)?$', val)
+        if not m:
+            raise ApiException("INVALID VARIANT", details=val)
+        variant_id = val if m.group(3) else None
+        positions.append((m.group(1), int(m.group(2)), variant_id))
+    return positions
+
+@api.route("/jobs/<job_id>/plots/pheno/batch", methods=["GET", "POST"])
+@check_view_job
+def get_job_variants_pheno(job_id, job=None):
+    if request.is_json:
+        variants = (request.get_json(silent=True) or {}).get("variants", [])
+    else:
+        variants = request.values.get("variants", "").split(",")
+    positions = parse_variant_list(variants)
+    if len(positions) == 0:
+        raise ApiException("MISSING REQUIRED PARAMETER (variants)", 405)
+    max_variants = current_app.config.get("MAX_BATCH_VARIANTS", 500)
+    if len(positions) > max_variants:
+        raise ApiException("TOO MANY VARIANTS REQUESTED (max {})".format(max_variants))
+    geno = Genotype.get(job.meta["genotype"], current_app.config)
+    reader = geno.get_geno_reader(current_app.config)
+    try:
+        variants, errors = reader.get_variants(positions, annotate=True, as_array=True)
+    except Exception as e:
+        print(e)
+        raise ApiException("Unable to retrieve genotypes", details=str(e))
+    info_stats = geno.get_info_stats()
+    aligned = dict()
+    results = []
+    for (chrom, pos, variant_id), variant, error in zip(positions, variants, errors):
+        result = {"chrom": chrom, "pos": pos, "variant_id": variant_id}
+        if variant is not None:
+            try:
+                sample_index = variant["SAMPLE_INDEX"]
+                if id(sample_index) not in aligned:
+                    aligned[id(sample_index)] = job.get_pheno_alignment(sample_index)
+                pheno_columns, pheno_values = aligned[id(sample_index)]
+                result["data"] = summarize_variant_pheno(variant, pheno_columns, pheno_values,
+                    info_stats)
+                result["header"] = variant
+            except Exception as e:
+                result["error"] = str(e)
+        else:
+            result["error"] = error
+        results.append(result)
+    return ApiResult(results)
+
 @api.route("/jobs/<job_id>/progress", methods=["GET"])
 @check_view_job
 def get_job_progress(job_id, job=None):
+    # the summary is cached per job (see chunk_progress); clients polling
+    # with If-None-Match get a 304 while it is unchanged
     sej = SlurmJob(job_id, job.root_path, current_app.config)
-    return ApiResult(sej.get_progress())
+    resp = ApiResult(sej.get_progress()).to_response()
+    resp.add_etag()
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
 
 @api.route("/queue", methods=["GET"])
 @api.route("/queue/<job_id>", methods=["GET"])
 def get_queue_status(job_id=None):
-    queue = get_queue()
+    queue = get_queue_snapshot(current_app.config)
     summary = {"running": len(queue["running"]),
         "queued": len(queue["queued"])}
     if job_id is not None:
-        try:
-            position = [x["job_name"] for x in queue["queued"]].index(job_id) + 1
+        position = queue["positions"].get(job_id)
+        if position is not None:
             summary["position"] = position
-        except:
-            pass
     return ApiResult(summary) 
 
 @api.route("/phenos", methods=["GET"])
@@ -641,8 +805,9 @@ def post_pheno():
         os.mkdir(pheno_directory)
         pheno_file_path = os.path.join(pheno_directory, "pheno.txt")
         pheno_meta_path = os.path.join(pheno_directory, "meta.json")
-        pheno_file.save(pheno_file_path)
-        md5 =  hashfile(open(pheno_file_path, "rb")).hex()
+        sample_rows = int(current_app.config.get("PHENO_SAMPLE_ROWS", 0))
+        ingest = PhenoIngest(pheno_file.stream, pheno_file_path, sample_rows=sample_rows).run()
+        md5 = ingest.md5
     except Exception as e:
         print("File saving error: %s" % e)
         raise ApiException("COULD NOT SAVE FILE")
@@ -658,12 +823,11 @@ def post_pheno():
         pheno_dict["existing"] = True
         return ApiResult(pheno_dict)
     # file has not been uploaded before
-    istext, filetype, mimetype = PhenoReader.is_text_file(pheno_file_path)
-    if not istext:
+    if not ingest.istext:
         shutil.rmtree(pheno_directory)
         raise ApiException("NOT A RECOGNIZED TEXT FILE",
-            details = {"filetype": filetype,
-                "mimetype": mimetype})
+            details = {"filetype": ingest.filetype,
+                "mimetype": ingest.mimetype})
     try:
         Phenotype.add({"id": pheno_id,
             "user_id": user.rid,
@@ -676,19 +840,21 @@ def post_pheno():
         raise ApiException("COULD NOT SAVE TO DATABASE")
     # file has been saved to DB
     pheno = Phenotype.get(pheno_id, current_app.config)
-    pheno_reader = pheno.get_pheno_reader()
     # find samples ids
     latest_geno = next(iter(Genotype.list_all_for_user(user)), None)
     if latest_geno:
         latest_geno = Genotype.get(latest_geno["id"], current_app.config)
-        meta = pheno_reader.infer_meta( sample_ids = latest_geno.get_samples() )
+        sample_ids = list(latest_geno.get_samples())
     else:
-        meta = pheno_reader.infer_meta()
+        sample_ids = None
+    meta = ingest.infer_meta( sample_ids = sample_ids )
     pheno.meta = meta
-    line_count = sum(1 for _ in pheno_reader.row_extractor()) 
-    meta["records"] = line_count
     with open(pheno_meta_path, "w") as f:
         json.dump(meta, f, indent=2)
+    if ingest.sampled:
+        # columns were guessed from a sample; check every row in the background
+        threading.Thread(target=verify_meta,
+            args=(pheno_file_path, pheno_meta_path, sample_ids), daemon=True).start()
     result = {"id": pheno_id,  \
         "url_model": url_for("user.get_model_build", pheno=pheno_id), \
         "url_view": url_for("user.get_pheno", pheno_id=pheno_id)}
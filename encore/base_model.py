@@ -1,8 +1,11 @@
 from .genotype import Genotype
 from .phenotype import Phenotype 
+from .ped_cache import ped_cache_key, get_ped_file, PED_CACHE_MAX_BYTES, PED_CACHE_MAX_AGE
 import os
 
 class BaseModel(object):
+    ped_comment_header = True
+
     def __init__(self, working_directory=None, app_config=None):
         self.working_directory = working_directory
         self.app_config = app_config
@@ -26,6 +29,31 @@ class BaseModel(object):
     def relative_path(self, *args):
         return os.path.expanduser(os.path.join(self.working_directory, *args))
 
+    def write_ped_file(self, ped_file_path, model_spec, geno=None, pheno=None):
+        geno = self.get_geno(model_spec, geno)
+        pheno = self.get_pheno(model_spec, pheno)
+
+        def write_ped(path):
+            ped_writer = self.get_ped_writer(model_spec, geno, pheno) 
+            with open(path, "w") as pedfile:
+                ped_writer.write_to_file(pedfile, comment_header=self.ped_comment_header)
+            return {
+                "response": ped_writer.get_response_headers(),
+                "covars": ped_writer.get_covar_headers()
+            }
+
+        try:
+            pheno.verify_sampled_meta()
+            # reuse the ped file of an earlier job with the same inputs
+            key = ped_cache_key(pheno, geno, model_spec, self.ped_comment_header)
+            ped = get_ped_file(ped_file_path, pheno.relative_path("ped_cache"), key, write_ped,
+                max_bytes=int(self.app_config.get("PED_CACHE_MAX_BYTES", PED_CACHE_MAX_BYTES)),
+                max_age=float(self.app_config.get("PED_CACHE_MAX_AGE", PED_CACHE_MAX_AGE)))
+            ped["path"] = ped_file_path
+            return ped
+        except Exception as e:
+            raise Exception("Failed to create ped file ({})".format(e))
+
     def if_exit_success(self, cmds, ifsuccess): 
         cmds = cmds + [ 
             "EXIT_STATUS=$?", 
@@ -34,6 +62,23 @@ class BaseModel(object):
             ] + ifsuccess + ["fi", "exit $EXIT_STATUS"]
         return cmds
 
+    def get_combined_postprocessing_command(self, geno, result_file, filter_column=None, tophits_window=None,
+            jobs=None):
+        # every postprocessing output from a single read of result_file,
+        # split by chromosome over jobs processes when it is tabix-indexed
+        cmd = "{} {}".format(self.app_config.get("POSTPROCESS_BINARY"), result_file)
+        if jobs:
+            cmd += " --jobs {}".format(jobs)
+        if filter_column:
+            cmd += " --filtered ./output.filtered.001.gz --filter-column {}".format(filter_column)
+        cmd += " --manhattan ./manhattan.json --qq ./qq.json --tophits ./tophits.json" + \
+            " --store ./results.store"
+        if tophits_window is not None:
+            cmd += " --window {}".format(tophits_window)
+        elif geno.get_build_nearest_gene_path():
+            cmd += " --gene {}".format(geno.get_build_nearest_gene_path())
+        return cmd
+
     def validate_model_spec(self, model_spec):
         pass
 
@@ -1,7 +1,127 @@
 import re
 import time
 import os
-import glob
+import json
+import fnmatch
+import threading
+from collections import OrderedDict
+
+# Chunk files of a job directory are tracked by a DirectoryIndex: the
+# directory is only listed again when its mtime changes and only files not
+# seen before, or seen recently modified, are stat'ed. The index is saved in the job directory (under
+# .progress, so saving does not change the job directory mtime) for other
+# workers and restarts, and the progress summary is cached until files
+# appear or change or a chunk moves to an older age group.
+
+INDEX_DIR = ".progress"
+INDEX_FILE = "index.json"
+SETTLE_SECONDS = 2 # listings this close to the directory mtime are redone
+SAVE_SECONDS = 60 # minimum time between saves of a changed index
+AGE_GROUP_MINUTES = (10, 60)
+MAX_INDEXES = 100 # directories kept in memory
+
+class DirectoryIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_DIR, INDEX_FILE)
+        self.watermark = None
+        self.settled = False
+        self.names = set()
+        self.mtimes = dict()
+        self.cache = dict()
+        self.saved = 0
+        self.lock = threading.Lock()
+        self.__load()
+
+    def __load(self):
+        try:
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            self.watermark = saved["watermark"]
+            self.names = set(saved["names"])
+            self.mtimes = saved["mtimes"]
+            self.settled = saved["settled"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def __save(self):
+        # other processes only use the saved index as a starting point, so
+        # it can lag behind
+        if time.time() - self.saved < SAVE_SECONDS:
+            return
+        self.saved = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(self.index_path + ".tmp", "w") as f:
+                json.dump({"watermark": self.watermark, "settled": self.settled,
+                    "names": sorted(self.names), "mtimes": self.mtimes}, f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        except (IOError, OSError) as e:
+            print("Unable to save progress index ({})".format(e))
+
+    def refresh(self):
+        # lists the directory when it has changed since the last listing
+        try:
+            watermark = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            watermark = None
+        if watermark == self.watermark and self.settled:
+            return
+        now = time.time()
+        try:
+            names = set(x for x in os.listdir(self.directory) if x != INDEX_DIR)
+        except OSError:
+            names = set()
+        # files added in the same timestamp tick would not change the mtime
+        self.settled = watermark is not None and now - watermark / 1e9 > SETTLE_SECONDS
+        self.watermark = watermark
+        if names != self.names:
+            for name in self.names - names:
+                self.mtimes.pop(name, None)
+            self.names = names
+            self.cache = dict()
+        self.__save()
+
+    def matching(self, pattern):
+        # names matching a glob pattern
+        key = ("names", pattern)
+        if key not in self.cache:
+            self.cache[key] = sorted(fnmatch.filter(self.names, pattern))
+        return self.cache[key]
+
+    def modified(self, names, recheck_seconds=0):
+        # modification times; new files are stat'ed, as are files last seen
+        # modified less than recheck_seconds ago (they may still be written).
+        # Cached summaries are dropped when a time changes
+        now = time.time()
+        stale = [x for x in names if x not in self.mtimes or now - self.mtimes[x] < recheck_seconds]
+        changed = False
+        for name in stale:
+            try:
+                mtime = os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            if self.mtimes.get(name) != mtime:
+                self.mtimes[name] = mtime
+                changed = True
+        if changed:
+            self.cache = dict()
+            self.__save()
+        return [self.mtimes.get(x) for x in names]
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+def get_directory_index(directory):
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            index = _indexes[directory] = DirectoryIndex(directory)
+            while len(_indexes) > MAX_INDEXES:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(directory)
+    return index
 
 def bin_chunks_by_chr_and_age(chunks, now):
     def get_age_group(a):
@@ -69,35 +189,58 @@ def collapse_chunk_bins(bins):
     return results
 
 def get_gene_chunk_progress(output_file_glob, input_file_glob, min_done_age=0):
-    in_files = glob.glob(input_file_glob)
-    out_files = glob.glob(output_file_glob)
-    if min_done_age>0:
-        now = time.mktime(time.localtime())
-        def age_in_minutes(x):
-            return (now - time.mktime(time.localtime(os.path.getmtime(x)))) / 60
-        out_files = [x for x in out_files if age_in_minutes(x)>min_done_age]
+    directory = os.path.dirname(output_file_glob)
+    index = get_directory_index(directory)
+    with index.lock:
+        index.refresh()
+        in_files = index.matching(os.path.basename(input_file_glob))
+        out_files = index.matching(os.path.basename(output_file_glob))
+        if min_done_age>0:
+            now = time.mktime(time.localtime())
+            def age_in_minutes(x):
+                return (now - time.mktime(time.localtime(x))) / 60
+            mtimes = index.modified(out_files, recheck_seconds=min_done_age * 60)
+            out_files = [x for x, modified in zip(out_files, mtimes)
+                if modified is not None and age_in_minutes(modified)>min_done_age]
     return {"data": {"total": len(in_files), "complete": len(out_files)}, 
         "header": {"format": "progress"}}
 
-def get_chr_chunk_progress(output_file_glob, fileregex):
-    files = glob.glob(output_file_glob)
-    now = time.mktime(time.localtime())
-    if len(files):
-        chunks = []
-        p = re.compile(fileregex)
-        for file in files:
-            m = p.search(file)
-            chunk = dict(m.groupdict())
-            chunk['chrom'] =  chunk['chr']
-            if not chunk['chrom'].startswith("chr"):
-                chunk['chrom'] = "chr" + chunk['chrom']
-            chunk['start'] = int(chunk['start'])
-            chunk['stop'] = int(chunk['stop'])
-            chunk['modified'] = time.mktime(time.localtime(os.path.getmtime(file)))
-            chunks.append(chunk)
-        
-        result = collapse_chunk_bins(bin_chunks_by_chr_and_age(chunks, now))
-        return {"data": result, "header": {"format": "ideogram"}}
-
-            
+def next_age_change(modified, now):
+    # the next time a chunk moves to an older age group
+    changes = [x + m * 60 for x in modified for m in AGE_GROUP_MINUTES if x + m * 60 > now]
+    return min(changes) if changes else None
 
+def get_chr_chunk_progress(output_file_glob, fileregex):
+    directory = os.path.dirname(output_file_glob)
+    index = get_directory_index(directory)
+    with index.lock:
+        index.refresh()
+        files = index.matching(os.path.basename(output_file_glob))
+        # chunks younger than the oldest age group can still change
+        all_modified = index.modified(files, recheck_seconds=max(AGE_GROUP_MINUTES) * 60)
+        now = time.mktime(time.localtime())
+        key = ("chr", output_file_glob, fileregex)
+        cached = index.cache.get(key)
+        if cached is not None and (cached[0] is None or now < cached[0]):
+            return cached[1]
+        if len(files):
+            chunks = []
+            p = re.compile(fileregex)
+            for file, modified in zip(files, all_modified):
+                m = p.search(os.path.join(directory, file))
+                if m is None or modified is None:
+                    continue
+                chunk = dict(m.groupdict())
+                chunk['chrom'] =  chunk['chr']
+                if not chunk['chrom'].startswith("chr"):
+                    chunk['chrom'] = "chr" + chunk['chrom']
+                chunk['start'] = int(chunk['start'])
+                chunk['stop'] = int(chunk['stop'])
+                chunk['modified'] = time.mktime(time.localtime(modified))
+                chunks.append(chunk)
+            if not chunks:
+                return None
+            result = collapse_chunk_bins(bin_chunks_by_chr_and_age(chunks, now))
+            resp = {"data": result, "header": {"format": "ideogram"}}
+            index.cache[key] = (next_age_change([x["modified"] for x in chunks], now), resp)
+            return resp
@@ -74,7 +74,14 @@ class EpactsModel(BaseModel):
                 "{} -c > output.epacts.gz\n".format(self.app_config.get("BGZIP_BINARY", "bgzip")) + \
                 " {} -p bed output.epacts.gz\n".format(self.app_config.get("TABIX_BINARY", "tabix")) + \
                 "fi")
-        else:
+        if self.app_config.get("POSTPROCESS_BINARY"):
+            filter_column = "MAF" if self.code in ("lmm", "lm") and self.cmd != "group" else None
+            cmds.append(self.get_combined_postprocessing_command(geno, "./output.epacts.gz",
+                filter_column, 0 if self.cmd == "group" else None, self.cores_per_job))
+            cmds.append("fi")
+            cmds.append("exit $EXIT_STATUS")
+            return cmds
+        if self.cmd != "group":
             if self.code == "lmm":
                 cmds.append("zcat -f output.epacts.gz | " + \
                     'awk -F"\\t" \'NR==1 || ($9 > 0 && $11 < 0.001) {OFS="\\t"; print }\' | ' + \
@@ -83,6 +90,9 @@ class EpactsModel(BaseModel):
                 cmds.append("zcat -f output.epacts.gz | " + \
                     'awk -F"\\t" \'NR==1 || ($8 > 0 && $9 < 0.001) {OFS="\\t"; print }\' | ' + \
                     "{} -c > output.filtered.001.gz".format(self.app_config.get("BGZIP_BINARY", "bgzip")))
+        if self.app_config.get("RESULTS_STORE_BINARY"):
+            cmd = "{} ./output.epacts.gz ./results.store".format(self.app_config.get("RESULTS_STORE_BINARY"))
+            cmds.append(cmd)
         if self.app_config.get("MANHATTAN_BINARY"):
             cmd  = "{} ./output.epacts.gz ./manhattan.json".format(self.app_config.get("MANHATTAN_BINARY", ""))
             cmds.append(cmd)
@@ -100,22 +110,6 @@ class EpactsModel(BaseModel):
         cmds.append("exit $EXIT_STATUS")
         return cmds 
 
-    def write_ped_file(self, ped_file_path, model_spec, geno=None, pheno=None):
-        geno = self.get_geno(model_spec, geno)
-        pheno = self.get_pheno(model_spec, pheno)
-       
-        try:
-            ped_writer = self.get_ped_writer(model_spec, geno, pheno) 
-            with open(ped_file_path, "w") as pedfile:
-                ped_writer.write_to_file(pedfile)
-            return {
-                "response": ped_writer.get_response_headers(),
-                "covars": ped_writer.get_covar_headers(),
-                "path": ped_file_path
-            }
-        except Exception as e:
-            raise Exception("Failed to create ped file ({})".format(e))
-
     def prepare_job(self, model_spec):
         geno = self.get_geno(model_spec)
         pheno = self.get_pheno(model_spec)
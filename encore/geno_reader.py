@@ -1,35 +1,174 @@
 import subprocess
+import threading
+import hashlib
 from collections import deque
+import numpy as np
+from .tabix_reader import get_tabix_reader, block_cache
+
+MISSING_GENO = -1
 
 def get_epacts_variant_id(data):
     return "{}:{}_{}/{}".format(data[0], data[1], data[3], data[4])
 
+class SampleIndex:
+    # sample columns of a vcf header line, shared by every variant read with it
+    def __init__(self, samples):
+        self.samples = samples
+        self.columns = {x: i for i, x in enumerate(samples)}
+        self.signature = hashlib.md5("\t".join(samples).encode()).hexdigest()
+
+    def align(self, sample_ids):
+        # column of each sample id in the genotype data, MISSING_GENO if absent
+        columns = self.columns
+        return np.fromiter((columns.get(x, MISSING_GENO) for x in sample_ids),
+            dtype=np.int64, count=len(sample_ids))
+
+_sample_indexes = dict()
+_sample_indexes_lock = threading.Lock()
+
+def get_sample_index(header_line):
+    index = _sample_indexes.get(header_line)
+    if index is None:
+        index = SampleIndex(tuple(header_line.split("\t")[9:]))
+        with _sample_indexes_lock:
+            if len(_sample_indexes) > 64:
+                _sample_indexes.clear()
+            _sample_indexes[header_line] = index
+    return index
+
+def encode_genotypes(sample_text, fmt):
+    # factor the tab separated sample fields of a vcf line into small integer
+    # codes plus their labels
+    if not sample_text:
+        return np.zeros(0, dtype=np.int8), []
+    if ":" not in fmt:
+        raw = sample_text.encode()
+        width = raw.find(b"\t")
+        if 0 < width <= 8 and (len(raw) + 1) % (width + 1) == 0:
+            # fixed width calls (e.g. 0/1) are read in place as 8 byte integers
+            cells = np.frombuffer(raw + b"\t", dtype=np.uint8).reshape(-1, width + 1)
+            if raw.count(b"\t") == len(cells) - 1 and (cells[:, width] == 9).all():
+                padded = np.zeros((len(cells), 8), dtype=np.uint8)
+                padded[:, :width] = cells[:, :width]
+                keys, codes = np.unique(padded.view(np.uint64).ravel(), return_inverse=True)
+                labels = [x.tobytes().rstrip(b"\x00").decode() for x in keys]
+                return codes.astype(np.int8 if len(labels) < 128 else np.int16), labels
+    calls = np.array(sample_text.split("\t"))
+    if ":" in fmt:
+        calls = np.char.partition(calls, ":")[:, 0]
+    labels, codes = np.unique(calls, return_inverse=True)
+    labels = [str(x) for x in labels]
+    return codes.astype(np.int8 if len(labels) < 128 else np.int16), labels
+
+def group_by_genotype(codes, labels, columns, values):
+    # split phenotype values by the genotype code of the matching sample
+    sample_codes = np.full(len(columns), MISSING_GENO, dtype=np.int64)
+    present = columns != MISSING_GENO
+    sample_codes[present] = codes[columns[present]]
+    keep = sample_codes != MISSING_GENO
+    sample_codes = sample_codes[keep]
+    values = values[keep]
+    order = np.argsort(sample_codes, kind="stable")
+    counts = np.bincount(sample_codes, minlength=len(labels))
+    groups = np.split(values[order], np.cumsum(counts)[:-1])
+    return {labels[i]: g for i, g in enumerate(groups) if counts[i] > 0}
+
 class GenoReader:
     def __init__(self, geno, config):
         self.geno = geno
         self.config = config
+        if "GENO_BLOCK_CACHE_BYTES" in config:
+            block_cache.set_max_bytes(int(config["GENO_BLOCK_CACHE_BYTES"]))
 
-    def get_variant(self, chrom, pos, variant_id=None, annotate=False):
-        sav_path = self.geno.get_sav_path(chrom, must_exist=True)
-        vcf_path = self.geno.get_vcf_path(chrom, must_exist=True)
-        if sav_path:
-            raw_data = self.get_sav_row(sav_path, chrom, pos)
-        elif vcf_path:
-            raw_data = self.get_vcf_row(vcf_path, chrom, pos)
-        else:
-            raise Exception("Could not find genotype data")
-        variant = self.parse_vcf_data(raw_data, variant_id)
+    def get_variant(self, chrom, pos, variant_id=None, annotate=False, as_array=False):
+        raw_data = self.get_geno_rows(chrom, [pos])[pos]
+        variant = self.parse_vcf_data(raw_data, variant_id, as_array)
         if annotate:
             anno_path = self.geno.get_vcf_anno_path(chrom)
             if anno_path:
                 anno = self.parse_vcf_data(self.get_vcf_row(anno_path, chrom, pos), variant_id)
-                if variant["INFO"]:
-                    variant["INFO"] = variant["INFO"] + ";" + anno["INFO"]
-                elif anno["INFO"]:
-                    variant["INFO"] = anno["INFO"]
+                self.merge_anno(variant, anno)
         return variant
 
+    def get_variants(self, positions, annotate=False, as_array=False):
+        # positions is a list of (chrom, pos, variant_id); variant_id may be None
+        # returns a list of variants and a list of errors, both in input order
+        variants = [None] * len(positions)
+        errors = [None] * len(positions)
+        by_chrom = dict()
+        for idx, (chrom, pos, variant_id) in enumerate(positions):
+            by_chrom.setdefault(str(chrom), []).append(idx)
+        for chrom, idxs in by_chrom.items():
+            wanted = sorted(set(positions[i][1] for i in idxs))
+            try:
+                rows = self.get_geno_rows(chrom, wanted)
+                anno_rows = None
+                if annotate:
+                    anno_path = self.geno.get_vcf_anno_path(chrom)
+                    if anno_path:
+                        anno_rows = self.get_vcf_rows(anno_path, chrom, wanted)
+            except Exception as e:
+                for i in idxs:
+                    errors[i] = str(e)
+                continue
+            for i in idxs:
+                _, pos, variant_id = positions[i]
+                try:
+                    variant = self.parse_vcf_data(deque(rows[pos]), variant_id, as_array)
+                    if anno_rows is not None:
+                        anno = self.parse_vcf_data(deque(anno_rows[pos]), variant_id)
+                        self.merge_anno(variant, anno)
+                    variants[i] = variant
+                except Exception as e:
+                    errors[i] = str(e)
+        return variants, errors
+
+    def merge_anno(self, variant, anno):
+        if variant["INFO"]:
+            variant["INFO"] = variant["INFO"] + ";" + anno["INFO"]
+        elif anno["INFO"]:
+            variant["INFO"] = anno["INFO"]
+
+    def get_geno_rows(self, chrom, positions):
+        sav_path = self.geno.get_sav_path(chrom, must_exist=True)
+        vcf_path = self.geno.get_vcf_path(chrom, must_exist=True)
+        if vcf_path and get_tabix_reader(vcf_path):
+            # indexed vcf can be read in-process, no need to export from sav
+            return self.get_vcf_rows(vcf_path, chrom, positions)
+        elif sav_path:
+            return {pos: self.get_sav_row(sav_path, chrom, pos) for pos in positions}
+        elif vcf_path:
+            return self.get_vcf_rows(vcf_path, chrom, positions)
+        else:
+            raise Exception("Could not find genotype data")
+
+    def get_vcf_rows(self, vcf_path, chrom, positions):
+        reader = get_tabix_reader(vcf_path)
+        if reader:
+            try:
+                return reader.fetch_lines_many(chrom, positions)
+            except Exception as e:
+                raise Exception("Could not extract genotype ({})".format(e))
+        return {pos: self.get_vcf_row(vcf_path, chrom, pos) for pos in positions}
+
+    def get_sample_index(self, chrom=1):
+        # sample columns without reading a variant; only possible for indexed vcfs
+        vcf_path = self.geno.get_vcf_path(chrom, must_exist=True)
+        reader = get_tabix_reader(vcf_path) if vcf_path else None
+        if reader is None or not reader.header():
+            return None
+        return get_sample_index(reader.header()[-1])
+
     def get_sav_row(self, sav_path, chrom, pos):
+        # sav files aren't bgzf, so cache the exported lines in the same pool
+        key = (sav_path, "export", str(chrom), pos)
+        lines = block_cache.get(key)
+        if lines is None:
+            lines = self.export_sav_row(sav_path, chrom, pos)
+            block_cache.put(key, lines, sum(len(x) for x in lines))
+        return deque(lines)
+
+    def export_sav_row(self, sav_path, chrom, pos):
         cmd = [self.config.get("SAV_BINARY", "sav"),
             "export",
             "-r", "{}:{}-{}".format(chrom , pos, pos+1),
@@ -41,10 +180,15 @@ class GenoReader:
             raise Exception("Could not extract genotype")
         except OSError:
             raise Exception("Could not find sav")
-        lines = deque([x for x in lines if not x.startswith("##") and len(x)!=0])
-        return lines
+        return tuple(x for x in lines if not x.startswith("##") and len(x)!=0)
 
     def get_vcf_row(self, vcf_path, chrom, pos):
+        reader = get_tabix_reader(vcf_path)
+        if reader:
+            try:
+                return reader.fetch_lines(chrom, pos, pos+1)
+            except Exception as e:
+                raise Exception("Could not extract genotype ({})".format(e))
         cmd = [self.config.get("TABIX_BINARY", "tabix"),
             "-h",
             vcf_path,
@@ -58,22 +202,32 @@ class GenoReader:
         lines = deque([x for x in lines if not x.startswith("##") and len(x)!=0])
         return lines
 
-    def parse_vcf_data(self, lines, variant_id):
+    def parse_vcf_data(self, lines, variant_id, as_array=False):
         if len(lines)<2:
             raise Exception("No variants not found")
-        headers = lines.popleft().split("\t")
+        # with as_array, only the fixed columns are split out of the header
+        # and data lines; sample fields are decoded in bulk below
+        maxsplit = 9 if as_array else -1
+        header_line = lines.popleft()
+        headers = header_line.split("\t", maxsplit)[:9] if as_array else header_line.split("\t")
         headers[0] = headers[0].strip("#")
-        data = lines.popleft().split("\t")
+        data = lines.popleft().split("\t", maxsplit)
         current_variant = get_epacts_variant_id(data)
         if variant_id is not None:
             while not variant_id.startswith(current_variant):
                 if len(lines)<1:
                     raise Exception("Variant not found ({})".format(variant_id))
-                data = lines.popleft().split("\t")
+                data = lines.popleft().split("\t", maxsplit)
                 current_variant = get_epacts_variant_id(data)
         if len(lines)>2:
             raise Exception("Multiple variants found, no ID given")
-        if len(headers)>8:
+        if len(headers)>8 and as_array:
+            variant_data = dict(zip(headers[0:9], data[0:9]))
+            codes, labels = encode_genotypes(data[9] if len(data)>9 else "", data[8])
+            variant_data["GENO_CODES"] = codes
+            variant_data["GENO_LABELS"] = labels
+            variant_data["SAMPLE_INDEX"] = get_sample_index(header_line)
+        elif len(headers)>8:
             variant_data = dict(zip(headers[0:9], data[0:9]))
             variant_data["GENOS"] = dict(zip(headers[9:], data[9:]))
         else:
@@ -6,9 +6,12 @@ import MySQLdb
 import sys
 import re
 import hashlib
+import tempfile
+import numpy as np
 from collections import OrderedDict
 from .user import User
 from .model_factory import ModelFactory
+from .results_store import get_results_store
 from .db_helpers import SelectQuery, TableJoin, PagedResult, OrderClause, OrderExpression, WhereExpression, WhereAll
 
 class Job:
@@ -33,6 +36,59 @@ class Job:
                     phenos[sample] = float(val)
         return phenos
 
+    def get_pheno_alignment(self, sample_index, build=True):
+        # adjusted phenotypes as (genotype column, value) arrays for the samples
+        # of sample_index; stored next to output.phe and memory-mapped on read
+        phe_file = self.relative_path("output.phe")
+        info_file = self.relative_path("output.phe.align.json")
+        columns_file = self.relative_path("output.phe.columns.npy")
+        values_file = self.relative_path("output.phe.values.npy")
+        if not os.path.exists(phe_file):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        phe_mtime = os.path.getmtime(phe_file)
+        try:
+            with open(info_file) as f:
+                info = json.load(f)
+            if info["samples"] == sample_index.signature and info["phe_mtime"] == phe_mtime:
+                return np.load(columns_file, mmap_mode="r"), np.load(values_file, mmap_mode="r")
+        except (IOError, ValueError, KeyError):
+            pass
+        if not build:
+            return None
+        phenos = self.get_adjusted_phenotypes()
+        columns = sample_index.align(list(phenos.keys()))
+        values = np.fromiter(phenos.values(), dtype=np.float64, count=len(phenos))
+        def replace(path, write, mode="wb"):
+            # concurrent requests may build the same alignment, so each
+            # writes its own temporary file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, mode) as f:
+                    write(f)
+                os.replace(tmp_path, path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        try:
+            for path, arr in ((columns_file, columns), (values_file, values)):
+                replace(path, lambda f: np.save(f, arr))
+            replace(info_file, lambda f: json.dump({"samples": sample_index.signature,
+                "phe_mtime": phe_mtime}, f), "w")
+        except (IOError, OSError) as e:
+            print("Unable to store phenotype alignment ({})".format(e))
+        return columns, values
+
+    def build_pheno_alignment(self, config):
+        from .genotype import Genotype
+        geno = Genotype.get(self.get_genotype_id(), config)
+        if geno is None:
+            return False
+        sample_index = geno.get_geno_reader(config).get_sample_index()
+        if sample_index is None:
+            return False
+        self.get_pheno_alignment(sample_index)
+        return True
+
     def relative_path(self, *args):
         return os.path.expanduser(os.path.join(self.root_path, *args))
 
@@ -61,6 +117,10 @@ class Job:
         else:
             return None
 
+    def get_results_store(self):
+        # columnar copy of the primary output, if postprocessing created one
+        return get_results_store(self.relative_path("results.store"))
+
     def get_owner(self):
         return User.from_id(self.user_id) 
 
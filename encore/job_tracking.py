@@ -1,5 +1,6 @@
 import MySQLdb
-from threading import Timer
+import queue
+from threading import Timer, Thread
 from datetime import datetime
 import sys
 import subprocess
@@ -27,6 +28,30 @@ class Tracker(object):
         self.credentials = db_credentials
         self.app = app
         self.timer = None
+        self.db = None
+        self.last_poll = None
+        self.status_ids = None
+        self.initial_lookback = datetime.timedelta(days=30)
+        self.poll_overlap = datetime.timedelta(minutes=2)
+        self.results_queue = queue.Queue()
+        self.results_worker = None
+
+    def get_db(self):
+        if self.db is not None:
+            try:
+                self.db.ping()
+                # drop any snapshot left from the previous poll
+                self.db.rollback()
+                return self.db
+            except MySQLdb.Error:
+                try:
+                    self.db.close()
+                except MySQLdb.Error:
+                    pass
+                self.db = None
+        self.db = MySQLdb.connect(host=self.credentials.host, user=self.credentials.user,
+            passwd=self.credentials.pw, db=self.credentials.db)
+        return self.db
 
     def query_pending_jobs(self, db):
 
@@ -36,13 +61,20 @@ class Tracker(object):
 
         cur = db.cursor(MySQLdb.cursors.DictCursor)
         cur.execute(sql)
-        jobs = []
-        for x in range(0, cur.rowcount):
-            row = cur.fetchone()
-            jobs.append(Job(row["id"], row["status"]))
+        jobs = dict()
+        for row in cur.fetchall():
+            jobs[row["id"]] = Job(row["id"], row["status"])
         return jobs
 
-    def update_job_status(self, db, job, slurm_status, exit_code):
+    def get_status_ids(self, db):
+        if self.status_ids is None:
+            cur = db.cursor(MySQLdb.cursors.DictCursor)
+            cur.execute("SELECT id, name FROM statuses")
+            self.status_ids = {row["name"]: row["id"] for row in cur.fetchall()}
+        return self.status_ids
+
+    @staticmethod
+    def translate_slurm_status(slurm_status):
         status = ""
         reason = ""
         if slurm_status == "RUNNING":
@@ -61,64 +93,141 @@ class Tracker(object):
             status = "failed"
         elif slurm_status == "COMPLETED":
             status = "succeeded"
+        return status, reason
 
-        if status:
-            cur = db.cursor(MySQLdb.cursors.DictCursor)
-            if reason:
-                sql = "UPDATE jobs SET status_id = (SELECT id FROM statuses WHERE name=%s LIMIT 1), " +  \
-                    "error_message=%s, " + \
-                    "modified_date = NOW() WHERE id = uuid_to_bin(%s)"
-                cur.execute(sql, (status, reason, job.id))
-            else:
-                sql = "UPDATE jobs SET status_id = (SELECT id FROM statuses WHERE name=%s LIMIT 1), " + \
-                    "modified_date = NOW() WHERE id = uuid_to_bin(%s)"
-                cur.execute(sql, (status, job.id))
+    def update_job_status(self, db, job, slurm_status, exit_code):
+        return self.update_job_status_batch(db, [(job, slurm_status, exit_code)])
+
+    def update_job_status_batch(self, db, updates):
+        # updates is a list of (job, slurm_status, exit_code)
+        groups = dict()
+        for job, slurm_status, exit_code in updates:
+            status, reason = self.translate_slurm_status(slurm_status)
+            if not status or status == job.status:
+                continue
+            groups.setdefault((status, reason), []).append(job)
+        if not groups:
+            return 0
+
+        status_ids = self.get_status_ids(db)
+        missing = [status for status, reason in groups if status not in status_ids]
+        if missing:
+            raise Exception("Unknown job status: {}".format(", ".join(missing)))
+        cur = db.cursor()
+        try:
+            for (status, reason), jobs in groups.items():
+                ids = ", ".join(["uuid_to_bin(%s)"] * len(jobs))
+                if reason:
+                    sql = "UPDATE jobs SET status_id = %s, error_message=%s, " + \
+                        "modified_date = NOW() WHERE id IN (" + ids + ")"
+                    cur.execute(sql, [status_ids[status], reason] + [j.id for j in jobs])
+                else:
+                    sql = "UPDATE jobs SET status_id = %s, " + \
+                        "modified_date = NOW() WHERE id IN (" + ids + ")"
+                    cur.execute(sql, [status_ids[status]] + [j.id for j in jobs])
             db.commit()
-            notifier = get_notifier()
-            if notifier:
-                try:
-                    if status == "failed":
+        except:
+            db.rollback()
+            raise
+        finally:
+            cur.close()
+
+        jobs_updated = 0
+        for (status, reason), jobs in groups.items():
+            for job in jobs:
+                job.status = status
+            jobs_updated += len(jobs)
+        notifier = get_notifier()
+        if notifier:
+            for (status, reason), jobs in groups.items():
+                if status != "failed":
+                    continue
+                for job in jobs:
+                    try:
                         notifier.send_failed_job(job.id)
-                except:
-                    pass
+                    except:
+                        pass
+        succeeded = [job for (status, reason), jobs in groups.items() \
+            if status == "succeeded" for job in jobs]
+        if succeeded:
+            self.queue_job_results(succeeded)
+        return jobs_updated
 
-    def update_job_statuses(self, db, jobs):
+    def queue_job_results(self, jobs):
+        # prepared on a worker thread so the poll never waits on it
+        for job in jobs:
+            self.results_queue.put(job.id)
+        if self.results_worker is None or not self.results_worker.is_alive():
+            self.results_worker = Thread(target=self.results_worker_loop)
+            self.results_worker.daemon = True
+            self.results_worker.start()
+
+    def results_worker_loop(self):
+        while True:
+            job_id = self.results_queue.get()
+            with self.app.app_context():
+                self.prepare_job_results(job_id)
+
+    def prepare_job_results(self, job_id):
+        # one-time work on finished jobs so result requests can skip it
+        from .job import Job as EncoreJob
+        try:
+            encore_job = EncoreJob.get(job_id, self.app.config)
+            if encore_job is not None:
+                encore_job.build_pheno_alignment(self.app.config)
+        except Exception as e:
+            print("Unable to prepare results for job {} ({})".format(job_id, e))
+
+    def get_sacct_start(self, now):
+        if self.last_poll is None:
+            return now - self.initial_lookback
+        return self.last_poll - self.poll_overlap
+
+    def query_slurm_jobs(self, since):
         p = subprocess.Popen(["/usr/cluster/bin/sacct", "-u", pwd.getpwuid(os.getuid())[0], \
             "--format", "jobid,state,exitcode,jobname,submit", "--noheader", "-P", \
-            "-S", (datetime.date.today() - datetime.timedelta(days=30)).strftime("%Y-%m-%d")], \
+            "-S", since.strftime("%Y-%m-%dT%H:%M:%S")], \
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        squeue_out, squeue_err = p.communicate()
+        sacct_out, sacct_err = p.communicate()
+        if p.returncode != 0:
+            raise Exception("sacct failed ({})".format(sacct_err.decode().strip()))
 
         # keep only most recent submission date for each job
         slurm_jobs_found = dict()
-        for line in squeue_out.decode().rstrip().split("\n"):
+        for line in sacct_out.decode().rstrip().split("\n"):
             if line:
                 slurm_job = line.strip().split("|")
                 # strip off "gasp_"
                 job_name = slurm_job[3][5:]
                 if job_name in slurm_jobs_found:
-                    prev_date = datetime.datetime.strptime(slurm_jobs_found[job_name][4], '%Y-%m-%dT%H:%M:%S')
-                    curr_date = datetime.datetime.strptime(slurm_job[4], '%Y-%m-%dT%H:%M:%S')
-                    if curr_date > prev_date:
+                    if slurm_job[4] > slurm_jobs_found[job_name][4]:
                         slurm_jobs_found[job_name] = slurm_job
                 else:
                     slurm_jobs_found[job_name] = slurm_job
-        jobs_updated = 0
-        for slurm_job in slurm_jobs_found.values():
-            for j in jobs:
-                if slurm_job[3][5:] == j.id:
-                    self.update_job_status(db, j, slurm_job[1], slurm_job[2])
-                    jobs_updated += 1
-                    break
+        return slurm_jobs_found
+
+    def update_job_statuses(self, db, jobs):
+        now = datetime.datetime.now()
+        slurm_jobs_found = self.query_slurm_jobs(self.get_sacct_start(now))
+        updates = []
+        for job_name, slurm_job in slurm_jobs_found.items():
+            j = jobs.get(job_name)
+            if j is not None:
+                updates.append((j, slurm_job[1], slurm_job[2]))
+        jobs_updated = self.update_job_status_batch(db, updates)
+        # only move the window forward once every change has been applied
+        self.last_poll = now
         return jobs_updated
 
     def routine(self):
         with self.app.app_context():
-            db = MySQLdb.connect(host=self.credentials.host, user=self.credentials.user, passwd=self.credentials.pw, db=self.credentials.db)
+            db = self.get_db()
             jobs = self.query_pending_jobs(db)
             if len(jobs) != 0:
                 return self.update_job_statuses(db, jobs)
             else:
+                # nothing to track; later submissions will fall after this point
+                self.last_poll = datetime.datetime.now()
                 return 0
 
     def timer_callback(self):
@@ -0,0 +1,130 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+import tempfile
+
+# bump when PedWriter output changes so stale entries are not reused
+PED_CACHE_VERSION = 1
+
+# defaults for the size of each phenotype's cache (see prune_ped_cache)
+PED_CACHE_MAX_BYTES = 5 * 1024**3
+PED_CACHE_MAX_AGE = 30 * 24 * 3600
+TMP_MAX_AGE = 24 * 3600
+
+def ped_cache_key(pheno, geno, model_spec, comment_header=True):
+    # hash of everything a generated ped file depends on
+    if not pheno.md5sum:
+        return None
+    meta = pheno.meta or {}
+    fields = {"version": PED_CACHE_VERSION,
+        "pheno_md5": pheno.md5sum,
+        "pheno_layout": meta.get("layout"),
+        "pheno_columns": meta.get("columns"),
+        "response": model_spec.get("response"),
+        "covariates": model_spec.get("covariates", []),
+        "genopheno": model_spec.get("genopheno", []),
+        "comment_header": comment_header}
+    if fields["genopheno"]:
+        reader = geno.get_pheno_reader()
+        if reader is None:
+            return None
+        stat = os.stat(reader.path)
+        fields["geno"] = {"id": geno.geno_id, "path": reader.path, "size": stat.st_size,
+            "mtime": stat.st_mtime_ns, "columns": (reader.meta or {}).get("columns")}
+    data = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+def prune_ped_cache(cache_dir, max_bytes=PED_CACHE_MAX_BYTES, max_age=PED_CACHE_MAX_AGE, keep=None):
+    # removes entries unused for max_age seconds, then the least recently
+    # used ones until the cached ped files take at most max_bytes; the
+    # entry keep is counted but never removed. Jobs hold their own links
+    now = time.time()
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    entries = []
+    total = 0
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        key, ext = os.path.splitext(name)
+        try:
+            if ext == ".tmp":
+                if now - os.path.getmtime(path) > TMP_MAX_AGE:
+                    os.remove(path)
+                continue
+            if ext != ".json":
+                continue
+            used = os.path.getmtime(path)
+            size = os.path.getsize(os.path.join(cache_dir, key + ".ped"))
+        except OSError:
+            continue
+        total += size
+        if key != keep:
+            entries.append((used, size, key))
+    for used, size, key in sorted(entries):
+        expired = max_age is not None and now - used > max_age
+        if not expired and (max_bytes is None or total <= max_bytes):
+            break
+        try:
+            # without its info file an entry is never reused
+            os.remove(os.path.join(cache_dir, key + ".json"))
+            os.remove(os.path.join(cache_dir, key + ".ped"))
+        except OSError:
+            continue
+        total -= size
+
+def get_ped_file(ped_file_path, cache_dir, key, write_ped, max_bytes=PED_CACHE_MAX_BYTES,
+        max_age=PED_CACHE_MAX_AGE):
+    # write_ped(path) writes a ped file and returns its response/covars
+    # headers; a cached copy is hardlinked (or copied) when key was seen.
+    # Entries are pruned (see prune_ped_cache) when one is added
+    if os.path.lexists(ped_file_path):
+        # never write through a link into the cache
+        os.remove(ped_file_path)
+    if key is None or cache_dir is None:
+        return write_ped(ped_file_path)
+    cached_path = os.path.join(cache_dir, key + ".ped")
+    info_path = os.path.join(cache_dir, key + ".json")
+    try:
+        with open(info_path) as f:
+            info = json.load(f)
+        link_or_copy(cached_path, ped_file_path)
+    except (OSError, ValueError):
+        pass
+    else:
+        try:
+            # the info file's mtime is the last use of the entry
+            os.utime(info_path, None)
+        except OSError:
+            pass
+        return info
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        os.close(fd)
+    except OSError:
+        return write_ped(ped_file_path)
+    try:
+        info = write_ped(tmp_path)
+        # cached files are shared through hardlinks, so keep them read-only
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, cached_path)
+        # the info file marks the entry complete
+        with open(tmp_path, "w") as f:
+            json.dump(info, f)
+        os.replace(tmp_path, info_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    link_or_copy(cached_path, ped_file_path)
+    prune_ped_cache(cache_dir, max_bytes, max_age, keep=key)
+    return info
@@ -1,5 +1,9 @@
 import re
+import numpy as np
 from itertools import chain
+from operator import itemgetter
+
+WRITE_BLOCK_ROWS = 65536
 
 def sanitize(x):
     if re.match(r'^[^A-Za-z]', x):
@@ -7,6 +11,16 @@ def sanitize(x):
     x = re.sub(r'[^A-Za-z0-9._]', "_", x)
     return x
 
+def level_codes(values, levels):
+    # index of each value in levels, -1 if it is not a level
+    levels = np.array(levels, dtype=object)
+    if len(levels) == 0:
+        return np.full(len(values), -1)
+    order = np.argsort(levels, kind="mergesort")
+    sorted_levels = levels[order]
+    pos = np.minimum(np.searchsorted(sorted_levels, values), len(levels)-1)
+    return np.where(sorted_levels[pos] == values, order[pos], -1)
+
 class ColumnFactory:
     @staticmethod
     def get_by_name(name, pr):
@@ -44,9 +58,11 @@ class ColumnFactory:
             return Column(coldef, pr, options=options)
 
 class Column(object):
+    # raw strings are kept in an object array with a missing mask
     def __init__(self, coldef, pr, options=None):
         self.coldef = coldef
-        self._raw_values = []
+        self._values = np.array([], dtype=object)
+        self._missing = np.array([], dtype=bool)
         if self.coldef:
             self.name = coldef["name"]
             self.colindex = [x["name"] for x in pr.meta["columns"]].index(self.name)
@@ -55,34 +71,40 @@ class Column(object):
     def headers(self):
         return [self.name] 
 
-    def append(self, row):
-        val = row[self.colindex]
-        if self.missing is not None and val==self.missing:
-            val = None
-        self._raw_values.append(val)
-        return val
+    def load(self, values):
+        self._values = np.asarray(values, dtype=object)
+        if self.missing is not None:
+            self._missing = self._values == self.missing
+        else:
+            self._missing = np.zeros(len(self._values), dtype=bool)
 
     def value(self, index):
-        val = self._raw_values[index] 
-        return val
-
-    def values(self, index):
-        val = self.value(index)
-        if val is None:
+        if self._missing[index]:
             return None
-        return [val]
+        return self._values[index]
+
+    def tolist(self):
+        vals = self._values.copy()
+        vals[self._missing] = None
+        return vals.tolist()
+
+    def expand(self, n):
+        # string arrays, one per header, and the missing mask
+        return [self._values], self._missing
 
     def reorder(self, indexlist):
-        new_raw_values = []
-        for idx in indexlist:
-            if idx is not None:
-                new_raw_values.append(self._raw_values[idx])
-            else:
-                new_raw_values.append(None)
-        self._raw_values = new_raw_values
+        idx = np.array([-1 if x is None else x for x in indexlist], dtype=np.int64)
+        found = idx >= 0
+        if len(self._values):
+            idx = np.where(found, idx, 0)
+            self._values = self._values[idx]
+            self._missing = self._missing[idx] | ~found
+        else:
+            self._values = np.full(len(idx), "", dtype=object)
+            self._missing = np.ones(len(idx), dtype=bool)
 
     def __len__(self):
-        return len(self._raw_values)
+        return len(self._values)
 
 class CategoricalColumn(Column):
     def __init__(self, coldef, pr, options=None):
@@ -94,18 +116,15 @@ class CategoricalColumn(Column):
     def headers(self):
         return [self.name + "_" + x for x in self.contr_levels]
 
-    def values(self, index):
-        val = self.value(index) 
-        if val is None:
-            return None
-        ret = ["0"] * len(self.contr_levels)
-        if val == self.ref_level:
-            return ret
-        for index, level in enumerate(self.contr_levels):
-            if val == level:
-                ret[index] = "1"
-                return ret
-        raise Exception("Found unexpected value ({}) in categorical column ()".format(val, self.name))
+    def expand(self, n):
+        codes = level_codes(self._values, self.levels)
+        unexpected = (codes < 0) & ~self._missing
+        if unexpected.any():
+            val = self._values[np.argmax(unexpected)]
+            raise Exception("Found unexpected value ({}) in categorical column ()".format(val, self.name))
+        # indicator matrix against the non-reference levels
+        indicators = codes[:, None] == np.arange(1, len(self.levels))
+        return list(np.where(indicators, "1", "0").T), self._missing
 
 class BinaryColumn(Column):
     
@@ -120,16 +139,10 @@ class BinaryColumn(Column):
     def headers(self):
         return [self.name + "_" + self.event_level]
 
-    def values(self, index):
-        val = self.value(index) 
-        if val is None:
-            return None
-        if not val in self.levels:
+    def expand(self, n):
+        if ((level_codes(self._values, self.levels) < 0) & ~self._missing).any():
             raise Exception("Found unexpected value in binary column")
-        if val == self.event_level:
-            return ["1"]
-        else:
-            return ["0"]
+        return [np.where(self._values == self.event_level, "1", "0")], self._missing
 
     def set_event_level(self, level):
         if not level in self.levels:
@@ -157,18 +170,10 @@ class PedRequiredColumn(Column):
             header = self.field
         return [header]
 
-    def append(self, row):
-        if self.coldef is None or self.colindex is None:
-            return None
-        return super(PedRequiredColumn, self).append(row)
-
-    def values(self, index):
+    def expand(self, n):
         if self.coldef is None:
-            return ["0"]
-        return super(PedRequiredColumn, self).values(index)
-
-def flatten(x):
-    return list(chain.from_iterable((v if v is not None else [None] for v in x )))
+            return [np.full(n, "0")], np.zeros(n, dtype=bool)
+        return super(PedRequiredColumn, self).expand(n)
 
 class PedWriter:
     def __init__(self, phenoreader=None, resp=None, covar=None):
@@ -177,33 +182,36 @@ class PedWriter:
         self.respcols = [ColumnFactory.get_by_name(resp, phenoreader)]
         self.covarcols = [ColumnFactory.get_by_name(x, phenoreader) for x in covar]
         self.allcols = self.pedcols + self.respcols + self.covarcols
-        for row in phenoreader.row_extractor():
-            for col in self.allcols:
-                col.append(row)
+        PedWriter.load_columns(phenoreader, self.allcols)
         self.expand_columns()
 
+    @staticmethod
+    def load_columns(phenoreader, cols):
+        cols = [x for x in cols if x.coldef]
+        if not cols:
+            return
+        getter = itemgetter(*[x.colindex for x in cols])
+        rows = [getter(row) for row in phenoreader.row_extractor()]
+        table = np.empty((len(rows), len(cols)), dtype=object)
+        if len(cols) == 1:
+            table[:, 0] = rows
+        elif rows:
+            table[:] = rows
+        for idx, col in enumerate(cols):
+            col.load(table[:, idx])
+
     def merge_covar(self, phenoreader=None, covar=None):
         datacols =  [ColumnFactory.get_by_name(x, phenoreader) for x in covar]
         matchcol = ColumnFactory.get_by_special_class("sample_id", phenoreader)
-        if matchcol is None:
+        if matchcol is None or matchcol.coldef is None:
             raise Exception("Unable to find Sample ID column")
-        lookup = dict()
-        for idx, row in enumerate(phenoreader.row_extractor()):
-            id = matchcol.append(row)
-            lookup[id] = idx
-            for col in datacols:
-                col.append(row)
-
-        reindex = []
+        PedWriter.load_columns(phenoreader, [matchcol] + datacols)
+        lookup = {id: idx for idx, id in enumerate(matchcol.tolist())}
+
         matchcol = ColumnFactory.find_id_column(self.allcols)
         if matchcol is None:
             raise Exception("Unable to find Sample ID column")
-        for idx in range(len(matchcol)):
-            sample = matchcol.value(idx)
-            if sample in lookup:
-                reindex.append(lookup[sample])
-            else:
-                reindex.append(None)
+        reindex = [lookup.get(sample) for sample in matchcol.tolist()]
 
         for col in datacols:
             col.reorder(reindex)
@@ -226,11 +234,11 @@ class PedWriter:
             assert len(vals) == len(uniqued)
             return uniqued
 
-        self.pedheaders = uniqueify(flatten([x.headers() for x in self.pedcols]), [])
+        self.pedheaders = uniqueify(list(chain.from_iterable(x.headers() for x in self.pedcols)), [])
         self.headers = self.pedheaders
-        self.respheaders = uniqueify(flatten([x.headers() for x in self.respcols]), self.headers)
+        self.respheaders = uniqueify(list(chain.from_iterable(x.headers() for x in self.respcols)), self.headers)
         self.headers = self.headers + self.respheaders
-        self.covarheaders = uniqueify(flatten([x.headers() for x in self.covarcols]), self.headers)
+        self.covarheaders = uniqueify(list(chain.from_iterable(x.headers() for x in self.covarcols)), self.headers)
         self.headers = self.headers + self.covarheaders
 
     def get_response_headers(self):
@@ -240,19 +248,25 @@ class PedWriter:
         return self.covarheaders
 
     def write_to_file(self, fconn, comment_header=True):
-        row_count = 0
         self.expand_columns()
         header = "\t".join(self.headers) + "\n"
         if comment_header:
             header = "#" + header
         fconn.write(header)
-        for idx in range(max((len(x) for x in self.allcols))):
-            vals = flatten([x.values(idx) for x in self.allcols])
-            has_missing = any((x is None for x in vals))
-            if not has_missing:
-                fconn.write("\t".join(vals) + "\n")
-                row_count += 1
-        return row_count
+        n = max((len(x) for x in self.allcols))
+        fields = []
+        missing = []
+        for col in self.allcols:
+            vals, miss = col.expand(n)
+            fields += vals
+            missing.append(miss)
+        # only complete cases are written
+        rows = np.flatnonzero(~np.any(missing, axis=0))
+        for start in range(0, len(rows), WRITE_BLOCK_ROWS):
+            block = rows[start:start + WRITE_BLOCK_ROWS]
+            lines = zip(*[x[block].tolist() for x in fields])
+            fconn.write("\n".join(map("\t".join, lines)) + "\n")
+        return len(rows)
 
 if __name__ == "__main__":
     from .pheno_reader import PhenoReader
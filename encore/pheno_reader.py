@@ -1,6 +1,15 @@
+import os
 import subprocess
 import re
+import io
 import csv
+import codecs
+import json
+import fcntl
+import random
+import tempfile
+import hashlib
+import itertools
 from collections import defaultdict, Counter
 
 # These three functions
@@ -15,6 +24,17 @@ def atof(text):
         retval = text
     return retval
 
+# raw types of plain decimal numbers, without the float() round trip
+INT_PATTERN = r'[-+]?[0-9]+(?:[eE][-+]?[0-9]+)?'
+FLOAT_PATTERN = r'[-+]?(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+NUMBER_PATTERN = r'[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+INT_RE = re.compile(INT_PATTERN)
+NUMBER_RE = re.compile(NUMBER_PATTERN)
+# the same checks over a whole column chunk joined by newlines
+INT_VALUES_RE = re.compile(r'(?:{0}\n)*{0}'.format(INT_PATTERN))
+FLOAT_VALUES_RE = re.compile(r'(?:{0}\n)*{0}'.format(FLOAT_PATTERN))
+NUMBER_VALUES_RE = re.compile(r'(?:{0}\n)*{0}'.format(NUMBER_PATTERN))
+
 def guess_raw_type(s):
     # return one of "int","float","str","bool","_empty_"
     if re.match(r'^\s*$', s):
@@ -30,6 +50,21 @@ def guess_raw_type(s):
             return "bool"
         return type(s).__name__
 
+def fast_raw_type(s):
+    # same result as guess_raw_type
+    if INT_RE.fullmatch(s):
+        return "int"
+    if NUMBER_RE.fullmatch(s):
+        return "float"
+    return guess_raw_type(s)
+
+def joined_values(values):
+    # values joined by newlines, or None if a value holds a newline
+    joined = "\n".join(values)
+    if joined.count("\n") != len(values)-1:
+        return None
+    return joined
+
 def guess_atomic_column_class(rawtype, obs):
     # rawtype is best guess raw data type
     # obs is a counter (data value, #times occuring) for values
@@ -126,8 +161,8 @@ def sniff_file(csvfile):
     except:
         return None
 
-def find_header(firstrow, lastcomment, cols):
-    colclasses = {k: guess_column_class(v) for k,v in cols.items()}
+def find_header(firstrow, lastcomment, colclasses):
+    # colclasses is dict (col index) of guess_column_class results
     col_types = [z["type"] for z in [colclasses[i] for i in range(len(firstrow))]]
     firstrow_types = [guess_raw_type(x) for x in firstrow]
 
@@ -194,73 +229,420 @@ def guess_sample_id_col(metas, cols, sample_ids):
                 id_col_idx = i
     return id_col_idx
 
-def infer_meta(csvfile, dialect=None, sample_ids=None):
-    meta = {"layout": {}, "columns": []}
+BYTE_ORDER_MARKS = ["\ufeff", "\xfe\xff", "\xff\xfe", "\xef\xbb\xbf"]
+CHUNK_CELLS = 1 << 18
 
-    start_pos = 0
-    csvfile.seek(0)
-    first = csvfile.read(4)
-    if first.startswith("\xfe\xff") or first.startswith("\xff\xfe"):
-        start_pos = 2
-    elif first.startswith("\xef\xbb\xbf"):
-        start_pos = 3
-
-    # store csv dialect
-    if not dialect:
-        csvfile.seek(start_pos)
-        dialect = sniff_file(csvfile)
-    for k in [k for k in dir(dialect) if not k.startswith("_")]:
-        meta["layout"]["csv_" + k] = getattr(dialect, k)
-
-    # read comments 
-    csvfile.seek(start_pos)
-    comments = list(get_comments(csvfile))
-
-    # read and process csv rows 
-    csvfile.seek(start_pos)
-    cvr = csv.reader(strip_comments(csvfile), dialect)
-    firstrow = next(cvr)
-    cols = defaultdict(lambda : defaultdict(Counter))
-    for row in cvr:
-        for idx, val in enumerate(row):
-            cols[idx][guess_raw_type(val)][val] += 1
-    # find column headers
-    if comments:
-        lastcomment = next(csv.reader([comments[-1][1:]], dialect))
-    else:
-        lastcomment = None
-    headers, headersource = find_header(firstrow, lastcomment, cols)
-    if headersource == "firstrow":
-        skip = len(comments)+1
-    else:
-        skip = len(comments)
-    meta["layout"]["skip"] = skip
-    # define columns
-    meta["columns"] = [None] * len(cols)
-    for col, colval in cols.items():
-        coldef = guess_column_class(colval)
-        if col < len(headers):
-            coldef["name"] = headers[col]
+class MetaCollector:
+    '''
+    Collects the dialect, leading comments, per-column value counts and
+    record count of a phenotype file from a single pass over its lines.
+
+    Rows are classified a column chunk at a time. When the lines can be
+    read again (reread returns a fresh iterator over them), columns that
+    are clearly numeric stop tracking their distinct numbers; the rare
+    column that later needs them is counted again in a second pass.
+
+    With sample_rows, columns are classified from a reservoir sample of
+    that many data lines, and sampled is set if the file had more. The
+    sample is the same for the same lines.
+    '''
+    def __init__(self, dialect=None, reread=None, columns=None, sample_rows=None):
+        self.dialect = dialect
+        self.reread = reread
+        self.columns = columns
+        self.sample_rows = sample_rows
+        self.sampled = False
+        self.comments = []
+        self.firstrow = None
+        self.rows = 0
+        self.indented_comments = 0
+        self.cols = defaultdict(lambda : defaultdict(Counter))
+        self.int_values = Counter()
+        # col index -> numeric raw types seen, for capped columns
+        self.numeric = dict()
+        self.recount = set()
+        self.records = None
+
+    def consume(self, lines):
+        lines = iter(lines)
+        first = next(lines, None)
+        if first is None:
+            raise Exception("No data found in phenotype file")
+        for bom in BYTE_ORDER_MARKS:
+            if first.startswith(bom):
+                first = first[len(bom):]
+                break
+        lines = itertools.chain([first], lines)
+        # buffer just enough lines to sniff the dialect
+        if not self.dialect:
+            head = []
+            n_data = 0
+            for line in lines:
+                head.append(line)
+                if not line.strip().startswith("#"):
+                    n_data += 1
+                    if n_data == 50:
+                        break
+            self.dialect = sniff_file(head)
+            lines = itertools.chain(head, lines)
+        lines = self.__scan(lines)
+        cvr = csv.reader(lines, self.dialect)
+        self.firstrow = next(cvr, None)
+        if self.firstrow is None:
+            raise Exception("No data found in phenotype file")
+        if self.sample_rows:
+            self.__add_sample(lines)
+        else:
+            self.__add_chunks(cvr)
+
+    def __add_sample(self, lines):
+        # reservoir sample of the remaining lines, kept in file order
+        rand = random.Random(self.sample_rows)
+        size = self.sample_rows
+        sample = []
+        n = 0
+        for n, line in enumerate(lines, 1):
+            if n <= size:
+                sample.append((n, line))
+            else:
+                i = rand.randrange(n)
+                if i < size:
+                    sample[i] = (n, line)
+        sample.sort()
+        self.__add_chunks(csv.reader((line for _, line in sample), self.dialect))
+        if n > size:
+            # rows spanning lines are rare enough to count lines
+            self.sampled = True
+            self.rows = n
+
+    def __add_chunks(self, rows):
+        chunk = []
+        cells = 0
+        for row in rows:
+            chunk.append(row)
+            cells += len(row)
+            if cells >= CHUNK_CELLS:
+                self.__add_rows(chunk)
+                chunk = []
+                cells = 0
+        self.__add_rows(chunk)
+
+    def __add_rows(self, rows):
+        self.rows += len(rows)
+        if len(set(map(len, rows))) <= 1:
+            columns = zip(*rows)
+        else:
+            width = max(map(len, rows))
+            columns = ([row[i] for row in rows if len(row) > i] for i in range(width))
+        for idx, values in enumerate(columns):
+            if self.columns is not None and idx not in self.columns:
+                continue
+            if idx in self.recount:
+                continue
+            if idx in self.numeric:
+                self.__add_numeric(idx, values)
+            else:
+                self.__add_values(idx, values)
+
+    def __add_values(self, idx, values):
+        colinfo = self.cols[idx]
+        counts = Counter(values)
+        joined = joined_values(counts)
+        if joined is not None and INT_VALUES_RE.fullmatch(joined):
+            colinfo["int"].update(counts)
+            self.int_values[idx] += len(values)
+        else:
+            for val, n in counts.items():
+                rawtype = fast_raw_type(val)
+                colinfo[rawtype][val] += n
+                if rawtype == "int":
+                    self.int_values[idx] += n
+        if self.reread and self.columns is None and not self.sample_rows and \
+                self.__clearly_numeric(idx, colinfo):
+            # stop tracking the distinct numbers
+            self.numeric[idx] = {x for x in ("int", "float") if x in colinfo}
+            colinfo.pop("int", None)
+            colinfo.pop("float", None)
+
+    def __clearly_numeric(self, idx, colinfo):
+        # numeric whatever numbers follow, unless a bool or a second
+        # distinct string turns up
+        if "bool" in colinfo or len(colinfo.get("str", ())) > 1:
+            return False
+        n_ints = len(colinfo.get("int", ()))
+        n_floats = len(colinfo.get("float", ()))
+        if n_ints + n_floats < 3:
+            return False
+        return n_floats > 0 or self.int_values[idx] > n_ints
+
+    def __add_numeric(self, idx, values):
+        types = self.numeric[idx]
+        joined = joined_values(values)
+        if joined is not None and INT_VALUES_RE.fullmatch(joined):
+            types.add("int")
+            return
+        if joined is not None and FLOAT_VALUES_RE.fullmatch(joined):
+            types.add("float")
+            return
+        if joined is not None and NUMBER_VALUES_RE.fullmatch(joined):
+            # neither all ints nor all floats, so both
+            types.update(("int", "float"))
+            return
+        colinfo = self.cols[idx]
+        for val, n in Counter(values).items():
+            rawtype = fast_raw_type(val)
+            if rawtype == "int" or rawtype == "float":
+                types.add(rawtype)
+            else:
+                colinfo[rawtype][val] += n
+        if "bool" in colinfo or len(colinfo.get("str", ())) > 1:
+            # needs every value after all
+            del self.numeric[idx]
+            colinfo.clear()
+            self.recount.add(idx)
+
+    def __numeric_class(self, idx):
+        # what guess_column_class returns for a capped column
+        colinfo = self.cols[idx]
+        types = self.numeric[idx]
+        ci = {"class": "numeric", "type": "float" if "float" in types else "int"}
+        if "str" in colinfo:
+            ci["missing"] = next(iter(colinfo["str"].keys()))
+        elif "_empty_" in colinfo and len(colinfo["_empty_"])==1:
+            ci["missing"] = next(iter(colinfo["_empty_"].keys()))
+        return ci
+
+    def __recount(self):
+        full = MetaCollector(self.dialect, columns=self.recount)
+        full.consume(self.reread())
+        for idx in self.recount:
+            self.cols[idx] = full.cols[idx]
+        self.recount = set()
+
+    def __scan(self, lines):
+        # record the leading comment block and drop comment lines
+        leading = True
+        for line in lines:
+            s = line.strip()
+            is_comment = s.startswith("#")
+            if leading:
+                if is_comment or len(s)==0:
+                    self.comments.append(s)
+                else:
+                    leading = False
+            elif is_comment and not line.startswith("#"):
+                # row_extractor only drops lines starting with the token
+                self.indented_comments += 1
+            if not is_comment:
+                yield line
+
+    def finish(self, sample_ids=None):
+        meta = {"layout": {}, "columns": []}
+        if self.recount:
+            self.__recount()
+        dialect = self.dialect
+        cols = self.cols
+        comments = self.comments
+        colclasses = dict()
+        for col, colval in cols.items():
+            if col in self.numeric:
+                colclasses[col] = self.__numeric_class(col)
+            else:
+                colclasses[col] = guess_column_class(colval)
+        # store csv dialect
+        for k in [k for k in dir(dialect) if not k.startswith("_")]:
+            meta["layout"]["csv_" + k] = getattr(dialect, k)
+        # find column headers
+        if comments:
+            lastcomment = next(csv.reader([comments[-1][1:]], dialect))
         else:
-            coldef["name"] = "COL{}".format(col+1)
-        meta["columns"][col] = coldef
-    #check if ped
-    pedlike, ped_columns = check_if_ped(meta["columns"], cols)
-    if pedlike:
-        #assign standard ped column types
-        meta["pedlike"] = 1
-        colclasses = ["family_id","sample_id","father_id","mother_id","sex"]
-        for actas, col in zip(colclasses, meta["columns"][0:3]):
-            if col["class"] != "fixed":
-                col["class"] =  actas
-    elif sample_ids:
-        #if not ped, try to find ID column
-        id_col =  None
-        sample_id_set = set(sample_ids)
-        id_col = guess_sample_id_col(meta["columns"], cols, sample_id_set)
-        if id_col is not None:
-            meta["columns"][id_col]["class"] = "sample_id"
-    return meta
+            lastcomment = None
+        headers, headersource = find_header(self.firstrow, lastcomment, colclasses)
+        if headersource == "firstrow":
+            skip = len(comments)+1
+        else:
+            skip = len(comments)
+        meta["layout"]["skip"] = skip
+        # rows row_extractor will return: blank lines in the comment
+        # block are skipped there but parsed as rows above
+        blank_comments = sum(1 for x in comments if not x)
+        self.records = 1 + self.rows - blank_comments + self.indented_comments - \
+            (1 if headersource == "firstrow" else 0)
+        # define columns
+        meta["columns"] = [None] * len(cols)
+        for col, coldef in colclasses.items():
+            if col < len(headers):
+                coldef["name"] = headers[col]
+            else:
+                coldef["name"] = "COL{}".format(col+1)
+            meta["columns"][col] = coldef
+        #check if ped
+        pedlike, ped_columns = check_if_ped(meta["columns"], cols)
+        if pedlike:
+            #assign standard ped column types
+            meta["pedlike"] = 1
+            colclasses = ["family_id","sample_id","father_id","mother_id","sex"]
+            for actas, col in zip(colclasses, meta["columns"][0:3]):
+                if col["class"] != "fixed":
+                    col["class"] =  actas
+        elif sample_ids:
+            #if not ped, try to find ID column
+            id_col =  None
+            sample_id_set = set(sample_ids)
+            id_col = guess_sample_id_col(meta["columns"], cols, sample_id_set)
+            if id_col is not None:
+                meta["columns"][id_col]["class"] = "sample_id"
+        return meta
+
+def collect_meta(csvfile, dialect=None, sample_rows=None):
+    def reread():
+        csvfile.seek(0)
+        return csvfile
+    csvfile.seek(0)
+    collector = MetaCollector(dialect, reread, sample_rows=sample_rows)
+    collector.consume(csvfile)
+    return collector
+
+def infer_meta(csvfile, dialect=None, sample_ids=None, sample_rows=None):
+    return collect_meta(csvfile, dialect, sample_rows).finish(sample_ids)
+
+def verify_meta(path, meta_path, sample_ids=None):
+    # re-infer the meta of a sampled upload from every row and rewrite
+    # meta_path without the "sampled" flag; returns True if the layout,
+    # columns or record count changed. Without sample_ids the sample id
+    # column found at upload is kept. Callers wait for a verification
+    # already running for the same meta rather than repeating it
+    with open(meta_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(meta_path) as f:
+                sampled_meta = json.load(f)
+            if not sampled_meta.get("sampled"):
+                return False
+            with open(path, encoding="utf-8") as csvfile:
+                collector = collect_meta(csvfile)
+                meta = collector.finish(sample_ids)
+            meta["records"] = collector.records
+            if sample_ids is None and "pedlike" not in meta:
+                for col, sampled_col in zip(meta["columns"], sampled_meta.get("columns", [])):
+                    if sampled_col.get("class") == "sample_id" and col["name"] == sampled_col["name"]:
+                        col["class"] = "sample_id"
+            changed = any(meta[k] != sampled_meta.get(k) for k in ("layout", "columns", "records"))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(meta_path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(meta, f, indent=2)
+                os.chmod(tmp_path, os.stat(meta_path).st_mode & 0o777)
+                os.replace(tmp_path, meta_path)
+            except:
+                os.unlink(tmp_path)
+                raise
+            return changed
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+class PhenoIngest:
+    '''
+    Writes an uploaded phenotype file to disk while hashing it, checking
+    that it is UTF-8 text and collecting its meta data, reading the
+    upload only once
+    '''
+    def __init__(self, stream, path, blocksize=65536, sample_rows=None):
+        self.stream = stream
+        self.path = path
+        self.blocksize = blocksize
+        self.md5 = None
+        self.size = 0
+        self.istext = True
+        self.isascii = True
+        self.filetype = None
+        self.mimetype = None
+        self.error = None
+        self.collector = MetaCollector(reread=self.__reread, sample_rows=sample_rows)
+
+    def run(self):
+        hasher = hashlib.md5()
+        with open(self.path, "wb") as out:
+            blocks = self.__blocks(hasher, out)
+            try:
+                self.collector.consume(self.__lines(blocks))
+            except Exception as e:
+                self.error = e
+            # save and hash whatever was not parsed
+            for _ in blocks:
+                pass
+        self.md5 = hasher.hexdigest()
+        if self.size == 0:
+            self.__not_text("empty", "inode/x-empty; charset=binary")
+        elif self.istext:
+            if self.isascii:
+                self.filetype = "ASCII text"
+                self.mimetype = "text/plain; charset=us-ascii"
+            else:
+                self.filetype = "UTF-8 Unicode text"
+                self.mimetype = "text/plain; charset=utf-8"
+        return self
+
+    @property
+    def sampled(self):
+        return self.collector.sampled
+
+    def infer_meta(self, sample_ids=None):
+        if self.error:
+            raise self.error
+        meta = self.collector.finish(sample_ids)
+        meta["records"] = self.collector.records
+        if self.sampled:
+            # until verify_meta has checked every row
+            meta["sampled"] = True
+        return meta
+
+    def __reread(self):
+        with open(self.path, encoding="utf-8") as f:
+            yield from f
+
+    def __not_text(self, filetype, mimetype):
+        self.istext = False
+        self.filetype = filetype
+        self.mimetype = mimetype
+
+    def __blocks(self, hasher, out):
+        while True:
+            block = self.stream.read(self.blocksize)
+            if not block:
+                break
+            hasher.update(block)
+            out.write(block)
+            self.size += len(block)
+            yield block
+
+    def __lines(self, blocks):
+        # universal newlines, as when the file is opened in text mode
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder("utf-8")(), translate=True)
+        partial = ""
+        for block in blocks:
+            if b"\x00" in block:
+                self.__not_text("data", "application/octet-stream; charset=binary")
+                return
+            try:
+                text = decoder.decode(block)
+            except UnicodeDecodeError:
+                self.__not_text("non UTF-8 data", "application/octet-stream; charset=unknown-8bit")
+                return
+            if self.isascii and not block.isascii():
+                self.isascii = False
+            lines = (partial + text).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        try:
+            partial += decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            self.__not_text("non UTF-8 data", "application/octet-stream; charset=unknown-8bit")
+            return
+        if partial:
+            yield partial
 
 class PhenoReader:
     def __init__(self, path, meta=None):
@@ -270,9 +652,9 @@ class PhenoReader:
         else:
             self.meta = self.infer_meta()
 
-    def infer_meta(self, sample_ids=None):
+    def infer_meta(self, sample_ids=None, sample_rows=None):
         with open(self.path, 'rU') as csvfile:
-            return infer_meta(csvfile, sample_ids=sample_ids)
+            return infer_meta(csvfile, sample_ids=sample_ids, sample_rows=sample_rows)
 
     def get_dialect(self, opts=None):
         class dialect(csv.Dialect):
@@ -338,7 +720,6 @@ class PhenoReader:
         return istext, human, mime  
 
 if __name__ == "__main__":
-    import json
     import sys
     if len(sys.argv)>=2:
         meta = None
@@ -4,7 +4,7 @@ import json
 from . import sql_pool
 import MySQLdb
 from collections import OrderedDict
-from .pheno_reader import PhenoReader
+from .pheno_reader import PhenoReader, verify_meta
 from .db_helpers import SelectQuery, TableJoin, PagedResult, OrderClause, OrderExpression, WhereExpression, WhereAll
 
 class Phenotype:
@@ -29,6 +29,17 @@ class Phenotype:
     def relative_path(self, *args):
         return os.path.expanduser(os.path.join(self.root_path, *args))
 
+    def verify_sampled_meta(self):
+        # meta guessed from a sample of the rows is checked against every
+        # row before it is relied on, waiting for the check started at
+        # upload if it is still running
+        if not self.meta.get("sampled"):
+            return
+        meta_path = self.relative_path("meta.json")
+        verify_meta(self.get_raw_path(), meta_path)
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+
     def get_column_levels(self, covar_name):
         covar = [x for x in self.meta.get("columns", []) if x.get("name", "")==covar_name]
         if len(covar) != 1:
@@ -0,0 +1,287 @@
+import re
+import gzip
+import numpy as np
+from .tabix_reader import get_tabix_reader
+
+# Filters for association results. Row selection is pushed down to the
+# columnar results store when a job has one (sorted p-value index, position
+# binary search) and to tabix seeks on the text output otherwise.
+
+MAX_POSITION = 2**31 - 1
+
+COLUMN_ALIASES = {"BEG": "BEGIN",
+    "CHR": "CHROM",
+    "POS": "BEGIN",
+    "SNPID": "MARKER_ID",
+    "N": "NS",
+    "p.value": "PVALUE",
+    "AF_Allele2": "MAF",
+    "AC_Allele2": "AC"}
+
+def read_results_header(path):
+    # column names as listed in the results endpoint output
+    with gzip.open(path, "rt") as f:
+        header = f.readline().rstrip('\n').split('\t')
+    if header[0].startswith("#"):
+        header[0] = header[0][1:]
+    if len(header) > 1 and header[1] == "BEG":
+        header[1] = "BEGIN"
+    return header
+
+def canonical_columns(header):
+    names = []
+    for col in header:
+        name = COLUMN_ALIASES.get(col, col)
+        if name in names:
+            name = col
+        names.append(name)
+    return names
+
+def parse_float(val, name):
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid value for {} ({})".format(name, val))
+
+def parse_regions(value):
+    # "chrom", "chrom:pos" or "chrom:start-stop", separated by spaces or ";"
+    regions = []
+    for part in re.split(r'[\s;]+', value):
+        if not part:
+            continue
+        m = re.match(r'^([^:]+)(?::([\d,]+)(?:-([\d,]+))?)?$', part)
+        if not m:
+            raise ValueError("Invalid region ({})".format(part))
+        chrom = m.group(1)
+        if m.group(2) is None:
+            start, stop = 1, MAX_POSITION
+        else:
+            start = int(m.group(2).replace(",", ""))
+            stop = int(m.group(3).replace(",", "")) if m.group(3) else start
+        if stop < start:
+            raise ValueError("Invalid region ({})".format(part))
+        regions.append((chrom, start, stop))
+    return regions
+
+def merge_regions(regions):
+    # overlapping regions on the same chromosome are queried once
+    merged = []
+    for chrom, start, stop in regions:
+        for i, (mchrom, mstart, mstop) in enumerate(merged):
+            if mchrom == chrom and start <= mstop + 1 and stop >= mstart - 1:
+                merged[i] = (chrom, min(start, mstart), max(stop, mstop))
+                break
+        else:
+            merged.append((chrom, start, stop))
+    if len(merged) != len(regions):
+        return merge_regions(merged)
+    return merged
+
+def parse_cursor(value):
+    # "chrom:pos:skip", resume after the first skip records starting at chrom:pos
+    if not value:
+        return None
+    m = re.match(r'^(.+):(\d+):(\d+)$', value)
+    if not m:
+        raise ValueError("Invalid cursor ({})".format(value))
+    return (m.group(1), int(m.group(2)), int(m.group(3)))
+
+def format_cursor(cursor):
+    return "{}:{}:{}".format(*cursor)
+
+class ResultFilter:
+    def __init__(self, max_pvalue=None, min_maf=None, max_maf=None, min_mac=None,
+            non_monomorphic=False, regions=None, after=None):
+        self.max_pvalue = max_pvalue
+        self.min_maf = min_maf
+        self.max_maf = max_maf
+        self.min_mac = min_mac
+        self.non_monomorphic = non_monomorphic
+        self.regions = merge_regions(regions) if regions else None
+        self.after = after
+
+    @staticmethod
+    def from_args(args):
+        regions = []
+        if args.get("region", ""):
+            regions += parse_regions(args.get("region"))
+        if args.get("chrom", ""):
+            regions += parse_regions(args.get("chrom").replace(",", " "))
+        def get_float(name):
+            if args.get(name, "") == "":
+                return None
+            return parse_float(args.get(name), name)
+        return ResultFilter(max_pvalue=get_float("max-pvalue"),
+            min_maf=get_float("min-maf"),
+            max_maf=get_float("max-maf"),
+            min_mac=get_float("min-mac"),
+            non_monomorphic=bool(args.get("non-monomorphic", False)),
+            regions=regions,
+            after=parse_cursor(args.get("cursor", "")))
+
+    def is_empty(self):
+        return self.max_pvalue is None and self.min_maf is None and \
+            self.max_maf is None and self.min_mac is None and \
+            not self.non_monomorphic and self.regions is None and self.after is None
+
+    def required_columns(self):
+        cols = []
+        if self.max_pvalue is not None:
+            cols.append("PVALUE")
+        if self.min_maf is not None or self.max_maf is not None:
+            cols.append("MAF")
+        if self.non_monomorphic or self.min_mac is not None:
+            cols.append("AC")
+        if self.min_mac is not None:
+            cols.append("NS")
+        return cols
+
+    def check_columns(self, names):
+        for col in self.required_columns():
+            if col not in names:
+                raise ValueError("Column {} not found".format(col))
+
+    def __value_mask(self, get_column):
+        # get_column(name) returns float values for the candidate rows
+        mask = None
+        def update(cond):
+            return cond if mask is None else mask & cond
+        if self.max_pvalue is not None:
+            mask = update(get_column("PVALUE") < self.max_pvalue)
+        if self.min_maf is not None or self.max_maf is not None:
+            maf = get_column("MAF")
+            maf = np.where(maf > .5, 1-maf, maf)
+            if self.min_maf is not None:
+                mask = update(maf >= self.min_maf)
+            if self.max_maf is not None:
+                mask = update(maf <= self.max_maf)
+        if self.non_monomorphic:
+            mask = update(get_column("AC") > 0)
+        if self.min_mac is not None:
+            ac = get_column("AC")
+            mac = np.minimum(ac, 2 * get_column("NS") - ac)
+            mask = update(mac >= self.min_mac)
+        return mask
+
+    def store_rows(self, store, block_size=1<<20):
+        # arrays of matching rows, in file order, a block at a time
+        self.check_columns(store.columns)
+        first_row = 0
+        if self.after is not None:
+            chrom, pos, skip = self.after
+            first_row = store.position_row(chrom, pos)
+            if first_row is None:
+                raise ValueError("Invalid cursor (unknown chromosome {})".format(chrom))
+            first_row += skip
+        return self.__store_rows(store, block_size, first_row)
+
+    def __store_rows(self, store, block_size, first_row):
+        candidates = None
+        if self.regions is not None:
+            parts = [store.region_rows(*region) for region in self.regions]
+            candidates = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+        if self.max_pvalue is not None:
+            below = store.rows_below("PVALUE", self.max_pvalue)
+            if candidates is None:
+                candidates = below
+            else:
+                candidates = np.intersect1d(candidates, below, assume_unique=True)
+        if candidates is not None and first_row:
+            candidates = candidates[candidates >= first_row]
+        if candidates is None:
+            total = store.rows - first_row
+        else:
+            total = len(candidates)
+        for start in range(0, total, block_size):
+            stop = min(start + block_size, total)
+            if candidates is None:
+                rows = np.arange(first_row + start, first_row + stop)
+            else:
+                rows = candidates[start:stop]
+            mask = self.__value_mask(lambda name: np.asarray(store.column(name)[rows], dtype=np.float64))
+            yield rows if mask is None else rows[mask]
+
+    @staticmethod
+    def store_cursor(store, row):
+        # cursor that resumes just after row
+        chrom = store.chroms[int(store.column("CHROM")[row])]["name"]
+        pos = int(store.column("BEGIN")[row])
+        return (chrom, pos, row - store.position_row(chrom, pos) + 1)
+
+    def text_rows(self, path, header):
+        # (fields, cursor) for matching lines of the text results; cursor
+        # resumes just after that line
+        names = canonical_columns(header)
+        self.check_columns(names)
+        reader = None
+        if self.regions is not None or self.after is not None:
+            reader = get_tabix_reader(path)
+            if reader is None:
+                raise ValueError("Results are not indexed")
+        regions = None
+        if reader is not None:
+            regions = self.__text_regions(reader)
+        return self.__text_rows(path, reader, regions, {x: i for i, x in enumerate(names)})
+
+    def __text_regions(self, reader):
+        # regions to query in file order, starting from the cursor
+        def file_order(chrom):
+            return reader.index.ref_ids.get(reader.resolve_chrom(chrom), -1)
+        if self.regions is not None:
+            regions = sorted(self.regions, key=lambda x: (file_order(x[0]), x[1]))
+        else:
+            regions = [(x, 1, MAX_POSITION) for x in reader.index.names]
+        if self.after is None:
+            return regions
+        chrom, pos, skip = self.after
+        after_order = file_order(chrom)
+        if after_order < 0:
+            raise ValueError("Invalid cursor (unknown chromosome {})".format(chrom))
+        clipped = []
+        for region in regions:
+            order = file_order(region[0])
+            if order > after_order:
+                clipped.append(region)
+            elif order == after_order and region[2] >= pos:
+                clipped.append((region[0], max(region[1], pos), region[2]))
+        return clipped
+
+    def __text_rows(self, path, reader, regions, colpos):
+        def to_float(val):
+            try:
+                return float(val)
+            except ValueError:
+                return np.nan
+        chrom_col = colpos["CHROM"]
+        pos_col = colpos["BEGIN"]
+        after = self.after
+        if after is not None and reader is not None:
+            after = (reader.resolve_chrom(after[0]), after[1], after[2])
+        last_key = None
+        count = 0
+        for row in self.__text_lines(path, reader, regions):
+            key = (row[chrom_col], int(row[pos_col]))
+            if key == last_key:
+                count += 1
+            else:
+                last_key = key
+                count = 1
+            if after is not None and key[0] == after[0]:
+                # skip records overlapping the cursor position from the left
+                # and the ones already returned at that position
+                if key[1] < after[1] or (key[1] == after[1] and count <= after[2]):
+                    continue
+            mask = self.__value_mask(lambda name: to_float(row[colpos[name]]))
+            if mask is None or mask:
+                yield row, (key[0], key[1], count)
+
+    def __text_lines(self, path, reader, regions):
+        if regions is not None:
+            for region in regions:
+                for line in reader.query(*region):
+                    yield line.split("\t")
+        else:
+            with gzip.open(path, "rt") as f:
+                next(f)
+                for line in f:
+                    yield line.rstrip("\n").split("\t")
@@ -0,0 +1,210 @@
+import os
+import json
+import threading
+import numpy as np
+
+# Reader for the columnar copy of association results written by
+# plot-epacts-output/make_results_store.py. Columns are memory-mapped on
+# first use and shared between requests (see get_results_store).
+
+def format_value(x):
+    if x != x:
+        return "NA"
+    if x.is_integer() and abs(x) < 1e15:
+        return str(int(x))
+    return repr(x)
+
+class ResultsStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.mtime = os.path.getmtime(os.path.join(path, "meta.json"))
+        self.rows = self.meta["rows"]
+        self.header = self.meta["header"]
+        self.columns = {x["name"]: x for x in self.meta["columns"]}
+        self.column_names = [x["name"] for x in self.meta["columns"]]
+        self.chroms = self.meta["chroms"]
+        self.chrom_ids = {x["name"]: i for i, x in enumerate(self.chroms)}
+        self.chrom_names = np.array([x["name"] for x in self.chroms], dtype=object)
+        self._arrays = dict()
+        self._lock = threading.Lock()
+
+    def has_column(self, name):
+        return name in self.columns
+
+    def is_numeric(self, name):
+        # columns with a value that is not a number are stored as text
+        return name in self.columns and self.columns[name]["type"] != "text"
+
+    def __map(self, filename, dtype):
+        key = (filename, dtype)
+        arr = self._arrays.get(key)
+        if arr is None:
+            path = os.path.join(self.path, filename)
+            with self._lock:
+                arr = self._arrays.get(key)
+                if arr is None:
+                    if os.path.getsize(path) == 0:
+                        arr = np.zeros(0, dtype=dtype)
+                    else:
+                        arr = np.memmap(path, dtype=dtype, mode="r")
+                    self._arrays[key] = arr
+        return arr
+
+    def column(self, name):
+        # numeric columns as arrays; chrom codes for CHROM
+        col = self.columns[name]
+        if col["type"] == "text":
+            raise Exception("Column {} is not numeric".format(name))
+        return self.__map(col["file"], col["dtype"])
+
+    def text(self, name, rows):
+        # list of strings for a slice or an array of row indexes
+        col = self.columns[name]
+        if col["type"] != "text":
+            raise Exception("Column {} is not text".format(name))
+        return self.__strings(col["file"], col["offsets"], rows)
+
+    def has_lines(self):
+        return "lines" in self.meta
+
+    def lines(self, rows):
+        # the input lines (without newline) of the rows
+        return self.__strings(self.meta["lines"]["file"], self.meta["lines"]["offsets"], rows)
+
+    def __strings(self, filename, offsets_filename, rows):
+        data = self.__map(filename, "|u1")
+        offsets = self.__map(offsets_filename, "<u8")
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(self.rows)
+            if stop <= start:
+                return []
+            bounds = offsets[start:stop+1].astype(np.int64)
+            block = bytes(data[bounds[0]:bounds[-1]])
+            bounds -= bounds[0]
+            return [block[bounds[i]:bounds[i+1]].decode() for i in range(stop - start)]
+        starts = offsets[rows].astype(np.int64)
+        stops = offsets[np.asarray(rows) + 1].astype(np.int64)
+        return [bytes(data[a:b]).decode() for a, b in zip(starts, stops)]
+
+    def values(self, name, rows):
+        # column values as strings, the way they would appear in the text file
+        col = self.columns[name]
+        if col["type"] == "text":
+            return self.text(name, rows)
+        arr = self.column(name)[rows]
+        if col["type"] == "chrom":
+            return self.chrom_names[arr].tolist()
+        if col["type"] == "pos":
+            return [str(x) for x in arr.tolist()]
+        return [format_value(x) for x in arr.tolist()]
+
+    def rows_below(self, name, threshold):
+        # rows (in file order) where name < threshold; uses the sorted index
+        # written for the column when there is one
+        index = self.meta.get("indexes", {}).get(name)
+        if index is None:
+            return np.flatnonzero(self.column(name) < threshold)
+        values = self.__map(index["values"], index["values_dtype"])
+        count = np.searchsorted(values, threshold, side="left")
+        order = self.__map(index["order"], index["order_dtype"])
+        return np.sort(order[:count].astype(np.int64))
+
+    def resolve_chrom(self, chrom):
+        chrom = str(chrom)
+        if chrom in self.chrom_ids:
+            return chrom
+        alt = chrom[3:] if chrom.startswith("chr") else "chr" + chrom
+        if alt in self.chrom_ids:
+            return alt
+        return None
+
+    def chrom_rows(self, chrom):
+        chrom = self.resolve_chrom(chrom)
+        if chrom is None:
+            return 0, 0
+        entry = self.chroms[self.chrom_ids[chrom]]
+        return entry["start"], entry["stop"]
+
+    def position_row(self, chrom, pos):
+        # first row of chrom starting at or after pos
+        chrom = self.resolve_chrom(chrom)
+        if chrom is None:
+            return None
+        entry = self.chroms[self.chrom_ids[chrom]]
+        begin = self.column("BEGIN")[entry["start"]:entry["stop"]]
+        if entry["sorted"]:
+            return entry["start"] + int(np.searchsorted(begin, pos, side="left"))
+        after = np.flatnonzero(begin >= pos)
+        return entry["start"] + (int(after[0]) if len(after) else len(begin))
+
+    def region_rows(self, chrom, start_pos, end_pos):
+        # sorted array of rows overlapping chrom:start_pos-end_pos (1-based, inclusive)
+        chrom = self.resolve_chrom(chrom)
+        if chrom is None:
+            return np.zeros(0, dtype=np.int64)
+        entry = self.chroms[self.chrom_ids[chrom]]
+        start, stop = entry["start"], entry["stop"]
+        begin = self.column("BEGIN")[start:stop]
+        if not entry["sorted"]:
+            rows = np.flatnonzero(begin <= end_pos)
+        else:
+            lo = np.searchsorted(begin, start_pos - entry.get("max_span", 0), side="left")
+            hi = np.searchsorted(begin, end_pos, side="right")
+            rows = np.arange(lo, hi)
+        if "END" in self.columns:
+            end = self.column("END")[start:stop][rows]
+            rows = rows[end >= start_pos]
+        else:
+            rows = rows[begin[rows] >= start_pos]
+        return rows + start
+
+    def has_tiles(self):
+        return bool(self.meta.get("tiles"))
+
+    def tile_level(self, start_pos, end_pos, max_bins):
+        # finest level covering the window with at most max_bins bins
+        levels = self.meta["tiles"]["levels"]
+        for i, level in enumerate(levels):
+            if (end_pos // level["width"]) - (start_pos // level["width"]) + 1 <= max_bins:
+                return i
+        return len(levels) - 1
+
+    def tile_bins(self, level, chrom, start_pos, end_pos):
+        # (bins, top rows) of a tile level overlapping the window; bins is a
+        # dict of arrays (bin start position, count, min_pvalue)
+        tiles = self.meta["tiles"]
+        desc = tiles["levels"][level]
+        files = desc["files"]
+        chrom = self.resolve_chrom(chrom)
+        lo = hi = 0
+        if chrom is not None:
+            lo, hi = desc["chrom_bins"][self.chrom_ids[chrom]]
+        def level_array(field):
+            return self.__map(files[field]["file"], files[field]["dtype"])
+        bins = level_array("bin")[lo:hi]
+        first = lo + int(np.searchsorted(bins, start_pos // desc["width"], side="left"))
+        last = lo + int(np.searchsorted(bins, end_pos // desc["width"], side="right"))
+        top = level_array("top").reshape(-1, tiles["top_n"])[first:last]
+        rows = np.sort(top[top >= 0])
+        begin = self.column("BEGIN")[rows]
+        rows = rows[(begin >= start_pos) & (begin <= end_pos)]
+        result = {"start": level_array("bin")[first:last].astype(np.int64) * desc["width"],
+            "count": level_array("count")[first:last],
+            "min_pvalue": level_array("min_pvalue")[first:last]}
+        return result, rows
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+def get_results_store(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    mtime = os.path.getmtime(meta_path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None or store.mtime != mtime:
+            store = _stores[path] = ResultsStore(path)
+        return store
@@ -8,6 +8,7 @@ class SaigeModel(BaseModel):
     filters = [("min-mac-20", "MAC > 20"),
         ("min-maf-001", "MAF > 0.1%"),
         ("min-maf-001-mac-20","MAF > 0.1% AND MAC > 20")]
+    ped_comment_header = False
 
     def __init__(self, working_directory="./", app_config=None):
         BaseModel.__init__(self, working_directory, app_config) 
@@ -67,11 +68,17 @@ class SaigeModel(BaseModel):
         return [cmd]
 
     def get_postprocessing_commands(self, geno, result_file="./results.txt.gz"):
+        if self.app_config.get("POSTPROCESS_BINARY"):
+            return [self.get_combined_postprocessing_command(geno, result_file, "NS",
+                jobs=self.cores_per_job)]
         cmds = []
         cmds.append("zcat -f {} | ".format(result_file) + \
             'awk -F"\\t" \'BEGIN {OFS="\\t"} NR==1 {for (i=1; i<=NF; ++i) {if($i=="p.value") pcol=i; if($i=="N") ncol=i}; if (pcol<1 || ncol<1) exit 1; print} ' + \
             '($ncol > 0 && $pcol < 0.001) {print}\' | ' + \
             "{} -c > output.filtered.001.gz".format(self.app_config.get("BGZIP_BINARY", "bgzip")))
+        if self.app_config.get("RESULTS_STORE_BINARY"):
+            cmd = "{} {} ./results.store".format(self.app_config.get("RESULTS_STORE_BINARY"), result_file)
+            cmds.append(cmd)
         if self.app_config.get("MANHATTAN_BINARY"):
             cmd  = "{} {} ./manhattan.json".format(self.app_config.get("MANHATTAN_BINARY", ""), result_file)
             cmds.append(cmd)
@@ -85,22 +92,6 @@ class SaigeModel(BaseModel):
             cmds.append(cmd)
         return cmds 
 
-    def write_ped_file(self, ped_file_path, model_spec, geno=None, pheno=None):
-        geno = self.get_geno(model_spec, geno)
-        pheno = self.get_pheno(model_spec, pheno)
-       
-        try:
-            ped_writer = self.get_ped_writer(model_spec, geno, pheno) 
-            with open(ped_file_path, "w") as pedfile:
-                ped_writer.write_to_file(pedfile, comment_header=False)
-            return {
-                "response": ped_writer.get_response_headers(),
-                "covars": ped_writer.get_covar_headers(),
-                "path": ped_file_path
-            }
-        except Exception as e:
-            raise Exception("Failed to create ped file ({})".format(e))
-
     def prepare_job(self, model_spec):
         geno = self.get_geno(model_spec)
         pheno = self.get_pheno(model_spec)
@@ -1,5 +1,9 @@
 import json
 import os
+import time
+import fcntl
+import tempfile
+import threading
 import subprocess
 import pwd
 from .model_factory import ModelFactory
@@ -124,6 +128,9 @@ def get_queue():
         "--noheader"]
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     squeue_out, squeue_err = p.communicate()
+    if p.returncode != 0:
+        # a failed squeue prints nothing, which is not an empty queue
+        raise subprocess.CalledProcessError(p.returncode, cmd, squeue_out, squeue_err)
     queue = {"running": [], "queued": []}
     for line in squeue_out.decode().split("\n"):
         values = line.split("|")
@@ -136,3 +143,70 @@ def get_queue():
         elif row["state"] == "PD":
             queue["queued"].append(row)
     return queue
+
+# get_queue_snapshot shares one squeue result between all requests and all
+# server processes: it is saved to a file and refreshed (by a single process,
+# under a file lock) once it is older than QUEUE_SNAPSHOT_TTL seconds
+
+_snapshot = {"mtime": None, "queue": None}
+_snapshot_lock = threading.Lock()
+
+def queue_positions(queue):
+    # job name -> 1-based position among queued jobs
+    positions = dict()
+    for i, row in enumerate(queue["queued"]):
+        positions.setdefault(row["job_name"], i + 1)
+    return positions
+
+def read_queue_snapshot(path):
+    # (age in seconds, queue) of the saved snapshot; parsed once per version
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    with _snapshot_lock:
+        if _snapshot["mtime"] == st.st_mtime_ns:
+            return time.time() - st.st_mtime, _snapshot["queue"]
+    try:
+        with open(path) as f:
+            queue = json.load(f)
+    except (IOError, ValueError):
+        return None, None
+    with _snapshot_lock:
+        _snapshot["mtime"] = st.st_mtime_ns
+        _snapshot["queue"] = queue
+    return time.time() - st.st_mtime, queue
+
+def get_queue_snapshot(config):
+    ttl = float(config.get("QUEUE_SNAPSHOT_TTL", 15))
+    path = config.get("QUEUE_SNAPSHOT_PATH") or \
+        os.path.join(tempfile.gettempdir(), "encore-queue.{}.json".format(os.getuid()))
+    age, queue = read_queue_snapshot(path)
+    if queue is not None and age < ttl:
+        return queue
+    with open(path + ".lock", "a") as lock:
+        # with an old snapshot to serve, don't wait for another refresh
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (fcntl.LOCK_NB if queue is not None else 0))
+        except OSError:
+            return queue
+        try:
+            age, current = read_queue_snapshot(path)
+            if current is not None and age < ttl:
+                return current
+            try:
+                current = get_queue()
+            except (OSError, subprocess.CalledProcessError) as e:
+                if queue is None:
+                    raise
+                print("Unable to refresh queue snapshot ({})".format(e))
+                os.utime(path, None)
+                return queue
+            current["positions"] = queue_positions(current)
+            current["updated"] = time.time()
+            with open(path + ".tmp", "w") as f:
+                json.dump(current, f)
+            os.replace(path + ".tmp", path)
+            return current
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -1,22 +1,225 @@
-# Not actually implementing a pool at this point.
-
+import time
+import threading
+from collections import deque
 import MySQLdb
 from flask import g, current_app
 
+class PoolTimeout(Exception):
+    pass
+
+class PooledConnection(object):
+    def __init__(self, con):
+        self.con = con
+        self.created = time.time()
+        self.last_used = self.created
+
+class ConnectionPool(object):
+    '''
+    Thread-safe pool of MySQLdb connections. fill() opens min_size
+    connections up front, and idle connections past idle_timeout are only
+    closed while more than min_size are open.
+    '''
+    def __init__(self, connect_args, min_size=1, max_size=10, timeout=30.0,
+            idle_timeout=300.0, max_lifetime=3600.0):
+        self.connect_args = connect_args
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.created = 0
+        self.recycled = 0
+        self.failed_checks = 0
+
+    def _connect(self):
+        pc = PooledConnection(MySQLdb.connect(**self.connect_args))
+        self.created += 1
+        return pc
+
+    def _close(self, pc):
+        try:
+            pc.con.close()
+        except Exception:
+            pass
+
+    def _expired(self, pc, now):
+        if self.max_lifetime and now - pc.created > self.max_lifetime:
+            return True
+        if self.idle_timeout and now - pc.last_used > self.idle_timeout:
+            return True
+        return False
+
+    def _healthy(self, pc):
+        try:
+            pc.con.ping()
+            return True
+        except Exception:
+            self.failed_checks += 1
+            return False
+
+    def _evict_idle(self, now):
+        # called with lock held; oldest idle connections sit at the left
+        evicted = []
+        keep = deque()
+        while self._idle:
+            pc = self._idle.popleft()
+            if self._expired(pc, now) and self._size - len(evicted) > self.min_size:
+                evicted.append(pc)
+            else:
+                keep.append(pc)
+        self._idle = keep
+        self._size -= len(evicted)
+        self.recycled += len(evicted)
+        return evicted
+
+    def fill(self):
+        # opens connections until min_size are open; a failure is left
+        # for checkout to report
+        while True:
+            with self._cond:
+                if self._size >= min(self.min_size, self.max_size):
+                    return
+                self._size += 1
+            try:
+                pc = self._connect()
+            except Exception as e:
+                with self._cond:
+                    self._size -= 1
+                print("Unable to open pooled database connection ({})".format(e))
+                return
+            with self._cond:
+                self._idle.append(pc)
+                self._cond.notify()
+
+    def checkout(self):
+        start = time.time()
+        waited = False
+        while True:
+            pc = None
+            reserved = False
+            with self._cond:
+                for old in self._evict_idle(time.time()):
+                    self._close(old)
+                while not self._idle and self._size >= self.max_size:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise PoolTimeout("Timed out waiting for database connection")
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    pc = self._idle.pop()
+                else:
+                    self._size += 1
+                    reserved = True
+            if reserved:
+                try:
+                    pc = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif self._expired(pc, time.time()) or not self._healthy(pc):
+                self._close(pc)
+                with self._cond:
+                    self._size -= 1
+                    self.recycled += 1
+                    self._cond.notify()
+                continue
+            with self._cond:
+                self.in_use += 1
+                self.checkouts += 1
+                if waited:
+                    self.waits += 1
+                self.wait_time += time.time() - start
+            return pc
+
+    def checkin(self, pc, discard=False):
+        if not discard:
+            try:
+                # end any open transaction so the next user gets a fresh snapshot
+                pc.con.rollback()
+            except Exception:
+                discard = True
+        now = time.time()
+        if not discard and self.max_lifetime and now - pc.created > self.max_lifetime:
+            discard = True
+        with self._cond:
+            self.in_use -= 1
+            if discard:
+                self._size -= 1
+                self.recycled += 1
+            else:
+                pc.last_used = now
+                self._idle.append(pc)
+            self._cond.notify()
+        if discard:
+            self._close(pc)
+
+    def close_all(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for pc in idle:
+            self._close(pc)
+
+    def stats(self):
+        with self._cond:
+            return {"size": self._size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "created": self.created,
+                "recycled": self.recycled,
+                "failed_checks": self.failed_checks}
+
+def create_pool(config):
+    connect_args = {"host": config.get("MYSQL_HOST"),
+        "user": config.get("MYSQL_USER"),
+        "passwd": config.get("MYSQL_PASSWORD"),
+        "db": config.get("MYSQL_DB")}
+    return ConnectionPool(connect_args,
+        min_size=int(config.get("MYSQL_POOL_MIN_SIZE", 1)),
+        max_size=int(config.get("MYSQL_POOL_MAX_SIZE", 10)),
+        timeout=float(config.get("MYSQL_POOL_TIMEOUT", 30.0)),
+        idle_timeout=float(config.get("MYSQL_POOL_IDLE_TIMEOUT", 300.0)),
+        max_lifetime=float(config.get("MYSQL_POOL_MAX_LIFETIME", 3600.0)))
+
+_pool_lock = threading.Lock()
+
+def get_pool(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    pool = app.extensions.get("sql_pool")
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get("sql_pool")
+            if pool is None:
+                pool = create_pool(app.config)
+                pool.fill()
+                app.extensions["sql_pool"] = pool
+    return pool
+
 def register_db(app):
     @app.teardown_appcontext
     def teardown_conn(exception):
-        con = getattr(g, '_database_con', None)
-        if con is not None:
-            con.close()
+        pc = g.pop('_database_con', None)
+        if pc is not None:
+            get_pool(app).checkin(pc)
 
 def get_conn():
-    con = getattr(g, '_database_con', None)
-    if con is None:
-        con = g._database_con = MySQLdb.connect(
-        host=current_app.config.get("MYSQL_HOST"), 
-        user=current_app.config.get("MYSQL_USER"), 
-        passwd=current_app.config.get("MYSQL_PASSWORD"), 
-        db=current_app.config.get("MYSQL_DB"))
-    return con
-
+    pc = getattr(g, '_database_con', None)
+    if pc is None:
+        pc = g._database_con = get_pool().checkout()
+    return pc.con
@@ -0,0 +1,382 @@
+import os
+import gzip
+import zlib
+import struct
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+
+# Minimal in-process reader for bgzip-compressed files with a tabix (.tbi)
+# index. Index and file handle are opened once per path and shared between
+# requests (see get_tabix_reader).
+
+BGZF_MAX_BLOCK_SIZE = 65536
+TBI_MIN_SHIFT = 14
+TBI_FORMAT_VCF = 2
+TBI_FORMAT_ZERO_BASED = 0x10000
+
+class BlockCache:
+    # LRU of decompressed data, bounded by the total size of cached values
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[key] = (value, nbytes)
+            self.size += nbytes
+            self.__evict()
+
+    def drop_file(self, path):
+        with self._lock:
+            for key in [k for k in self._items if k[0] == path]:
+                self.size -= self._items.pop(key)[1]
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.__evict()
+
+    def __evict(self):
+        while self.size > self.max_bytes and self._items:
+            key, (value, nbytes) = self._items.popitem(last=False)
+            self.size -= nbytes
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._items),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+# shared by every reader in the process; keys start with the file path
+block_cache = BlockCache(256 * 1024 * 1024)
+
+def reg2bins(beg, end):
+    # bins overlapping the 0-based, half-open region [beg, end)
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+def merge_chunks(chunks):
+    merged = []
+    for start, stop in sorted(chunks):
+        if merged and start <= merged[-1][1]:
+            if stop > merged[-1][1]:
+                merged[-1][1] = stop
+        else:
+            merged.append([start, stop])
+    return [tuple(x) for x in merged]
+
+class TabixIndex:
+    def __init__(self, path):
+        self.path = path
+        self.__load()
+
+    def __load(self):
+        with gzip.open(self.path, "rb") as f:
+            data = f.read()
+        if data[0:4] != b"TBI\x01":
+            raise Exception("Not a tabix index ({})".format(self.path))
+        (n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm) = \
+            struct.unpack_from("<8i", data, 4)
+        self.format = fmt
+        self.col_seq = col_seq - 1
+        self.col_beg = col_beg - 1
+        self.col_end = col_end - 1
+        self.meta_char = chr(meta)
+        self.skip = skip
+        offset = 36
+        names = data[offset:offset+l_nm].split(b"\x00")
+        self.names = [x.decode() for x in names[:n_ref]]
+        offset += l_nm
+        self.bins = []
+        self.linear = []
+        for _ in range(n_ref):
+            (n_bin,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            bins = dict()
+            for _ in range(n_bin):
+                (bin_id, n_chunk) = struct.unpack_from("<Ii", data, offset)
+                offset += 8
+                chunks = struct.unpack_from("<{}Q".format(2*n_chunk), data, offset)
+                offset += 16 * n_chunk
+                bins[bin_id] = list(zip(chunks[0::2], chunks[1::2]))
+            (n_intv,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            linear = struct.unpack_from("<{}Q".format(n_intv), data, offset)
+            offset += 8 * n_intv
+            self.bins.append(bins)
+            self.linear.append(linear)
+        self.ref_ids = {x: i for i, x in enumerate(self.names)}
+
+    def has_chrom(self, chrom):
+        return chrom in self.ref_ids
+
+    def get_chunks(self, chrom, beg, end):
+        # merged list of (start, stop) virtual offsets that may hold records
+        # overlapping the 0-based, half-open region [beg, end)
+        ref_id = self.ref_ids.get(chrom)
+        if ref_id is None:
+            return []
+        bins = self.bins[ref_id]
+        linear = self.linear[ref_id]
+        min_offset = 0
+        if linear:
+            min_offset = linear[min(beg >> TBI_MIN_SHIFT, len(linear)-1)]
+        chunks = []
+        for bin_id in reg2bins(beg, end):
+            for chunk in bins.get(bin_id, []):
+                if chunk[1] > min_offset:
+                    chunks.append(chunk)
+        return [(max(start, min_offset), stop) for start, stop in merge_chunks(chunks)]
+
+    def record_span(self, fields):
+        # 0-based, half-open span of a parsed record
+        beg = int(fields[self.col_beg])
+        if not (self.format & TBI_FORMAT_ZERO_BASED):
+            beg -= 1
+        if (self.format & 0xffff) == TBI_FORMAT_VCF:
+            end = beg + len(fields[3])
+        elif self.col_end >= 0 and self.col_end != self.col_beg:
+            end = int(fields[self.col_end])
+        else:
+            end = beg + 1
+        return beg, end
+
+class BgzfFile:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+    def read_block(self, coffset):
+        # returns (decompressed data, compressed block size)
+        key = (self.path, coffset)
+        cached = block_cache.get(key)
+        if cached is not None:
+            return cached
+        block = self.__read_block(coffset)
+        block_cache.put(key, block, len(block[0]))
+        return block
+
+    def __read_block(self, coffset):
+        raw = os.pread(self.fd, BGZF_MAX_BLOCK_SIZE, coffset)
+        if len(raw) < 18:
+            return b"", 0
+        if raw[0] != 31 or raw[1] != 139:
+            raise Exception("Invalid BGZF block at {} ({})".format(coffset, self.path))
+        (xlen,) = struct.unpack_from("<H", raw, 10)
+        bsize = None
+        pos = 12
+        while pos < 12 + xlen:
+            si1, si2, slen = struct.unpack_from("<BBH", raw, pos)
+            if si1 == 66 and si2 == 67:
+                (bsize,) = struct.unpack_from("<H", raw, pos + 4)
+            pos += 4 + slen
+        if bsize is None:
+            raise Exception("Missing BGZF block size at {} ({})".format(coffset, self.path))
+        block_size = bsize + 1
+        data = zlib.decompress(raw[12 + xlen:block_size - 8], -15)
+        return data, block_size
+
+    def read_range(self, vstart, vstop):
+        # decompressed bytes between two virtual offsets
+        return b"".join(self.iter_range(vstart, vstop))
+
+    def iter_range(self, vstart, vstop):
+        coffset = vstart >> 16
+        stop_coffset = vstop >> 16
+        skip = vstart & 0xffff
+        while coffset <= stop_coffset:
+            data, block_size = self.read_block(coffset)
+            if block_size == 0:
+                break
+            if coffset == stop_coffset:
+                data = data[:vstop & 0xffff]
+            yield data[skip:] if skip else data
+            skip = 0
+            coffset += block_size
+
+    def iter_lines(self, vstart, vstop):
+        # complete lines between two virtual offsets, read one block at a time
+        pending = b""
+        for data in self.iter_range(vstart, vstop):
+            lines = (pending + data).split(b"\n") if pending else data.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+
+class TabixReader:
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index = TabixIndex(index_path or path + ".tbi")
+        self.bgzf = BgzfFile(path)
+        self.mtime = os.path.getmtime(path)
+        self._header = None
+
+    def close(self):
+        self.bgzf.close()
+
+    def header(self):
+        if self._header is None:
+            meta = self.index.meta_char
+            lines = []
+            coffset = 0
+            pending = b""
+            done = False
+            while not done:
+                data, block_size = self.bgzf.read_block(coffset)
+                if block_size == 0:
+                    break
+                coffset += block_size
+                buf = pending + data
+                parts = buf.split(b"\n")
+                pending = parts.pop()
+                for line in parts:
+                    line = line.decode()
+                    if not line.startswith(meta):
+                        done = True
+                        break
+                    lines.append(line)
+            self._header = lines
+        return self._header
+
+    def resolve_chrom(self, chrom):
+        chrom = str(chrom)
+        if self.index.has_chrom(chrom):
+            return chrom
+        if chrom.startswith("chr"):
+            alt = chrom[3:]
+        else:
+            alt = "chr" + chrom
+        if self.index.has_chrom(alt):
+            return alt
+        return None
+
+    def query(self, chrom, start, stop):
+        # records overlapping the 1-based, inclusive region chrom:start-stop
+        chrom = self.resolve_chrom(chrom)
+        if chrom is None:
+            return
+        beg = max(start - 1, 0)
+        end = stop
+        index = self.index
+        bchrom = chrom.encode()
+        meta = index.meta_char.encode()
+        nsplit = max(index.col_seq, index.col_beg, index.col_end, 3) + 1
+        for vstart, vstop in index.get_chunks(chrom, beg, end):
+            for line in self.bgzf.iter_lines(vstart, vstop):
+                if not line or line.startswith(meta):
+                    continue
+                fields = line.split(b"\t", nsplit)
+                if fields[index.col_seq] != bchrom:
+                    continue
+                rbeg, rend = index.record_span(fields)
+                if rbeg >= end:
+                    break
+                if rend > beg:
+                    yield line.decode()
+
+    def query_many(self, chrom, positions):
+        # records at each of many 1-based positions (same overlap rule as
+        # query(chrom, pos, pos+1)) using a single pass over merged chunks
+        hits = {pos: [] for pos in positions}
+        chrom = self.resolve_chrom(chrom)
+        if chrom is None or not hits:
+            return hits
+        index = self.index
+        targets = sorted(hits)
+        chunks = []
+        for pos in targets:
+            chunks.extend(index.get_chunks(chrom, max(pos - 1, 0), pos + 1))
+        bchrom = chrom.encode()
+        meta = index.meta_char.encode()
+        nsplit = max(index.col_seq, index.col_beg, index.col_end, 3) + 1
+        last = targets[-1]
+        for vstart, vstop in merge_chunks(chunks):
+            for line in self.bgzf.iter_lines(vstart, vstop):
+                if not line or line.startswith(meta):
+                    continue
+                fields = line.split(b"\t", nsplit)
+                if fields[index.col_seq] != bchrom:
+                    continue
+                rbeg, rend = index.record_span(fields)
+                if rbeg > last:
+                    return hits
+                lo = bisect_left(targets, rbeg)
+                hi = bisect_right(targets, rend)
+                if lo < hi:
+                    text = line.decode()
+                    for pos in targets[lo:hi]:
+                        hits[pos].append(text)
+        return hits
+
+    def fetch_lines_many(self, chrom, positions):
+        header = self.header()
+        header = header[-1:] if header else []
+        return {pos: deque(header + lines) for pos, lines in
+            self.query_many(chrom, positions).items()}
+
+    def fetch_lines(self, chrom, start, stop):
+        # same layout as `tabix -h` with the "##" lines removed
+        lines = deque()
+        header = self.header()
+        if header:
+            lines.append(header[-1])
+        lines.extend(self.query(chrom, start, stop))
+        return lines
+
+_readers = dict()
+_readers_lock = threading.Lock()
+
+def get_tabix_reader(path):
+    index_path = path + ".tbi"
+    if not os.path.exists(index_path):
+        return None
+    mtime = os.path.getmtime(path)
+    with _readers_lock:
+        reader = _readers.get(path)
+        if reader is not None and reader.mtime == mtime:
+            return reader
+        if reader is not None:
+            block_cache.drop_file(path)
+        # a stale reader may still be in use by another request; it is
+        # closed once the last reference goes away
+        reader = TabixReader(path, index_path)
+        _readers[path] = reader
+        return reader
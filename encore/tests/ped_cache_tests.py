@@ -0,0 +1,171 @@
+import os
+import time
+from encore.ped_cache import ped_cache_key, get_ped_file, prune_ped_cache
+
+class FakePheno:
+    def __init__(self, md5sum="abc123", meta=None):
+        self.md5sum = md5sum
+        self.meta = meta if meta is not None else {
+            "layout": {"csv_delimiter": "\t", "skip": 1},
+            "columns": [{"name": "id", "class": "sample_id", "type": "str"},
+                {"name": "bmi", "class": "numeric", "type": "float"},
+                {"name": "sex", "class": "binary", "type": "str", "levels": ["F", "M"]}]}
+
+class FakeReader:
+    def __init__(self, path):
+        self.path = path
+        self.meta = {"columns": [{"name": "IND_ID"}, {"name": "PC1"}]}
+
+class FakeGeno:
+    def __init__(self, path):
+        self.geno_id = "geno1"
+        self.reader = FakeReader(path)
+
+    def get_pheno_reader(self):
+        return self.reader
+
+MODEL_SPEC = {"response": "bmi", "covariates": ["sex"]}
+
+def test_key_is_stable():
+    assert ped_cache_key(FakePheno(), None, MODEL_SPEC) == \
+        ped_cache_key(FakePheno(), None, dict(MODEL_SPEC))
+    assert ped_cache_key(FakePheno(md5sum=None), None, MODEL_SPEC) is None
+
+def test_key_changes_with_meta():
+    base = ped_cache_key(FakePheno(), None, MODEL_SPEC)
+    pheno = FakePheno()
+    pheno.meta["columns"][2]["levels"] = ["F", "M", "U"]
+    assert ped_cache_key(pheno, None, MODEL_SPEC) != base
+    pheno = FakePheno()
+    pheno.meta["columns"][1]["class"] = "categorical"
+    assert ped_cache_key(pheno, None, MODEL_SPEC) != base
+    pheno = FakePheno()
+    pheno.meta["layout"]["skip"] = 0
+    assert ped_cache_key(pheno, None, MODEL_SPEC) != base
+    # parts of the meta the ped file does not depend on are ignored
+    pheno = FakePheno()
+    pheno.meta["records"] = 100
+    assert ped_cache_key(pheno, None, MODEL_SPEC) == base
+
+def test_key_changes_with_inputs():
+    base = ped_cache_key(FakePheno(), None, MODEL_SPEC)
+    assert ped_cache_key(FakePheno(md5sum="def456"), None, MODEL_SPEC) != base
+    assert ped_cache_key(FakePheno(), None, {"response": "bmi"}) != base
+    assert ped_cache_key(FakePheno(), None, dict(MODEL_SPEC, response="sex")) != base
+    assert ped_cache_key(FakePheno(), None, MODEL_SPEC, comment_header=False) != base
+
+def test_key_follows_genotype_phenotypes(tmpdir):
+    path = tmpdir.join("geno_pheno.txt")
+    path.write("IND_ID\tPC1\nA\t0.1\n")
+    spec = dict(MODEL_SPEC, genopheno=["PC1"])
+    geno = FakeGeno(str(path))
+    base = ped_cache_key(FakePheno(), geno, spec)
+    assert base != ped_cache_key(FakePheno(), None, MODEL_SPEC)
+    assert ped_cache_key(FakePheno(), geno, spec) == base
+    path.write("IND_ID\tPC1\nA\t0.2\nB\t0.3\n")
+    assert ped_cache_key(FakePheno(), geno, spec) != base
+    geno.reader = None
+    assert ped_cache_key(FakePheno(), geno, spec) is None
+
+class PedWrites:
+    def __init__(self, text="#FAM_ID\tIND_ID\n1\tA\n"):
+        self.text = text
+        self.calls = 0
+
+    def __call__(self, path):
+        self.calls += 1
+        with open(path, "w") as f:
+            f.write(self.text)
+        return {"response": ["bmi"], "covars": ["sex"]}
+
+def test_entries_are_reused(tmpdir):
+    cache_dir = str(tmpdir.join("ped_cache"))
+    write_ped = PedWrites()
+    first = str(tmpdir.join("job1.ped"))
+    second = str(tmpdir.join("job2.ped"))
+    info = get_ped_file(first, cache_dir, "key1", write_ped)
+    assert info == {"response": ["bmi"], "covars": ["sex"]}
+    assert get_ped_file(second, cache_dir, "key1", write_ped) == info
+    assert write_ped.calls == 1
+    assert open(second).read() == write_ped.text
+    assert os.path.samefile(first, second)
+    get_ped_file(str(tmpdir.join("job3.ped")), cache_dir, "key2", write_ped)
+    assert write_ped.calls == 2
+
+def test_rewrite_does_not_touch_cache(tmpdir):
+    cache_dir = str(tmpdir.join("ped_cache"))
+    ped = str(tmpdir.join("job1.ped"))
+    get_ped_file(ped, cache_dir, "key1", PedWrites())
+    # a resubmitted job replaces its link instead of writing through it
+    get_ped_file(ped, cache_dir, None, PedWrites("other\n"))
+    assert open(ped).read() == "other\n"
+    assert open(os.path.join(cache_dir, "key1.ped")).read() == PedWrites().text
+
+def test_incomplete_entries_are_rewritten(tmpdir):
+    cache_dir = tmpdir.mkdir("ped_cache")
+    cache_dir.join("key1.ped").write("partial")
+    write_ped = PedWrites()
+    ped = str(tmpdir.join("job1.ped"))
+    get_ped_file(ped, str(cache_dir), "key1", write_ped)
+    assert write_ped.calls == 1
+    assert open(ped).read() == write_ped.text
+
+def test_unwritable_cache_writes_directly(tmpdir):
+    tmpdir.join("not_a_dir").write("")
+    write_ped = PedWrites()
+    ped = str(tmpdir.join("job1.ped"))
+    get_ped_file(ped, str(tmpdir.join("not_a_dir", "ped_cache")), "key1", write_ped)
+    assert write_ped.calls == 1
+    assert open(ped).read() == write_ped.text
+
+def add_entry(cache_dir, key, size, age):
+    cache_dir.join(key + ".ped").write("x" * size)
+    info = cache_dir.join(key + ".json")
+    info.write("{}")
+    used = time.time() - age
+    os.utime(str(info), (used, used))
+
+def cached_keys(cache_dir):
+    return sorted(x.purebasename for x in cache_dir.listdir("*.json"))
+
+def test_prune_by_size(tmpdir):
+    cache_dir = tmpdir.mkdir("ped_cache")
+    for i, key in enumerate(["a", "b", "c", "d"]):
+        add_entry(cache_dir, key, 100, 1000 - i)
+    prune_ped_cache(str(cache_dir), max_bytes=250, max_age=None)
+    assert cached_keys(cache_dir) == ["c", "d"]
+    assert sorted(x.basename for x in cache_dir.listdir()) == ["c.json", "c.ped", "d.json", "d.ped"]
+
+def test_prune_keeps_new_entry(tmpdir):
+    cache_dir = tmpdir.mkdir("ped_cache")
+    add_entry(cache_dir, "a", 100, 5000)
+    add_entry(cache_dir, "b", 100, 10)
+    prune_ped_cache(str(cache_dir), max_bytes=50, max_age=None, keep="a")
+    assert cached_keys(cache_dir) == ["a"]
+
+def test_prune_by_age(tmpdir):
+    cache_dir = tmpdir.mkdir("ped_cache")
+    add_entry(cache_dir, "old", 10, 5000)
+    add_entry(cache_dir, "new", 10, 10)
+    cache_dir.join("stale.tmp").write("")
+    os.utime(str(cache_dir.join("stale.tmp")), (0, 0))
+    cache_dir.join("active.tmp").write("")
+    prune_ped_cache(str(cache_dir), max_bytes=None, max_age=3600)
+    assert cached_keys(cache_dir) == ["new"]
+    assert not cache_dir.join("stale.tmp").exists()
+    assert cache_dir.join("active.tmp").exists()
+
+def test_reuse_counts_as_use(tmpdir):
+    cache_dir = tmpdir.mkdir("ped_cache")
+    write_ped = PedWrites()
+    get_ped_file(str(tmpdir.join("job1.ped")), str(cache_dir), "a", write_ped)
+    get_ped_file(str(tmpdir.join("job2.ped")), str(cache_dir), "b", write_ped)
+    for key in ("a", "b"):
+        os.utime(str(cache_dir.join(key + ".json")), (0, 0))
+    get_ped_file(str(tmpdir.join("job3.ped")), str(cache_dir), "a", write_ped)
+    size = len(write_ped.text)
+    get_ped_file(str(tmpdir.join("job4.ped")), str(cache_dir), "c", write_ped,
+        max_bytes=2 * size, max_age=None)
+    assert cached_keys(cache_dir) == ["a", "c"]
+    # jobs keep their copies of pruned entries
+    assert open(str(tmpdir.join("job2.ped"))).read() == write_ped.text
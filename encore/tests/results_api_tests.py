@@ -0,0 +1,229 @@
+import os
+import sys
+import gzip
+import importlib
+import pytest
+from urllib.parse import urlsplit, parse_qs
+from flask_login import LoginManager
+from encore import ApiFlask
+from encore import api_blueprint
+from encore.api_blueprint import api
+from encore.job import Job
+from encore.results_store import ResultsStore
+from encore.tabix_reader import TabixReader
+from tabix_reader_tests import write_tabix
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "plot-epacts-output"))
+import make_results_store
+
+# encore.auth is shadowed by the auth blueprint in the package namespace
+auth = importlib.import_module("encore.auth")
+
+# /results must return the same lines from the columnar store and from the
+# text output, with the file's own number formatting
+
+HEADER = ["#CHROM\tBEGIN\tEND\tMARKER_ID\tNS\tAC\tMAF\tPVALUE\tBETA"]
+PVALUES = ["1e-04", "0.00012", "NA", "3.5E-8", "0.2", "0.010", "1", "5e-3"]
+
+def make_records():
+    records = []
+    for chrom in ("1", "2"):
+        for i in range(400):
+            # every tenth position holds two variants
+            begin = 10000 + (i - i % 2 if i % 10 < 2 else i) * 50
+            maf = "{:.3f}".format((i % 37) / 74)
+            rest = "\t".join(["{}:{}_A/G".format(chrom, begin), "2000",
+                str((i % 37) * 2), maf, PVALUES[i % len(PVALUES)], "-0.10"])
+            records.append((chrom, begin, begin, rest))
+    return records
+
+def record_lines(records):
+    return ["\t".join([c, str(b), str(e), rest]) + "\n" for c, b, e, rest in records]
+
+class FakeJob:
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+
+    def get_output_file_path(self):
+        return self.path
+
+    def get_results_store(self):
+        return self.store
+
+@pytest.fixture(scope="module")
+def results(tmpdir_factory):
+    tmpdir = tmpdir_factory.mktemp("results")
+    path = str(tmpdir.join("output.epacts.gz"))
+    records = make_records()
+    write_tabix(path, HEADER, records)
+    store_path = str(tmpdir.join("results.store"))
+    make_results_store.process_file(path, store_path)
+    return path, ResultsStore(store_path), record_lines(records)
+
+@pytest.fixture(scope="module")
+def app():
+    app = ApiFlask(__name__)
+    app.config["LOGIN_DISABLED"] = True
+    app.register_blueprint(api, url_prefix="/api")
+    LoginManager().init_app(app)
+    return app
+
+@pytest.fixture(params=["store", "text"])
+def client(request, app, results, monkeypatch):
+    path, store, lines = results
+    job = FakeJob(path, store if request.param == "store" else None)
+    monkeypatch.setattr(Job, "get", lambda job_id, config: job)
+    monkeypatch.setattr(auth, "can_user_view_job", lambda user, job: True)
+    return app.test_client()
+
+def get_lines(client, query=""):
+    rv = client.get("/api/jobs/job1/results" + query)
+    assert rv.status_code == 200
+    text = rv.get_data(as_text=True).splitlines(True)
+    assert text[0] == HEADER[0][1:] + "\n"
+    return rv, text[1:]
+
+def pvalue_below(line, threshold):
+    value = line.split("\t")[7]
+    return value != "NA" and float(value) < threshold
+
+def test_unfiltered_results(client, results):
+    rv, lines = get_lines(client)
+    assert lines == results[2]
+
+@pytest.mark.parametrize("query,keep", [
+    ("?max-pvalue=0.01", lambda x: pvalue_below(x, 0.01)),
+    ("?region=2:12000-15000", lambda x: x.startswith("2\t") and 12000 <= int(x.split("\t")[1]) <= 15000),
+    ("?chrom=2&min-maf=0.4", lambda x: x.startswith("2\t") and float(x.split("\t")[6]) >= 0.4),
+    ("?region=1:10000-20000&max-pvalue=0.001", lambda x: x.startswith("1\t") and
+        int(x.split("\t")[1]) <= 20000 and pvalue_below(x, 0.001)),
+])
+def test_filtered_results_keep_file_text(client, results, query, keep):
+    rv, lines = get_lines(client, query)
+    expected = [x for x in results[2] if keep(x)]
+    assert expected
+    assert lines == expected
+
+def test_offset_and_limit(client, results):
+    rv, lines = get_lines(client, "?max-pvalue=0.5&offset=7&limit=25")
+    expected = [x for x in results[2] if pvalue_below(x, 0.5)]
+    assert lines == expected[7:32]
+
+def test_cursor_pages(client, results):
+    expected = [x for x in results[2] if pvalue_below(x, 0.05)]
+    query = "?max-pvalue=0.05&limit=17"
+    pages = []
+    cursors = []
+    while True:
+        rv, lines = get_lines(client, query)
+        pages.extend(lines)
+        cursor = rv.headers.get("X-Next-Cursor")
+        if cursor is None:
+            assert "Link" not in rv.headers
+            break
+        link = rv.headers["Link"]
+        assert link.endswith('>; rel="next"')
+        url = urlsplit(link[1:link.index(">")])
+        args = parse_qs(url.query)
+        assert url.path == "/api/jobs/job1/results"
+        assert args == {"max-pvalue": ["0.05"], "limit": ["17"], "cursor": [cursor]}
+        # chrom:pos:n resumes after the first n records at the position of
+        # the last line of the page
+        assert cursor == line_cursor(results[2], lines[-1])
+        cursors.append(cursor)
+        query = "?" + url.query
+    assert pages == expected
+    assert len(cursors) == (len(expected) - 1) // 17
+
+def line_cursor(all_lines, line):
+    fields = line.split("\t")
+    at_pos = [x for x in all_lines[:all_lines.index(line) + 1]
+        if x.split("\t")[:2] == fields[:2]]
+    return "{}:{}:{}".format(fields[0], fields[1], len(at_pos))
+
+def test_cursor_within_position(client, results):
+    # a page ending on the first of two variants at a position resumes
+    # with the second one
+    rv, lines = get_lines(client, "?region=1:10000-10100&limit=1")
+    assert rv.headers["X-Next-Cursor"] == "1:10000:1"
+    rv, lines = get_lines(client, "?region=1:10000-10100&limit=1&cursor=1:10000:1")
+    assert lines == [x for x in results[2] if x.startswith("1\t10000\t")][1:2]
+
+@pytest.mark.parametrize("query", ["?limit=5&cursor=nope", "?limit=5&cursor=9:100:1",
+    "?cursor=9:100:1"])
+def test_invalid_filter(client, query):
+    # rejected before any of the response is sent
+    rv = client.get("/api/jobs/job1/results" + query)
+    assert rv.status_code == 400
+    assert rv.get_json()["error"] == "INVALID FILTER"
+
+def test_unindexed_text_results(app, tmpdir, monkeypatch):
+    path = str(tmpdir.join("output.epacts.gz"))
+    with gzip.open(path, "wt") as f:
+        f.write(HEADER[0] + "\n" + "".join(record_lines(make_records())))
+    monkeypatch.setattr(Job, "get", lambda job_id, config: FakeJob(path, None))
+    monkeypatch.setattr(auth, "can_user_view_job", lambda user, job: True)
+    rv = app.test_client().get("/api/jobs/job1/results?region=1:10000-20000")
+    assert rv.status_code == 400
+    assert rv.get_json()["details"] == "Results are not indexed"
+
+def test_results_file_range(client, results):
+    with open(results[0], "rb") as f:
+        data = f.read()
+    rv = client.get("/api/jobs/job1/results/file", headers={"Range": "bytes=100-1099"})
+    assert rv.status_code == 206
+    assert rv.headers["Content-Range"] == "bytes 100-1099/{}".format(len(data))
+    assert rv.get_data() == data[100:1100]
+    rv = client.get("/api/jobs/job1/results/file", headers={"Range": "bytes={}-".format(len(data) - 10)})
+    assert rv.status_code == 206
+    assert rv.get_data() == data[-10:]
+    rv = client.get("/api/jobs/job1/results/file")
+    assert rv.status_code == 200
+    assert rv.get_data() == data
+
+class FakeTabix:
+    def __init__(self, path):
+        self.reader = TabixReader(path)
+
+    def query(self, chrom, start, stop):
+        return (x.split("\t") for x in self.reader.query(chrom, start, stop))
+
+def text_column_results(tmpdir, column, value):
+    # results where one value of column is not a number, so the store
+    # keeps that column as text
+    path = str(tmpdir.join("output.epacts.gz"))
+    records = make_records()
+    col = HEADER[0].split("\t").index(column) - 3
+    chrom, begin, end, rest = records[5]
+    fields = rest.split("\t")
+    fields[col] = value
+    records[5] = (chrom, begin, end, "\t".join(fields))
+    write_tabix(path, HEADER, records)
+    store_path = str(tmpdir.join("results.store"))
+    make_results_store.process_file(path, store_path)
+    return path, ResultsStore(store_path), record_lines(records)
+
+def get_zoom(app, monkeypatch, path, store):
+    monkeypatch.setattr(Job, "get", lambda job_id, config: FakeJob(path, store))
+    monkeypatch.setattr(auth, "can_user_view_job", lambda user, job: True)
+    monkeypatch.setattr(api_blueprint.tabix, "open", FakeTabix, raising=False)
+    rv = app.test_client().get("/api/jobs/job1/plots/zoom?chrom=1&start_pos=10000&end_pos=12000")
+    assert rv.status_code == 200
+    return rv.get_json()["data"]
+
+def test_zoom_text_pvalue_uses_tabix(app, tmpdir, monkeypatch):
+    path, store, lines = text_column_results(tmpdir, "PVALUE", "<1e-300")
+    assert not store.is_numeric("PVALUE")
+    data = get_zoom(app, monkeypatch, path, store)
+    assert data == get_zoom(app, monkeypatch, path, None)
+    assert "<1e-300" in data["PVALUE"]
+
+def test_zoom_text_maf(app, tmpdir, monkeypatch):
+    path, store, lines = text_column_results(tmpdir, "MAF", "unknown")
+    assert store.is_numeric("PVALUE") and not store.is_numeric("MAF")
+    data = get_zoom(app, monkeypatch, path, store)
+    fields = [x.split("\t") for x in lines]
+    assert data["MAF"] == [x[6] for x in fields
+        if x[0] == "1" and int(x[1]) <= 12000 and x[7] != "NA"]
+    assert "unknown" in data["MAF"]
@@ -0,0 +1,109 @@
+import threading
+import pytest
+from encore import sql_pool
+from encore.sql_pool import ConnectionPool, PoolTimeout
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.rollbacks = 0
+
+    def ping(self):
+        if self.broken:
+            raise Exception("MySQL server has gone away")
+
+    def rollback(self):
+        if self.broken:
+            raise Exception("MySQL server has gone away")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+    def connect(**kwargs):
+        con = FakeConnection()
+        opened.append(con)
+        return con
+    monkeypatch.setattr(sql_pool.MySQLdb, "connect", connect, raising=False)
+    return opened
+
+def test_checkout_checkin_reuses_connection(connections):
+    pool = ConnectionPool({}, min_size=0, max_size=2)
+    pc = pool.checkout()
+    assert pool.stats()["in_use"] == 1
+    pool.checkin(pc)
+    assert pc.con.rollbacks == 1
+    assert pool.stats()["idle"] == 1
+    assert pool.checkout() is pc
+    assert len(connections) == 1
+
+def test_checkin_discards_broken_connection(connections):
+    pool = ConnectionPool({}, min_size=0, max_size=2)
+    pc = pool.checkout()
+    pc.con.broken = True
+    pool.checkin(pc)
+    assert pc.con.closed
+    assert pool.stats()["size"] == 0
+    assert pool.checkout() is not pc
+
+def test_checkout_replaces_broken_idle_connection(connections):
+    pool = ConnectionPool({}, min_size=0, max_size=2)
+    pc = pool.checkout()
+    pool.checkin(pc)
+    pc.con.broken = True
+    fresh = pool.checkout()
+    assert fresh is not pc
+    assert pc.con.closed
+    assert pool.stats()["failed_checks"] == 1
+    assert pool.stats()["size"] == 1
+
+def test_checkin_discards_connection_past_lifetime(connections):
+    pool = ConnectionPool({}, min_size=0, max_size=2, max_lifetime=60)
+    pc = pool.checkout()
+    pc.created -= 120
+    pool.checkin(pc)
+    assert pc.con.closed
+    assert pool.stats()["size"] == 0
+
+def test_checkout_times_out_at_max_size(connections):
+    pool = ConnectionPool({}, min_size=0, max_size=2, timeout=0.05)
+    held = [pool.checkout(), pool.checkout()]
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+    assert len(connections) == 2
+    pool.checkin(held[0])
+    assert pool.checkout() is held[0]
+
+def test_checkout_waits_for_checkin(connections):
+    pool = ConnectionPool({}, min_size=0, max_size=1, timeout=5)
+    pc = pool.checkout()
+    timer = threading.Timer(0.05, pool.checkin, [pc])
+    timer.start()
+    assert pool.checkout() is pc
+    timer.join()
+    assert pool.stats()["waits"] == 1
+
+def test_fill_opens_min_size_connections(connections):
+    pool = ConnectionPool({}, min_size=3, max_size=2)
+    pool.fill()
+    assert pool.stats()["idle"] == 2
+    pool = ConnectionPool({}, min_size=2, max_size=5)
+    pool.fill()
+    assert pool.stats()["idle"] == 2
+    assert len(connections) == 4
+
+def test_idle_eviction_keeps_min_size(connections):
+    pool = ConnectionPool({}, min_size=2, max_size=3, idle_timeout=60)
+    held = [pool.checkout() for _ in range(3)]
+    for pc in held:
+        pool.checkin(pc)
+    for pc in held[:2]:
+        pc.last_used -= 120
+    assert pool.checkout() is held[2]
+    assert held[0].con.closed
+    assert not held[1].con.closed
+    assert pool.stats()["size"] == 2
@@ -0,0 +1,191 @@
+import gzip
+import zlib
+import struct
+import pytest
+from encore import tabix_reader
+from encore.tabix_reader import TabixReader, BlockCache
+
+# Test files are written here with small BGZF blocks so that records cross
+# block boundaries, along with a generic (1-based, CHROM/BEGIN/END) index
+
+def bgzf_block(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    comp = c.compress(data) + c.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+        18 + len(comp) + 8 - 1)
+    return header + comp + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+def reg2bin(beg, end):
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+def write_tabix(path, header, records, block_size=1000):
+    # records are (chrom, begin, end, rest) with 1-based, inclusive spans
+    text = "".join(x + "\n" for x in header)
+    spans = []
+    for chrom, begin, end, rest in records:
+        line = "\t".join([chrom, str(begin), str(end), rest]) + "\n"
+        spans.append((len(text), len(text) + len(line)))
+        text += line
+    data = text.encode()
+    blocks = [bgzf_block(data[i:i+block_size]) for i in range(0, len(data), block_size)]
+    coffsets = [0]
+    for block in blocks:
+        coffsets.append(coffsets[-1] + len(block))
+    with open(path, "wb") as f:
+        f.write(b"".join(blocks) + bgzf_block(b""))
+    def voffset(pos):
+        return coffsets[pos // block_size] << 16 | pos % block_size
+
+    names = []
+    refs = dict()
+    for (chrom, begin, end, _), (start, stop) in zip(records, spans):
+        if chrom not in refs:
+            names.append(chrom)
+            refs[chrom] = (dict(), dict())
+        bins, linear = refs[chrom]
+        vstart, vstop = voffset(start), voffset(stop)
+        chunks = bins.setdefault(reg2bin(begin - 1, end), [])
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vstop
+        else:
+            chunks.append([vstart, vstop])
+        for w in range((begin - 1) >> 14, ((end - 1) >> 14) + 1):
+            linear.setdefault(w, vstart)
+    nm = b"".join(x.encode() + b"\x00" for x in names)
+    out = [b"TBI\x01", struct.pack("<8i", len(names), 0, 1, 2, 3, ord("#"), 0, len(nm)), nm]
+    for chrom in names:
+        bins, linear = refs[chrom]
+        out.append(struct.pack("<i", len(bins)))
+        for bin_id, chunks in sorted(bins.items()):
+            out.append(struct.pack("<Ii", bin_id, len(chunks)))
+            for chunk in chunks:
+                out.append(struct.pack("<QQ", *chunk))
+        n_intv = max(linear) + 1
+        ioff = []
+        for w in range(n_intv):
+            ioff.append(linear.get(w, ioff[-1] if ioff else 0))
+        out.append(struct.pack("<i", n_intv))
+        out.append(struct.pack("<{}Q".format(n_intv), *ioff))
+    with open(path + ".tbi", "wb") as f:
+        f.write(gzip.compress(b"".join(out)))
+
+def make_records(chroms):
+    records = []
+    for chrom in chroms:
+        for i in range(3000):
+            begin = 1000 + i * 37
+            # a few long records, spanning several index bins
+            end = begin + 40000 if i % 250 == 0 else begin
+            records.append((chrom, begin, end, "{}:{}_A/G\t{:.3g}".format(chrom, begin, 0.5 / (i + 1))))
+    return records
+
+HEADER = ["##fileformat=test", "#CHROM\tBEGIN\tEND\tMARKER_ID\tPVALUE"]
+
+def expected(records, chrom, start, stop):
+    return ["\t".join([c, str(b), str(e), rest]) for c, b, e, rest in records
+        if c == chrom and b <= stop and e >= start]
+
+@pytest.fixture
+def tabix_file(tmpdir):
+    path = str(tmpdir.join("results.gz"))
+    records = make_records(["1", "2", "X"])
+    write_tabix(path, HEADER, records)
+    tabix_reader.block_cache.drop_file(path)
+    return path, records
+
+def test_header(tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    assert reader.header() == HEADER
+
+def test_query_whole_chromosomes(tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    for chrom in ("1", "2", "X"):
+        assert list(reader.query(chrom, 1, 10**9)) == expected(records, chrom, 1, 10**9)
+
+def test_query_across_block_boundaries(tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    # windows of a few records at every offset, so each record boundary
+    # that falls on a block boundary is crossed by some query
+    for start in range(1000, 1000 + 3000 * 37, 53):
+        stop = start + 120
+        assert list(reader.query("2", start, stop)) == expected(records, "2", start, stop)
+
+def test_query_long_records(tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    # only reachable through the record starting at 1000 + 250 * 37
+    pos = 1000 + 250 * 37 + 30000
+    hits = list(reader.query("1", pos, pos))
+    assert hits == expected(records, "1", pos, pos)
+    assert any(x.startswith("1\t{}\t".format(1000 + 250 * 37)) for x in hits)
+
+def test_query_many_matches_query(tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    positions = [1, 1000, 1037, 1050, 50000, 1000 + 2999 * 37, 10**8] + \
+        list(range(1000 + 500 * 37, 1000 + 520 * 37, 11))
+    hits = reader.query_many("X", positions)
+    assert sorted(hits) == sorted(positions)
+    for pos in positions:
+        assert hits[pos] == list(reader.query("X", pos, pos + 1))
+    assert reader.query_many("X", []) == {}
+    assert reader.query_many("Y", [1000]) == {1000: []}
+
+def test_fetch_lines(tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    lines = reader.fetch_lines("1", 1000, 1074)
+    assert list(lines) == [HEADER[-1]] + expected(records, "1", 1000, 1074)
+    many = reader.fetch_lines_many("1", [1000, 1037])
+    assert list(many[1037]) == [HEADER[-1]] + list(reader.query("1", 1037, 1038))
+
+def test_chr_prefix(tmpdir, tabix_file):
+    path, records = tabix_file
+    reader = TabixReader(path)
+    assert reader.resolve_chrom("chr1") == "1"
+    assert list(reader.query("chr2", 2000, 3000)) == expected(records, "2", 2000, 3000)
+    prefixed_path = str(tmpdir.join("prefixed.gz"))
+    prefixed = make_records(["chr1"])
+    write_tabix(prefixed_path, HEADER, prefixed)
+    prefixed_reader = TabixReader(prefixed_path)
+    assert prefixed_reader.resolve_chrom("1") == "chr1"
+    assert list(prefixed_reader.query("1", 2000, 3000)) == expected(prefixed, "chr1", 2000, 3000)
+    assert prefixed_reader.query_many("1", [1037])[1037] == expected(prefixed, "chr1", 1037, 1038)
+    assert prefixed_reader.resolve_chrom("2") is None
+    assert list(prefixed_reader.query("2", 1, 10**9)) == []
+
+def test_block_cache_byte_limit():
+    cache = BlockCache(100)
+    cache.put(("a", 0), "x", 40)
+    cache.put(("a", 1), "y", 40)
+    assert cache.get(("a", 0)) == "x"
+    cache.put(("b", 0), "z", 40)
+    # least recently used entry goes first
+    assert cache.get(("a", 1)) is None
+    assert cache.get(("a", 0)) == "x"
+    assert cache.stats()["bytes"] == 80
+    cache.put(("b", 1), "too big", 101)
+    assert cache.get(("b", 1)) is None
+    cache.drop_file("a")
+    assert cache.get(("a", 0)) is None
+    assert cache.stats()["bytes"] == 40
+    cache.set_max_bytes(30)
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["evictions"] == 2
+
+def test_reads_stay_within_cache_limit(monkeypatch, tabix_file):
+    path, records = tabix_file
+    cache = BlockCache(4000)
+    monkeypatch.setattr(tabix_reader, "block_cache", cache)
+    reader = TabixReader(path)
+    assert list(reader.query("1", 1, 10**9)) == expected(records, "1", 1, 10**9)
+    stats = cache.stats()
+    assert 0 < stats["bytes"] <= 4000
+    assert stats["evictions"] > 0
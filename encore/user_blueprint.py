@@ -151,7 +151,7 @@ def get_job_output(job, filename, as_attach=False, mimetype=None, tail=None, hea
                 resp.headers["Content-Type"] = mimetype
             return resp
         else:
-            return send_file(output_file, as_attachment=as_attach, mimetype=mimetype)
+            return send_file(output_file, as_attachment=as_attach, mimetype=mimetype, conditional=True)
     except Exception as e:
         print(e)
         return "File Not Found", 404
@@ -0,0 +1,380 @@
+'''
+Reads association results (the output of epacts or saige) a block of rows
+at a time and parses the columns the plotting scripts need into numpy
+arrays, so thresholds, binning and top-N selection can work on whole
+arrays. Full records (the `other` dict of the per-line readers) are only
+built for the rows that end up being reported.
+'''
+
+import os
+import io
+import sys
+import gzip
+import re
+import zlib
+import struct
+import collections
+import collections.abc
+import numpy as np
+
+COLUMN_ALIASES = {"BEG": "BEGIN",
+    "CHR": "CHROM",
+    "POS": "BEGIN",
+    "SNPID": "MARKER_ID",
+    "N": "NS",
+    "p.value": "PVALUE"}
+
+AssocResult = collections.namedtuple('AssocResult', 'chrom pos pval other'.split())
+
+_single_id_regex = re.compile(r'([^:]+):([0-9]+)_([-ATCG]+)\/([-ATCG]+)(?:_(.+))?')
+_group_id_regex = re.compile(r'([^:]+):([0-9]+)-([0-9]+)(?:_(.+))?')
+# one match per line of "\n"-joined marker ids; the allele groups are
+# empty when the id is not of the single variant form
+_marker_lines_regex = re.compile(r'^(?:([^:\n]+):([0-9]+)_([-ATCG]+)/([-ATCG]+)(?:_[^\n]+)?)?[^\n]*', re.M)
+_allele_regex = re.compile(r'^[-ATCG]+$')
+
+def to_float(x):
+    try:
+        return float(x)
+    except ValueError:
+        return np.nan
+
+def float_array(values):
+    # "NA" and other non-numbers become NaN
+    return np.array([to_float(x) for x in values], dtype=np.float64)
+
+def parse_header(line):
+    if line.startswith("#"):
+        line = line[1:]
+    header = line.rstrip().split()
+    return {COLUMN_ALIASES.get(x, x): i for i, x in enumerate(header)}
+
+class Categories:
+    '''Integer codes for string values, kept consistent across chunks'''
+    def __init__(self):
+        self.codes = dict()
+        self.names = []
+
+    def encode(self, values):
+        codes = list(map(self.codes.get, values))
+        if None in codes:
+            for i, name in enumerate(values):
+                if codes[i] is None:
+                    code = self.codes.get(name)
+                    if code is None:
+                        code = self.codes[name] = len(self.names)
+                        self.names.append(name)
+                    codes[i] = code
+        return np.array(codes, dtype=np.int32)
+
+class AssocChunk:
+    '''
+    A block of rows. chrom, ref and alt are codes into the reader's
+    chroms and alleles categories (ref and alt are -1 when the marker id
+    does not name the alleles), pos is int64 and pval is float64 with NaN
+    for missing values. first_row is the row number of the first row.
+    '''
+    def __init__(self, reader, fields, rows, first_row):
+        self.filecols = reader.filecols
+        self.ncol = len(reader.filecols)
+        self.fields = fields
+        self.rows = rows
+        self.first_row = first_row
+        self.chrom = reader.chroms.encode(self.column("CHROM"))
+        self.pos = np.array(list(map(int, self.column("BEGIN"))), dtype=np.int64)
+        self.pval = float_array(self.column("PVALUE"))
+        self.ref, self.alt = self.__alleles(reader.alleles)
+
+    def column(self, name):
+        return self.fields[self.filecols[name]::self.ncol]
+
+    def columns(self):
+        return [self.fields[i::self.ncol] for i in range(self.ncol)]
+
+    def float_column(self, name):
+        return float_array(self.column(name))
+
+    def row(self, i):
+        return self.fields[i*self.ncol:(i+1)*self.ncol]
+
+    def line(self, i):
+        return "\t".join(self.row(i)) + "\n"
+
+    def __alleles(self, alleles):
+        markers = self.column("MARKER_ID")
+        n = len(markers)
+        # most ids are chrom:pos_ref/alt, which split into four fields
+        parts = "\n".join(markers).replace(":", "\n").replace("_", "\n").replace("/", "\n").split("\n")
+        if n and len(parts) == 4 * n and parts[0::4] == self.column("CHROM") and \
+                parts[1::4] == self.column("BEGIN"):
+            refs, alts = parts[2::4], parts[3::4]
+            if all(_allele_regex.match(x) for x in set(refs) | set(alts)):
+                return alleles.encode(refs), alleles.encode(alts)
+        groups = _marker_lines_regex.findall("\n".join(markers))
+        refs = np.full(n, -1, dtype=np.int32)
+        alts = np.full(n, -1, dtype=np.int32)
+        has_alleles = np.array([bool(x[2]) for x in groups], dtype=bool)
+        if has_alleles.any():
+            idx = np.flatnonzero(has_alleles)
+            refs[idx] = alleles.encode([groups[i][2] for i in idx])
+            alts[idx] = alleles.encode([groups[i][3] for i in idx])
+        return refs, alts
+
+    def result(self, i):
+        # the same record the per-line AssocResultReader classes return
+        v = self.row(i)
+        column_indices = self.filecols
+        if v[column_indices["PVALUE"]] == 'NA':
+            return None
+        chrom = v[column_indices["CHROM"]]
+        pos = int(v[column_indices["BEGIN"]])
+        pval = float(v[column_indices["PVALUE"]])
+        marker_id = v[column_indices["MARKER_ID"]]
+        other = { k: v[i] for k,i in column_indices.items()}
+        match = _single_id_regex.match(marker_id)
+        if match:
+            chrom2, pos2, ref2, alt2, name2 = match.groups()
+            assert chrom == chrom2
+            assert pos == int(pos2)
+            other["ref"] = ref2
+            other["alt"] = alt2
+            if name2:
+                other["label"] = name2
+        else:
+            match = _group_id_regex.match(marker_id)
+            if match:
+                chrom2, begin2, end2, name2 = match.groups()
+                other["start"] = begin2
+                other["stop"] = end2
+                if name2:
+                    other["label"] = name2
+        return AssocResult(chrom, pos, pval, other)
+
+class ChunkResults(collections.abc.Sequence):
+    '''Records for some rows of a chunk, built when first accessed'''
+    def __init__(self, chunk, indices, transform=None):
+        self.chunk = chunk
+        self.indices = indices
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        result = self.chunk.result(int(self.indices[i]))
+        if self.transform is not None:
+            result = self.transform(result)
+        return result
+
+TBI_PSEUDO_BIN = 37450 # holds per-sequence statistics instead of chunks
+
+def tabix_parts(path, part_bytes):
+    '''
+    Splits a bgzip-compressed file with a tabix index into (start, end)
+    virtual offsets of runs of rows: one per sequence, and sequences with
+    more than part_bytes of compressed data are split further at linear
+    index entries. end is None for the last part. Returns None when there
+    is no usable index.
+    '''
+    index_path = path + ".tbi"
+    if not os.path.exists(index_path):
+        return None
+    with gzip.open(index_path, "rb") as f:
+        data = f.read()
+    if data[0:4] != b"TBI\x01":
+        return None
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    offset = 36 + l_nm
+    bounds = []
+    for _ in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        seq_start = None
+        for _ in range(n_bin):
+            (bin_id, n_chunk) = struct.unpack_from("<Ii", data, offset)
+            offset += 8
+            chunks = struct.unpack_from("<{}Q".format(2*n_chunk), data, offset)
+            offset += 16 * n_chunk
+            if bin_id != TBI_PSEUDO_BIN and chunks:
+                first = min(chunks[0::2])
+                seq_start = first if seq_start is None else min(seq_start, first)
+        (n_intv,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        linear = struct.unpack_from("<{}Q".format(n_intv), data, offset)
+        offset += 8 * n_intv
+        if seq_start is None:
+            continue
+        bounds.append(seq_start)
+        last = seq_start
+        # linear index entries point at the first row of a 16kb window
+        for voffset in sorted(set(x for x in linear if x > seq_start)):
+            if (voffset >> 16) - (last >> 16) >= part_bytes:
+                bounds.append(voffset)
+                last = voffset
+    if not bounds or any(b <= a for a, b in zip(bounds, bounds[1:])):
+        return None
+    return list(zip(bounds, bounds[1:] + [None]))
+
+class BgzfRange(io.RawIOBase):
+    '''
+    The decompressed bytes of a bgzip-compressed file from virtual offset
+    start up to (not including) end, or to the end of the file
+    '''
+    def __init__(self, path, start, end=None):
+        self.f = open(path, "rb")
+        self.coffset = start >> 16
+        self.skip = start & 0xffff
+        self.end = end
+        self.buf = b""
+        self.buf_pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.buf_pos >= len(self.buf):
+            if not self.__next_block():
+                return 0
+        n = min(len(b), len(self.buf) - self.buf_pos)
+        b[:n] = self.buf[self.buf_pos:self.buf_pos+n]
+        self.buf_pos += n
+        return n
+
+    def __next_block(self):
+        if self.end is not None and self.coffset > self.end >> 16:
+            return False
+        self.f.seek(self.coffset)
+        header = self.f.read(18)
+        if len(header) < 18:
+            return False
+        if header[0:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+            raise Exception("Invalid BGZF block at {} ({})".format(self.coffset, self.f.name))
+        block_size = struct.unpack_from("<H", header, 16)[0] + 1
+        block = zlib.decompress(self.f.read(block_size - 18)[:-8], -15)
+        stop = len(block)
+        if self.end is not None and self.coffset == self.end >> 16:
+            stop = self.end & 0xffff
+        self.buf = block[self.skip:stop]
+        self.buf_pos = 0
+        self.skip = 0
+        self.coffset += block_size
+        return True
+
+    def close(self):
+        self.f.close()
+        io.RawIOBase.close(self)
+
+class AssocChunkReader:
+    '''
+    Iterates over AssocChunk objects of about chunk_bytes of text each.
+    Rows with the wrong number of fields are skipped. With a region (start
+    and end virtual offsets, see tabix_parts) only those rows of a
+    bgzip-compressed file are read; row numbers then count from the start
+    of the region.
+    '''
+    def __init__(self, path, chunk_bytes=2*1024*1024, region=None):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.region = region
+        self.header = None
+        self.filecols = dict()
+        self.chroms = Categories()
+        self.alleles = Categories()
+
+    def __enter__(self):
+        if self.region is not None:
+            with gzip.open(self.path, "rt") as f:
+                self.header = f.readline()
+            self.filecols = parse_header(self.header)
+            self.f = io.TextIOWrapper(io.BufferedReader(BgzfRange(self.path, *self.region),
+                buffer_size=1<<20))
+            return self
+        if self.path and self.path != "-":
+            if self.path.endswith(".gz"):
+                self.f = gzip.open(self.path, "rt")
+            else:
+                self.f = open(self.path, "rt")
+        else:
+            self.f = sys.stdin
+        self.header = self.f.readline()
+        self.filecols = parse_header(self.header)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.f is not sys.stdin:
+            self.f.close()
+
+    def __iter__(self):
+        ncol = len(self.filecols)
+        first_row = 0
+        while True:
+            block = self.f.read(self.chunk_bytes)
+            if not block:
+                break
+            if not block.endswith("\n"):
+                block += self.f.readline()
+                if not block.endswith("\n"):
+                    block += "\n"
+            rows = block.count("\n")
+            fields = block.replace("\n", "\t").split("\t")
+            fields.pop()
+            if len(fields) != rows * ncol:
+                lines = [x.split("\t") for x in block.split("\n")]
+                lines = [x for x in lines if len(x) == ncol]
+                rows = len(lines)
+                fields = [x for line in lines for x in line]
+            if rows:
+                yield AssocChunk(self, fields, rows, first_row)
+                first_row += rows
+
+class TopResults:
+    '''
+    The n results with the smallest p-values, smallest first and the
+    earliest row first among equal p-values (the order ExtremeCollection
+    keeps).
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.pvals = np.zeros(0)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.results = []
+
+    def add(self, chunk, pvals=None, transform=None):
+        pvals = chunk.pval if pvals is None else pvals
+        idx = np.flatnonzero(~np.isnan(pvals))
+        if len(idx) > self.n:
+            kth = np.partition(pvals[idx], self.n - 1)[self.n - 1]
+            idx = idx[pvals[idx] <= kth]
+        if len(self.rows) == self.n:
+            idx = idx[pvals[idx] < self.pvals[-1]]
+        if len(idx) == 0:
+            return
+        all_pvals = np.concatenate((self.pvals, pvals[idx]))
+        all_rows = np.concatenate((self.rows, chunk.first_row + idx))
+        order = np.lexsort((all_rows, all_pvals))[:self.n]
+        new_results = ChunkResults(chunk, idx, transform)
+        old = len(self.results)
+        self.results = [self.results[i] if i < old else new_results[i - old] for i in order.tolist()]
+        self.pvals = all_pvals[order]
+        self.rows = all_rows[order]
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __getitem__(self, i):
+        return self.results[i]
+
+    def merge(self, other, row_offset=0):
+        # adds the results of another TopResults over rows that come after
+        # these ones, its row numbers shifted by row_offset
+        all_pvals = np.concatenate((self.pvals, other.pvals))
+        all_rows = np.concatenate((self.rows, other.rows + row_offset))
+        order = np.lexsort((all_rows, all_pvals))[:self.n]
+        results = self.results + other.results
+        self.results = [results[i] for i in order.tolist()]
+        self.pvals = all_pvals[order]
+        self.rows = all_rows[order]
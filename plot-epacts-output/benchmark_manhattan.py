@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+'''
+Compares manhattan plot binning throughput (variants/second) of
+make_manhattan_json.VariantBinner against the previous implementation
+(`bisect.insort` into a sorted list and one -log10 rounding per variant).
+
+Variants are generated, or read from a results file with `--infile`.
+'''
+
+import sys
+import math
+import time
+import random
+import bisect
+import make_manhattan_json
+from make_manhattan_json import AssocResult, VariantBinner
+
+try:
+    import blist
+    sorted_list = blist.blist
+except ImportError:
+    sorted_list = list
+
+class LegacyHeap():
+    def __init__(self):
+        self._q = sorted_list()
+        self._items = {}
+        self._idx = 0
+
+    def add(self, item, priority):
+        idx = self._idx
+        self._idx += 1
+        bisect.insort(self._q, (-priority, idx))
+        self._items[idx] = item
+
+    def pop(self):
+        priority, idx = self._q.pop(0)
+        return self._items.pop(idx)
+
+    def __len__(self):
+        return len(self._q)
+
+    def __iter__(self):
+        while self._q:
+            yield self.pop()
+
+class LegacyBinner(VariantBinner):
+    def __init__(self, *args):
+        VariantBinner.__init__(self, *args)
+        self.unbinned_variant_heap = LegacyHeap()
+
+    def bin_variant(self, variant):
+        chrom = variant.chrom
+        if not chrom in self.chrom_order:
+            self.chrom_order[chrom] = len(self.chrom_order)
+        chrom_key = self.chrom_order[chrom]
+        pos_bin = variant.pos // self.bin_length
+        self.chrom_n_bins[chrom_key] = max(self.chrom_n_bins.get(chrom_key,0), pos_bin)
+        if (chrom_key, pos_bin) in self.bins:
+            bin = self.bins[(chrom_key, pos_bin)]
+        else:
+            bin = {"chrom": chrom,
+                   "startpos": pos_bin * self.bin_length,
+                   "neglog10_pvals": set()}
+            self.bins[(chrom_key, pos_bin)] = bin
+        bin["neglog10_pvals"].add(round(-math.log10(variant.pval) // self.neglog10_pval_bin_size *
+            self.neglog10_pval_bin_size, self.neglog10_pval_bin_digits))
+
+    def add(self, variant):
+        if variant.pval > self.binning_pval_threshold:
+            self.bin_variant(variant)
+        else:
+            self.unbinned_variant_heap.add(variant, variant.pval)
+            if len(self.unbinned_variant_heap) > self.n_unbinned:
+                old = self.unbinned_variant_heap.pop()
+                self.bin_variant(old)
+
+def simulate_variants(count, hit_fraction, seed=1):
+    # null p-values plus a fraction of strong hits
+    rand = random.Random(seed)
+    variants = []
+    per_chrom = max(count // 22, 1)
+    for i in range(count):
+        chrom = str(min(i // per_chrom + 1, 22))
+        pos = (i % per_chrom) * 100 + 1
+        if rand.random() < hit_fraction:
+            pval = 10 ** -rand.uniform(5, 50)
+        else:
+            pval = rand.random() or 1e-308
+        other = {"MAF": "{:.4g}".format(rand.uniform(0.01, 0.5)),
+            "BETA": "{:.4g}".format(rand.gauss(0, 1)), "NS": "1000"}
+        variants.append(AssocResult(chrom, pos, pval, other))
+    return variants
+
+def read_variants(path):
+    with make_manhattan_json.AssocResultReader(path) as inf:
+        return [x for x in inf if x]
+
+def run(binner_class, variants, args):
+    binner = binner_class(args.pos_window, args.sig_pvalue, args.max_unbinned, 0.05, 2)
+    start = time.process_time()
+    for variant in variants:
+        binner.add(variant)
+    result = binner.finish()
+    return time.process_time() - start, result
+
+if __name__ == "__main__":
+    import argparse
+    argp = argparse.ArgumentParser(description='Benchmark manhattan plot binning.', \
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argp.add_argument('--variants', '-n', help="Number of simulated variants",
+        type=int, default=1000000)
+    argp.add_argument('--hit-fraction', help="Fraction of simulated variants with p < 1e-5",
+        type=float, default=0.01)
+    argp.add_argument('--max-unbinned', '-M', help="Maximum number of unbinned variants",
+        type=int, default=500)
+    argp.add_argument('--sig-pvalue', '-P', help="P-value threshold for binning",
+        type=float, default=1)
+    argp.add_argument('--pos-window', '-w', help="Window size (in bases)",
+        type=float, default=3e6)
+    argp.add_argument('--repeat', help="Runs per implementation (fastest is reported)",
+        type=int, default=3)
+    argp.add_argument('--infile', help="Read variants from a results file instead")
+    args = argp.parse_args()
+
+    if args.infile:
+        variants = read_variants(args.infile)
+    else:
+        variants = simulate_variants(args.variants, args.hit_fraction)
+
+    results = {}
+    timings = {}
+    for name, binner_class in (("legacy", LegacyBinner), ("heap", VariantBinner)):
+        times = []
+        for _ in range(args.repeat):
+            elapsed, results[name] = run(binner_class, variants, args)
+            times.append(elapsed)
+        timings[name] = min(times)
+        print('{:8} {:10.3f}s {:14,.0f} variants/s'.format(name, timings[name],
+            len(variants) / timings[name]))
+    print('speedup  {:.2f}x'.format(timings["legacy"] / timings["heap"]))
+    if results["legacy"] != results["heap"]:
+        print('results differ')
+        sys.exit(1)
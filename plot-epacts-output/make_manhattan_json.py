@@ -16,27 +16,42 @@ import gzip
 import re
 import json
 import math
+import heapq
 import collections
-import bisect
-import blist
+import numpy as np
+import assoc_chunks
 
 
 class Heap():
-    '''A priority queue in which the items with the largest priorities get removed first'''
-    def __init__(self):
-        self._q = blist.blist()
-        self._items = {}
+    '''
+    A priority queue in which the items with the largest priorities get
+    removed first (the earliest added first among equal priorities). With a
+    maxsize, adding to a full queue removes and returns the item that would
+    be popped next.
+    '''
+    def __init__(self, maxsize=None):
+        self._q = []
         self._idx = 0 # Handle uncomparable items
+        self.maxsize = maxsize
 
     def add(self, item, priority):
-        idx = self._idx
+        entry = (-priority, self._idx, item)
         self._idx += 1
-        bisect.insort(self._q, (-priority, idx))
-        self._items[idx] = item
+        if self.maxsize is not None and len(self._q) >= self.maxsize:
+            return heapq.heappushpop(self._q, entry)[2]
+        heapq.heappush(self._q, entry)
+        return None
 
     def pop(self):
-        priority, idx = self._q.pop(0)
-        return self._items.pop(idx)
+        return heapq.heappop(self._q)[2]
+
+    def entries(self):
+        # (item, priority) pairs in the order they were added
+        return [(item, -priority) for priority, idx, item in sorted(self._q, key=lambda x: x[1])]
+
+    def peek_priority(self):
+        # priority of the item that would be popped next
+        return -self._q[0][0]
 
     def __len__(self):
         return len(self._q)
@@ -54,8 +69,10 @@ assert round_sig(1.59e-10, 2) == 1.6e-10
 _single_id_regex = re.compile(r'([^:]+):([0-9]+)_([-ATCG]+)\/([-ATCG]+)(?:_(.+))?')
 _group_id_regex = re.compile(r'([^:]+):([0-9]+)-([0-9]+)(?:_(.+))?')
 
-def rounded_neglog10(pval, neglog10_pval_bin_size, neglog10_pval_bin_digits):
-    return round(-math.log10(pval) // neglog10_pval_bin_size * neglog10_pval_bin_size, neglog10_pval_bin_digits)
+def rounded_neglog10(pvals, neglog10_pval_bin_size, neglog10_pval_bin_digits):
+    # for an array of p-values
+    return np.round(np.floor_divide(-np.log10(pvals), neglog10_pval_bin_size) * neglog10_pval_bin_size,
+        neglog10_pval_bin_digits)
 
 def get_pvals_and_pval_extents(pvals, neglog10_pval_bin_size):
     # expects that NEGLOG10_PVAL_BIN_SIZE is the distance between adjacent bins.
@@ -74,66 +91,178 @@ def get_pvals_and_pval_extents(pvals, neglog10_pval_bin_size):
             rv_pval_extents.append([start,end])
     return (rv_pvals, rv_pval_extents)
 
-def bin_variants(variants, bin_length, binning_pval_threshold, n_unbinned, neglog10_pval_bin_size, neglog10_pval_bin_digits):
-    bins = {}
-    unbinned_variant_heap = Heap()
+class VariantBinner:
+    '''
+    Accepts variants one at a time; see bin_variants. Binned p-values are
+    buffered so -log10 rounding and de-duplication within each bin are done
+    a chunk at a time.
+    '''
     exports = [["ref","ref"], ["alt","alt"], ["MAF","maf"],
         ["BETA","beta"],["SEBETA","sebeta"], ["label","label"], ["NS","N"]]
-    chrom_order = {}
-    chrom_n_bins = {}
-
-    def bin_variant(variant):
-        chrom = variant.chrom
-        if not chrom in chrom_order:
-            chrom_order[chrom] = len(chrom_order)
-        chrom_key = chrom_order[chrom]
-        pos_bin = variant.pos // bin_length
-        chrom_n_bins[chrom_key] = max(chrom_n_bins.get(chrom_key,0), pos_bin)
-        if (chrom_key, pos_bin) in bins:
-            bin = bins[(chrom_key, pos_bin)]
-        else:
-            bin = {"chrom": chrom,
-                   "startpos": pos_bin * bin_length,
-                   "neglog10_pvals": set()}
-            bins[(chrom_key, pos_bin)] = bin
-        bin["neglog10_pvals"].add(rounded_neglog10(variant.pval, neglog10_pval_bin_size, neglog10_pval_bin_digits))
-        
-    variant_iterator = iter((v for v in variants if v)) 
-    # put the most-significant variants into the heap and bin the rest
-    for variant in variant_iterator:
-        if variant.pval > binning_pval_threshold:
-            bin_variant(variant)
+
+    def __init__(self, bin_length, binning_pval_threshold, n_unbinned, neglog10_pval_bin_size,
+            neglog10_pval_bin_digits, chunk_size=1<<16):
+        self.bin_length = bin_length
+        self.binning_pval_threshold = binning_pval_threshold
+        self.n_unbinned = n_unbinned
+        self.neglog10_pval_bin_size = neglog10_pval_bin_size
+        self.neglog10_pval_bin_digits = neglog10_pval_bin_digits
+        self.chunk_size = chunk_size
+        self.bins = {}
+        self.unbinned_variant_heap = Heap(n_unbinned)
+        self.chrom_order = {}
+        self.chrom_names = []
+        self.chrom_n_bins = {}
+        self.pending_chroms = []
+        self.pending_pos = []
+        self.pending_pvals = []
+        self.pending_blocks = []
+
+    def chrom_key(self, chrom):
+        # chromosomes are kept in the order they first appear
+        chrom_key = self.chrom_order.get(chrom)
+        if chrom_key is None:
+            chrom_key = self.chrom_order[chrom] = len(self.chrom_order)
+            self.chrom_names.append(chrom)
+        return chrom_key
+
+    def bin_variant(self, variant):
+        self.pending_chroms.append(self.chrom_key(variant.chrom))
+        self.pending_pos.append(variant.pos)
+        self.pending_pvals.append(variant.pval)
+        if len(self.pending_pvals) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        blocks = self.pending_blocks
+        if self.pending_pvals:
+            blocks.append((np.array(self.pending_chroms, dtype=np.int64),
+                np.array(self.pending_pos, dtype=np.int64),
+                np.array(self.pending_pvals, dtype=np.float64)))
+        if not blocks:
+            return
+        chrom_keys = np.concatenate([x[0] for x in blocks])
+        pos_bins = np.concatenate([x[1] for x in blocks]) // self.bin_length
+        neglog10_pvals = rounded_neglog10(np.concatenate([x[2] for x in blocks]),
+            self.neglog10_pval_bin_size, self.neglog10_pval_bin_digits)
+        self.pending_chroms, self.pending_pos, self.pending_pvals = [], [], []
+        self.pending_blocks = []
+        if len(chrom_keys) == 0:
+            return
+        order = np.lexsort((neglog10_pvals, pos_bins, chrom_keys))
+        chrom_keys, pos_bins, neglog10_pvals = chrom_keys[order], pos_bins[order], neglog10_pvals[order]
+        first = np.r_[True, (chrom_keys[1:] != chrom_keys[:-1]) | (pos_bins[1:] != pos_bins[:-1]) |
+            (neglog10_pvals[1:] != neglog10_pvals[:-1])]
+        for chrom_key, pos_bin, neglog10_pval in zip(chrom_keys[first].tolist(),
+                pos_bins[first].tolist(), neglog10_pvals[first].tolist()):
+            if (chrom_key, pos_bin) in self.bins:
+                bin = self.bins[(chrom_key, pos_bin)]
+            else:
+                bin = {"chrom": self.chrom_names[chrom_key],
+                       "startpos": pos_bin * self.bin_length,
+                       "neglog10_pvals": set()}
+                self.bins[(chrom_key, pos_bin)] = bin
+                self.chrom_n_bins[chrom_key] = max(self.chrom_n_bins.get(chrom_key,0), pos_bin)
+            bin["neglog10_pvals"].add(neglog10_pval)
+
+    def add(self, variant):
+        # put the most-significant variants into the heap and bin the rest
+        self.chrom_key(variant.chrom)
+        if variant.pval > self.binning_pval_threshold:
+            self.bin_variant(variant)
         else:
-            unbinned_variant_heap.add(variant, variant.pval)
-            if len(unbinned_variant_heap) > n_unbinned:
-                old = unbinned_variant_heap.pop()
-                bin_variant(old)
-
-    unbinned_variants = []
-    for variant in unbinned_variant_heap:
-        rec = {
-            'chrom': variant.chrom,
-            'pos': variant.pos,
-            'pval': round_sig(variant.pval, 2)
-        }
-        for field, export_as in exports:
-            if field in variant.other:
-                rec[export_as] = variant.other[field]
-        unbinned_variants.append(rec)
-
-
-    # unroll bins into simple array (preserving chromosomal order)
-    binned_variants = []
-    for chrom_key in sorted(chrom_order.values()):
-        for pos_key in range(int(1+chrom_n_bins[chrom_key])):
-            b = bins.get((chrom_key, pos_key), None)
-            if b and len(b['neglog10_pvals']) != 0:
-                b['neglog10_pvals'], b['neglog10_pval_extents'] = get_pvals_and_pval_extents(b['neglog10_pvals'], neglog10_pval_bin_size)
-                b['pos'] = int(b['startpos'] + bin_length/2)
-                del b['startpos']
-                binned_variants.append(b)
-
-    return binned_variants, unbinned_variants
+            old = self.unbinned_variant_heap.add(variant, variant.pval)
+            if old is not None:
+                self.bin_variant(old)
+
+    def add_arrays(self, chroms, chrom_names, pos, pvals, variants):
+        # the same as calling add for each row: chroms are codes into
+        # chrom_names and variants a sequence of the matching records. Only
+        # rows that can still make the unbinned list go through the heap.
+        _, first = np.unique(chroms, return_index=True)
+        keys = np.zeros(len(chrom_names), dtype=np.int64)
+        for code in chroms[np.sort(first)].tolist():
+            keys[code] = self.chrom_key(chrom_names[code])
+        candidates = np.flatnonzero(pvals <= self.binning_pval_threshold)
+        if len(candidates) > self.n_unbinned:
+            kth = np.partition(pvals[candidates], self.n_unbinned - 1)[self.n_unbinned - 1] \
+                if self.n_unbinned > 0 else -np.inf
+            candidates = candidates[pvals[candidates] <= kth]
+        heap = self.unbinned_variant_heap
+        if len(heap) == self.n_unbinned and len(heap):
+            candidates = candidates[pvals[candidates] <= heap.peek_priority()]
+        binned = np.ones(len(pvals), dtype=bool)
+        binned[candidates] = False
+        self.pending_blocks.append((keys[chroms[binned]], pos[binned], pvals[binned]))
+        for i in candidates.tolist():
+            old = heap.add(variants[i], pvals[i])
+            if old is not None:
+                self.bin_variant(old)
+        if sum(len(x[2]) for x in self.pending_blocks) >= self.chunk_size:
+            self.flush()
+
+    def merge(self, other):
+        # adds everything another binner has seen, as if its variants had
+        # been added to this one after the variants already here
+        other.flush()
+        keys = [self.chrom_key(chrom) for chrom in other.chrom_names]
+        for (chrom_key, pos_bin), bin in other.bins.items():
+            key = (keys[chrom_key], pos_bin)
+            if key in self.bins:
+                self.bins[key]["neglog10_pvals"] |= bin["neglog10_pvals"]
+            else:
+                self.bins[key] = dict(bin, chrom=self.chrom_names[key[0]],
+                    neglog10_pvals=set(bin["neglog10_pvals"]))
+                self.chrom_n_bins[key[0]] = max(self.chrom_n_bins.get(key[0],0), pos_bin)
+        for variant, pval in other.unbinned_variant_heap.entries():
+            old = self.unbinned_variant_heap.add(variant, pval)
+            if old is not None:
+                self.bin_variant(old)
+
+    def finish(self):
+        self.flush()
+        unbinned_variants = []
+        for variant in self.unbinned_variant_heap:
+            rec = {
+                'chrom': variant.chrom,
+                'pos': variant.pos,
+                'pval': round_sig(variant.pval, 2)
+            }
+            for field, export_as in self.exports:
+                if field in variant.other:
+                    rec[export_as] = variant.other[field]
+            unbinned_variants.append(rec)
+
+        # unroll bins into simple array (preserving chromosomal order)
+        binned_variants = []
+        for chrom_key in sorted(self.chrom_order.values()):
+            for pos_key in range(int(1+self.chrom_n_bins.get(chrom_key, 0))):
+                b = self.bins.get((chrom_key, pos_key), None)
+                if b and len(b['neglog10_pvals']) != 0:
+                    b['neglog10_pvals'], b['neglog10_pval_extents'] = get_pvals_and_pval_extents(b['neglog10_pvals'], self.neglog10_pval_bin_size)
+                    b['pos'] = int(b['startpos'] + self.bin_length/2)
+                    del b['startpos']
+                    binned_variants.append(b)
+
+        return binned_variants, unbinned_variants
+
+def bin_variants(variants, bin_length, binning_pval_threshold, n_unbinned, neglog10_pval_bin_size, neglog10_pval_bin_digits):
+    binner = VariantBinner(bin_length, binning_pval_threshold, n_unbinned, neglog10_pval_bin_size, neglog10_pval_bin_digits)
+    for variant in variants:
+        if variant:
+            binner.add(variant)
+    return binner.finish()
+
+def manhattan_result(result):
+    # chromosome names and p-values the way AssocResultReader returns them
+    return result._replace(chrom=result.chrom.replace("chr", ""), pval=max(result.pval, 1e-308))
+
+def bin_chunk(binner, chunk, chrom_names):
+    # an assoc_chunks.AssocChunk; chrom_names are the reader's chromosome names
+    idx = np.flatnonzero(~np.isnan(chunk.pval))
+    binner.add_arrays(chunk.chrom[idx], [x.replace("chr", "") for x in chrom_names],
+        chunk.pos[idx], np.maximum(chunk.pval[idx], 1e-308),
+        assoc_chunks.ChunkResults(chunk, idx, manhattan_result))
 
 AssocResult = collections.namedtuple('AssocResult', 'chrom pos pval other'.split())
 class AssocResultReader:
@@ -259,6 +388,15 @@ def process_file(results, bin_length, bin_threshold, max_unbinned, neglog10_pval
     print('num unbinned:', len(unbinned_variants))
     return rv
 
+def process_chunks(reader, bin_length, bin_threshold, max_unbinned, neglog10_pval_bin_size, neglog10_pval_bin_digits):
+    binner = VariantBinner(bin_length, bin_threshold, max_unbinned, neglog10_pval_bin_size, neglog10_pval_bin_digits)
+    with reader as f:
+        for chunk in f:
+            bin_chunk(binner, chunk, f.chroms.names)
+    variant_bins, unbinned_variants = binner.finish()
+    print('num unbinned:', len(unbinned_variants))
+    return {'variant_bins': variant_bins, 'unbinned_variants': unbinned_variants}
+
 if __name__ == "__main__":
     import argparse
     argp = argparse.ArgumentParser(description='Create JSON file for manhattan plot.', \
@@ -277,8 +415,8 @@ if __name__ == "__main__":
     argp.add_argument('outfile', nargs='?', help="Output file (stdout if not specified)")
     args = argp.parse_args()
 
-    with AssocResultReader(args.infile) as inf, JSONOutFile(args.outfile) as outf:
-        bins = process_file(inf, args.pos_window, args.sig_pvalue, args.max_unbinned, \
+    with JSONOutFile(args.outfile) as outf:
+        bins = process_chunks(assoc_chunks.AssocChunkReader(args.infile), args.pos_window, args.sig_pvalue, args.max_unbinned, \
             args.pval_window, args.pval_round)
         outf.write(bins)
 
@@ -12,13 +12,15 @@ It creates a json file which can be used to render a QQ plot.
 
 import os.path
 import sys
-import gzip
-import re
 import json
 import math
+import heapq
+import shutil
+import tempfile
 import collections
+import numpy as np
 import scipy.stats
-from itertools import islice
+import assoc_chunks
 
 NEGLOG10_PVAL_BIN_SIZE = 0.05 # Use 0.05, 0.1, 0.15, etc
 NEGLOG10_PVAL_BIN_DIGITS = 2 # Then keep 2 digits after the decimal
@@ -62,171 +64,373 @@ def get_conf_int(nvar):
         ))
     return points
 
-def make_qq(variants, max_unbinned, num_bins):
-    # smallest first
-    sorted_variants = sorted((x for x in variants if x is not None), key=lambda x: x.pval)
-    count = len(sorted_variants)
-
-    max_exp_neglog10_pval = -math.log10(0.5 / count) #expected
-    max_obs_neglog10_pval = -math.log10(sorted_variants[0].pval )
-
-    current_bin = -1
-    variants_in_bin = []
-    binned_variants = []
-    for i in range(max_unbinned+1, count):
-        exp_neglog10_pval = -math.log10( (i+0.5) / count ) 
-        exp_bin = int(exp_neglog10_pval / max_exp_neglog10_pval * num_bins)
-        obs_neglog10_pval = -math.log10( sorted_variants[i].pval )
-        if exp_bin != current_bin:
-            if len(variants_in_bin)>0:
-                binned_variants.append((
-                    round_sig(current_bin / num_bins * max_exp_neglog10_pval, 3),
-                    round_sig(sum(variants_in_bin) / float(len(variants_in_bin)), 3) 
-                ))
-                variants_in_bin = []
-            current_bin = exp_bin
-        variants_in_bin.append(obs_neglog10_pval)
-    if len(variants_in_bin)>0:
-        binned_variants.append((
-            round_sig(current_bin / num_bins * max_exp_neglog10_pval, 3),
-            round_sig(sum(variants_in_bin) / float(len(variants_in_bin)), 3) 
-        ))
-
-    unbinned_variants = []
-    for i in range(0, min(max_unbinned, count)):
-        variant = sorted_variants[i]
-        obs_neglog10_pval = -math.log10( variant.pval )
-        exp_neglog10_pval = -math.log10( (i+0.5) / count )
-        rec = {
-            'chrom': variant.chrom,
-            'pos': variant.pos,
-            'pval': variant.pval
-        }
-        rec.update(variant.other)
-        unbinned_variants.append( (round_sig(exp_neglog10_pval,3), round_sig(obs_neglog10_pval,3), rec) )
-
-    median_pval = sorted_variants[count//2].pval
-    gc = {
-        "50": round_sig(gc_value(median_pval),5) 
-    }
-    conf_int = get_conf_int(count)
-        
-    return {"variant_bins": binned_variants, "unbinned_variants": unbinned_variants, 
-        "gc": gc, "count": count, "conf_int": conf_int} 
-
-
-def process_file_unbinned(results, max_unbinned, num_bins):
-    plot = {"description": "Overall Results", "layers": [make_qq(results, max_unbinned, num_bins)]}
-    return plot
-
-def process_file_quartile_binned(results, max_unbinned, num_bins):
-    maf_sorted = sorted((x for x in results if x is not None), key=lambda v: float(v.other["MAF"]))
-    count = len(maf_sorted)
-    num_blocks = 4
-    block_base_size = count // num_blocks 
-    ranges = [[i*block_base_size, (i+1)*block_base_size-1] for i in range(num_blocks)]
-    ranges[num_blocks-1][1] += count - block_base_size * num_blocks 
-    blocks = []
-    for i in range(num_blocks):
-        start = ranges[i][0]
-        stop = ranges[i][1]
-        maf_range = [float(maf_sorted[start].other["MAF"]), float(maf_sorted[stop].other["MAF"])]
-        block = make_qq(islice(maf_sorted, start, stop), max_unbinned, num_bins)
-        block["maf_range"] = maf_range 
-        block["level"] = "Q{}".format(i)
-        blocks.append(block)
-    plot = {"description": "MAF Stratified", "layers": blocks}
-    return plot
-
-def process_file(results, max_unbinned, num_bins):
-    if "MAF" in results.filecols:
-        plot = process_file_quartile_binned(results, max_unbinned, num_bins)
-    else:
-        plot = process_file_unbinned(results, max_unbinned, num_bins)
-    return {"header": {"variant_columns": list(results.filecols.keys())}, "data": [plot]} 
-
-AssocResult = collections.namedtuple('AssocResult', 'chrom pos pval other'.split())
-class AssocResultReader:
-
-    _single_id_regex = re.compile(r'([^:]+):([0-9]+)_([-ATCG]+)\/([-ATCG]+)(?:_(.+))?')
-    _group_id_regex = re.compile(r'([^:]+):([0-9]+)-([0-9]+)(?:_(.+))?')
-
-    def __init__(self, path):
-        self.path = path
-        self.filecols = dict()
-
-    def __enter__(self):
-        if self.path and self.path != "-":
-            if self.path.endswith(".gz"):
-                self.f = gzip.open(self.path, "rt")
+MAX_NEGLOG10_PVAL = 308 # p-values are clamped to 1e-308
+NEGLOG10_PVAL_HIST_WIDTH = 0.001 # width of the -log10 p histogram buckets
+MAX_EXACT_BUCKET_VALUES = 1<<22 # p-values loaded to resolve bins exactly
+
+class QQLayer:
+    '''
+    Streaming QQ plot layer. The smallest p-values are kept exactly (they
+    are plotted one by one); everything else only goes into a fixed-width
+    histogram of -log10 p (count and sum per bucket), so memory does not
+    grow with the number of variants. p-values are also spilled to a
+    temporary file (8 bytes each) so the few buckets where a bin or the
+    median starts can be resolved exactly at the end.
+    '''
+    def __init__(self, max_unbinned, num_bins, hist_width=NEGLOG10_PVAL_HIST_WIDTH, tmpdir=None):
+        self.max_unbinned = max_unbinned
+        self.num_bins = num_bins
+        self.top_size = max_unbinned + 1
+        self.top = [] # heap of (-pval, -order, row, variant)
+        self.count = 0
+        self.hist_width = hist_width
+        nbuckets = int(math.ceil(MAX_NEGLOG10_PVAL / hist_width)) + 1
+        self.hist_count = np.zeros(nbuckets, dtype=np.int64)
+        self.hist_sum = np.zeros(nbuckets)
+        self.spill = tempfile.TemporaryFile(dir=tmpdir)
+
+    def add(self, pvals, rows, variants=None, order=None):
+        # pvals and rows are arrays; variants, if given, is a matching list.
+        # Ties are broken by order (rows by default), the way a stable sort
+        # would
+        if len(pvals) == 0:
+            return
+        pvals = np.asarray(pvals, dtype=np.float64)
+        pvals.tofile(self.spill)
+        neglog10 = -np.log10(pvals)
+        idx = self.__bucket(neglog10)
+        self.hist_count += np.bincount(idx, minlength=len(self.hist_count))
+        self.hist_sum += np.bincount(idx, weights=neglog10, minlength=len(self.hist_count))
+        self.count += len(pvals)
+        candidates = np.arange(len(pvals))
+        if len(pvals) > self.top_size:
+            kth = np.partition(pvals, self.top_size - 1)[self.top_size - 1]
+            candidates = np.flatnonzero(pvals <= kth)
+        if len(self.top) == self.top_size:
+            candidates = candidates[pvals[candidates] <= -self.top[0][0]]
+        for i in candidates.tolist():
+            item = (-float(pvals[i]), -int(rows[i] if order is None else order[i]), int(rows[i]),
+                variants[i] if variants is not None else None)
+            if len(self.top) < self.top_size:
+                heapq.heappush(self.top, item)
+            elif item[:2] > self.top[0][:2]:
+                heapq.heapreplace(self.top, item)
+
+    def top_rows(self):
+        # smallest p-values first
+        return [x[2] for x in sorted(self.top, key=lambda x: (-x[0], -x[1]))]
+
+    def __bucket(self, neglog10):
+        return np.clip((neglog10 / self.hist_width).astype(np.int64), 0, len(self.hist_count) - 1)
+
+    def __bucket_values(self, buckets):
+        # sorted p-values in each of the given buckets, from the spill file
+        buckets = np.array(sorted(buckets), dtype=np.int64)
+        found = []
+        self.spill.flush()
+        self.spill.seek(0)
+        while len(buckets):
+            pvals = np.fromfile(self.spill, dtype=np.float64, count=1<<20)
+            if len(pvals) == 0:
+                break
+            pvals = pvals[np.isin(self.__bucket(-np.log10(pvals)), buckets)]
+            found.append(pvals)
+        if not found:
+            return dict()
+        pvals = np.sort(np.concatenate(found))
+        idx = self.__bucket(-np.log10(pvals))
+        return {b: pvals[idx == b] for b in buckets.tolist()}
+
+    def __exact_buckets(self, wanted):
+        # resolve as many of the wanted buckets as fit in memory
+        wanted = sorted(set(wanted), key=lambda b: self.hist_count[b])
+        total = 0
+        chosen = []
+        for b in wanted:
+            total += int(self.hist_count[b])
+            if total > MAX_EXACT_BUCKET_VALUES:
+                break
+            chosen.append(b)
+        return self.__bucket_values(chosen)
+
+    def __exp_bin_groups(self, first, count, max_exp_neglog10_pval):
+        # runs of ranks [first, count) falling into the same expected p-value bin
+        def exp_bin(i):
+            return int(-math.log10((i+0.5) / count) / max_exp_neglog10_pval * self.num_bins)
+        groups = []
+        i = first
+        while i < count:
+            current_bin = exp_bin(i)
+            lo, hi = i, count - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if exp_bin(mid) == current_bin:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            groups.append((current_bin, i, lo + 1))
+            i = lo + 1
+        return groups
+
+    def result(self, variants=None):
+        # variants maps row numbers to results for the top rows when they
+        # were not passed to add
+        count = self.count
+        max_exp_neglog10_pval = -math.log10(0.5 / count) #expected
+        top = sorted(self.top, key=lambda x: (-x[0], -x[1]))
+        first = self.max_unbinned + 1
+        groups = self.__exp_bin_groups(first, count, max_exp_neglog10_pval)
+
+        # buckets in order of decreasing -log10 p, cumulated, without the
+        # exact top results; a rank r falls in bucket b when the counts
+        # before b are < r <= the counts up to b
+        counts = self.hist_count.copy()
+        sums = self.hist_sum.copy()
+        if top:
+            neglog10 = -np.log10(np.array([-x[0] for x in top]))
+            np.subtract.at(counts, self.__bucket(neglog10), 1)
+            np.subtract.at(sums, self.__bucket(neglog10), neglog10)
+        cum_counts = np.cumsum(counts[::-1])[::-1]
+        cum_sums = np.cumsum(sums[::-1])[::-1]
+        def locate(rank):
+            b = len(counts) - int(np.searchsorted(cum_counts[::-1], rank, side="left")) - 1
+            return b, rank - (int(cum_counts[b+1]) if b+1 < len(counts) else 0)
+
+        median_rank = count // 2
+        bounds = [x[2] - first for x in groups]
+        wanted = [locate(r)[0] for r in bounds if r > 0]
+        if median_rank >= len(top):
+            wanted.append(locate(median_rank - len(top) + 1)[0])
+        exact = self.__exact_buckets(wanted)
+        top_in_bucket = collections.Counter(self.__bucket(-np.log10(np.array([-x[0] for x in top]))).tolist()) \
+            if top else collections.Counter()
+
+        def rank_sum(rank):
+            # sum of -log10 p over the `rank` smallest p-values after the top ones
+            if rank <= 0:
+                return 0.0
+            b, within = locate(rank)
+            before = float(cum_sums[b+1]) if b+1 < len(counts) else 0.0
+            if b in exact:
+                values = exact[b][top_in_bucket[b]:top_in_bucket[b]+within]
+                return before + float(np.sum(-np.log10(values)))
+            return before + within * float(sums[b]) / counts[b]
+
+        binned_variants = []
+        start_sum = 0.0
+        for exp_bin, start, stop in groups:
+            stop_sum = rank_sum(stop - first)
+            binned_variants.append((
+                round_sig(exp_bin / self.num_bins * max_exp_neglog10_pval, 3),
+                round_sig((stop_sum - start_sum) / (stop - start), 3)
+            ))
+            start_sum = stop_sum
+
+        unbinned_variants = []
+        for i in range(0, min(self.max_unbinned, count)):
+            pval, row, variant = -top[i][0], top[i][2], top[i][3]
+            if variant is None:
+                variant = variants[row]
+            obs_neglog10_pval = -math.log10( pval )
+            exp_neglog10_pval = -math.log10( (i+0.5) / count )
+            rec = {
+                'chrom': variant.chrom,
+                'pos': variant.pos,
+                'pval': variant.pval
+            }
+            rec.update(variant.other)
+            unbinned_variants.append( (round_sig(exp_neglog10_pval,3), round_sig(obs_neglog10_pval,3), rec) )
+
+        if median_rank < len(top):
+            median_pval = -top[median_rank][0]
+        else:
+            b, within = locate(median_rank - len(top) + 1)
+            if b in exact:
+                median_pval = float(exact[b][top_in_bucket[b] + within - 1])
             else:
-                self.f = open(self.path, "rt")
+                # too many values to load, interpolate within the bucket
+                median_pval = 10 ** -((b + 1 - (within - 0.5) / counts[b]) * self.hist_width)
+        gc = {
+            "50": round_sig(gc_value(median_pval),5)
+        }
+        conf_int = get_conf_int(count)
+
+        return {"variant_bins": binned_variants, "unbinned_variants": unbinned_variants,
+            "gc": gc, "count": count, "conf_int": conf_int}
+
+    def close(self):
+        self.spill.close()
+
+class QQBuilder:
+    '''
+    Builds the QQ plot json from a stream of results. When there is a MAF
+    column the plot is stratified by MAF quartile, which is only known once
+    every result has been seen; p-values and MAFs are then spilled to
+    temporary files (16 bytes per result) and the variants plotted
+    individually are looked up again with fetch_variants(rows) at the end.
+    '''
+    def __init__(self, filecols, max_unbinned, num_bins, chunk_size=1<<16, tmpdir=None):
+        self.filecols = filecols
+        self.max_unbinned = max_unbinned
+        self.num_bins = num_bins
+        self.chunk_size = chunk_size
+        self.tmpdir = tmpdir
+        self.stratified = "MAF" in filecols
+        self.rows = 0
+        self.fetch_top = False
+        if self.stratified:
+            self.pval_file = tempfile.TemporaryFile(dir=tmpdir)
+            self.maf_file = tempfile.TemporaryFile(dir=tmpdir)
         else:
-            self.f = sys.stdin
-        self.itr = iter(self.f)
-        header = next(self.itr)
-        self.__parseheader(header)
-        return self
-
-    def __exit__(self, type, value, traceback):
-        if self.f is not sys.stdin:
-            self.f.close()
-
-    def __parseheader(self, line):
-        if line.startswith("#"):
-            line = line[1:]
-        header = line.rstrip().split()
-        aliases = {"BEG": "BEGIN",
-            "CHR": "CHROM",
-            "POS": "BEGIN",
-            "SNPID": "MARKER_ID",
-            "N": "NS",
-            "p.value": "PVALUE"}
-        for i, col in enumerate(header):
-            if aliases.get(col):
-                header[i] = aliases.get(col)
-        self.filecols = { x:i for i,x in enumerate(header)}
-
-    def row_parser(self, row):
-        column_indices = self.filecols
-        v = row.rstrip().split('\t')
-        if v[column_indices["PVALUE"]] == 'NA':
-            return None
+            self.layer = QQLayer(max_unbinned, num_bins, tmpdir=tmpdir)
+
+    def add_chunk(self, chunk):
+        # every row of an assoc_chunks.AssocChunk with a p-value
+        idx = np.flatnonzero(~np.isnan(chunk.pval))
+        pvals = np.maximum(chunk.pval[idx], 1e-308)
+        if self.stratified:
+            pvals.tofile(self.pval_file)
+            chunk.float_column("MAF")[idx].tofile(self.maf_file)
         else:
-            chrom = v[column_indices["CHROM"]]
-            pos = int(v[column_indices["BEGIN"]])
-            pval = float(v[column_indices["PVALUE"]])
-            if pval < 1e-308:
-                pval = 1e-308
-            marker_id = v[column_indices["MARKER_ID"]]
-            other = { k: v[i] for k,i in column_indices.items()};
-            match = AssocResultReader._single_id_regex.match(marker_id)
-            if match:
-                chrom2, pos2, ref2, alt2, name2 = match.groups()
-                assert chrom == chrom2
-                assert pos == int(pos2)
-                other["ref"] = ref2
-                other["alt"] = alt2
-                if name2:
-                    other["label"] = name2
-            else:
-                match = AssocResultReader._group_id_regex.match(marker_id)
-                if match:
-                    chrom2, begin2, end2, name2 = match.groups()
-                    other["start"] = begin2
-                    other["stop"] = end2
-                    if name2:
-                        other["label"] = name2
-            return AssocResult(chrom, pos, pval, other)
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        line = next(self.itr)
-        return self.row_parser(line)
-
-    next = __next__
+            self.layer.add(pvals, np.arange(self.rows, self.rows + len(idx)),
+                assoc_chunks.ChunkResults(chunk, idx, qq_result))
+        self.rows += len(idx)
+
+    def add_values(self, pvals, mafs=None):
+        # p-values (clamped, without NaNs) and MAFs of the next results;
+        # their records are looked up with fetch_variants in finish
+        if self.stratified:
+            pvals.tofile(self.pval_file)
+            mafs.tofile(self.maf_file)
+        else:
+            self.layer.add(pvals, np.arange(self.rows, self.rows + len(pvals)))
+            self.fetch_top = True
+        self.rows += len(pvals)
+
+    def __spilled(self, f):
+        # the spilled column a chunk at a time
+        f.seek(0)
+        while True:
+            chunk = np.fromfile(f, dtype=np.float64, count=self.chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+    def __maf_counts(self):
+        values = np.zeros(0)
+        counts = np.zeros(0, dtype=np.int64)
+        for chunk in self.__spilled(self.maf_file):
+            chunk_values, chunk_counts = np.unique(chunk, return_counts=True)
+            values, inverse = np.unique(np.concatenate((values, chunk_values)), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate((counts, chunk_counts)),
+                minlength=len(values)).astype(np.int64)
+        return values, counts
+
+    def __stratified_layers(self, fetch_variants, num_blocks=4):
+        # quartiles of the results sorted (stably) by MAF; the rank of a
+        # result is the number with a smaller MAF plus the number with the
+        # same MAF earlier in the file
+        values, counts = self.__maf_counts()
+        count = int(counts.sum())
+        ends = np.cumsum(counts)
+        block_base_size = count // num_blocks
+        ranges = [[i*block_base_size, (i+1)*block_base_size-1] for i in range(num_blocks)]
+        ranges[num_blocks-1][1] += count - block_base_size * num_blocks
+        layers = [QQLayer(self.max_unbinned, self.num_bins, tmpdir=self.tmpdir)
+            for _ in range(num_blocks)]
+        try:
+            return self.__fill_layers(layers, fetch_variants, values, ends, ranges)
+        finally:
+            for layer in layers:
+                layer.close()
+
+    def __fill_layers(self, layers, fetch_variants, values, ends, ranges):
+        starts = ends - np.diff(np.r_[0, ends])
+        def maf_at(rank):
+            return float(values[np.searchsorted(ends, rank, side="right")])
+        block_starts = np.array([x[0] for x in ranges])
+        block_stops = np.array([x[1] for x in ranges])
+        seen = np.zeros(len(values), dtype=np.int64)
+        row = 0
+        for pvals, mafs in zip(self.__spilled(self.pval_file), self.__spilled(self.maf_file)):
+            idx = np.searchsorted(values, mafs)
+            order = np.argsort(idx, kind="mergesort")
+            sorted_idx = idx[order]
+            group_first = np.flatnonzero(np.r_[True, sorted_idx[1:] != sorted_idx[:-1]])
+            group_sizes = np.diff(np.r_[group_first, len(sorted_idx)])
+            occurrence = np.empty(len(idx), dtype=np.int64)
+            occurrence[order] = np.arange(len(idx)) - np.repeat(group_first, group_sizes) + seen[sorted_idx]
+            seen += np.bincount(idx, minlength=len(values))
+            ranks = starts[idx] + occurrence
+            block = np.searchsorted(block_starts, ranks, side="right") - 1
+            rows = np.arange(row, row + len(pvals))
+            # each block stops short of its last rank, as in islice(start, stop)
+            keep = ranks < block_stops[block]
+            for i, layer in enumerate(layers):
+                sel = keep & (block == i)
+                layer.add(pvals[sel], rows[sel], order=ranks[sel])
+            row += len(pvals)
+        top_rows = sorted(set(r for layer in layers for r in layer.top_rows()[:self.max_unbinned]))
+        variants = fetch_variants(top_rows)
+        blocks = []
+        for i, layer in enumerate(layers):
+            block = layer.result(variants)
+            block["maf_range"] = [maf_at(ranges[i][0]), maf_at(ranges[i][1])]
+            block["level"] = "Q{}".format(i)
+            blocks.append(block)
+        return blocks
+
+    def finish(self, fetch_variants=None):
+        if self.stratified:
+            try:
+                plot = {"description": "MAF Stratified",
+                    "layers": self.__stratified_layers(fetch_variants)}
+            finally:
+                self.pval_file.close()
+                self.maf_file.close()
+        else:
+            try:
+                variants = None
+                if self.fetch_top:
+                    variants = fetch_variants(self.layer.top_rows()[:self.max_unbinned])
+                plot = {"description": "Overall Results", "layers": [self.layer.result(variants)]}
+            finally:
+                self.layer.close()
+        return {"header": {"variant_columns": list(self.filecols.keys())}, "data": [plot]}
+
+def qq_result(result):
+    # p-values below the smallest double are clamped to it
+    return result._replace(pval=max(result.pval, 1e-308))
+
+def read_variants(path, rows, region=None):
+    # {row: result} for the given row numbers (counting results with a
+    # p-value from the start of the file or of the region)
+    wanted = np.array(sorted(set(rows)), dtype=np.int64)
+    found = dict()
+    with assoc_chunks.AssocChunkReader(path, region=region) as inf:
+        row = 0
+        for chunk in inf:
+            if len(found) == len(wanted):
+                break
+            idx = np.flatnonzero(~np.isnan(chunk.pval))
+            for r in wanted[(wanted >= row) & (wanted < row + len(idx))].tolist():
+                found[r] = qq_result(chunk.result(int(idx[r - row])))
+            row += len(idx)
+    return found
+
+def process_file(path, max_unbinned, num_bins):
+    with assoc_chunks.AssocChunkReader(path) as inf:
+        builder = QQBuilder(inf.filecols, max_unbinned, num_bins)
+        for chunk in inf:
+            builder.add_chunk(chunk)
+    return builder.finish(lambda rows: read_variants(path, rows))
+
+def spool_stdin():
+    # results are read a second time for MAF stratified plots
+    f = tempfile.NamedTemporaryFile("wt", suffix=".txt", delete=False)
+    shutil.copyfileobj(sys.stdin, f)
+    f.close()
+    return f.name
 
 class JSONOutFile:
     def __init__(self, path):
@@ -262,8 +466,13 @@ if __name__ == "__main__":
     argp.add_argument('outfile', nargs='?', help="Output file (stdout if not specified)")
     args = argp.parse_args()
 
-    with AssocResultReader(args.infile) as inf, JSONOutFile(args.outfile) as outf:
-        bins = process_file(inf, args.max_unbinned, args.pval_bins)  
-        outf.write(bins)
+    infile = spool_stdin() if args.infile == "-" else args.infile
+    try:
+        with JSONOutFile(args.outfile) as outf:
+            bins = process_file(infile, args.max_unbinned, args.pval_bins)
+            outf.write(bins)
+    finally:
+        if infile != args.infile:
+            os.remove(infile)
 
     print('{} -> {}'.format(args.infile, args.outfile))
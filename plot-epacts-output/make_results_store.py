@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+
+'''
+This script takes two arguments:
+- an input filename (the output of epacts or saige with a single phenotype)
+- an output directory (conventionally `results.store`)
+
+It writes a columnar copy of the results that the web server can
+memory-map instead of decompressing the text file. The directory holds
+one binary file per column and a `meta.json` describing them:
+- CHROM is stored as a uint16 code into meta["chroms"]
+- BEGIN/END are stored as uint32
+- numeric columns are stored as float64 (NA becomes NaN)
+- text columns are stored as concatenated utf-8 bytes plus a uint64
+  offsets file (offsets[i]:offsets[i+1] is row i)
+- the input line of each row is kept the same way (meta["lines"]) so
+  queries can return the original text
+Rows keep the input order. Each chromosome is a contiguous run of rows
+recorded in meta["chroms"] with its first/last position; as the input is
+sorted by position within each chromosome, the BEGIN column doubles as the
+position index for that run. PVALUE additionally gets a value-sorted row
+index (meta["indexes"]) for threshold queries and a tile pyramid
+(meta["tiles"]): per zoom level, position bins with their variant count,
+min p-value and the rows of their top variants.
+'''
+
+
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import numpy as np
+
+COLUMN_ALIASES = {"BEG": "BEGIN",
+    "CHR": "CHROM",
+    "POS": "BEGIN",
+    "SNPID": "MARKER_ID",
+    "N": "NS",
+    "p.value": "PVALUE",
+    "AF_Allele2": "MAF",
+    "AC_Allele2": "AC"}
+
+STORE_VERSION = 2
+
+# columns that also get a value-sorted row index
+SORTED_INDEX_COLUMNS = ("PVALUE",)
+
+def canonical_columns(header):
+    names = []
+    for col in header:
+        name = COLUMN_ALIASES.get(col, col)
+        if name in names:
+            name = col
+        names.append(name)
+    return names
+
+def to_float(x):
+    try:
+        return float(x)
+    except ValueError:
+        return np.nan
+
+def parse_floats(values):
+    # float() on each value is much faster than numpy's string casts;
+    # raises ValueError on a value that is not a number
+    return np.array([float(x) if x != "NA" else np.nan for x in values], dtype=np.float64)
+
+def float_array(values):
+    try:
+        return parse_floats(values)
+    except ValueError:
+        return np.array([to_float(x) for x in values], dtype=np.float64)
+
+def is_numeric(values):
+    try:
+        parse_floats(values)
+        return True
+    except ValueError:
+        return False
+
+def line_fields(path, offsets_path, index, block_rows=65536):
+    # field index of each line of a lines file, a block of rows at a time
+    offsets = np.fromfile(offsets_path, dtype="<u8").astype(np.int64)
+    with open(path, "rb") as f:
+        for start in range(0, len(offsets) - 1, block_rows):
+            stop = min(start + block_rows, len(offsets) - 1)
+            data = f.read(int(offsets[stop] - offsets[start]))
+            bounds = (offsets[start:stop+1] - offsets[start]).tolist()
+            yield [data[a:b].decode().split("\t")[index] for a, b in zip(bounds[:-1], bounds[1:])]
+
+def top_by_bin(rows, keys, pvals, top_n):
+    # groups rows by (non-decreasing) key and keeps the top_n smallest
+    # p-values of each; returns keys, first index of each group in the
+    # p-value order, group sizes and a (groups, top_n) array of rows (-1 pads)
+    order = np.lexsort((pvals, keys))
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(keys)])
+    top = np.full((len(starts), top_n), -1, dtype=np.int64)
+    for j in range(top_n):
+        valid = sizes > j
+        top[valid, j] = rows[order[starts[valid] + j]]
+    return keys[starts], starts, top
+
+def build_tile_levels(chrom_codes, pos, pvals, base_width, factor, nlevels, top_n):
+    # bins of base_width * factor**level bases holding variant count,
+    # min p-value and the top_n variants; each level is built from the
+    # top variants of the one below
+    rows = np.flatnonzero(~np.isnan(pvals))
+    codes = chrom_codes[rows].astype(np.int64)
+    levels = []
+    counts = None
+    width = base_width
+    for level in range(nlevels):
+        bins = pos[rows].astype(np.int64) // width
+        keys = (codes << 32) | bins
+        ukeys, starts, top = top_by_bin(rows, keys, pvals[rows], top_n)
+        if counts is None:
+            counts = np.diff(np.r_[starts, len(keys)])
+        else:
+            # candidates are sorted by key, so child counts collapse in order
+            child_bins = (child_keys & 0xffffffff) // factor
+            parent = (child_keys >> 32 << 32) | child_bins
+            counts = np.add.reduceat(counts, np.flatnonzero(np.r_[True, parent[1:] != parent[:-1]])) \
+                if len(parent) else counts
+        min_pvalue = np.where(top[:, 0] >= 0, pvals[np.maximum(top[:, 0], 0)], np.nan)
+        levels.append({"width": width,
+            "chrom": (ukeys >> 32).astype(np.uint16),
+            "bin": (ukeys & 0xffffffff).astype(np.uint32),
+            "count": counts.astype(np.uint32),
+            "min_pvalue": min_pvalue,
+            "top": top})
+        child_keys = ukeys
+        rows = top[top >= 0]
+        codes = chrom_codes[rows].astype(np.int64)
+        width *= factor
+    return levels
+
+def column_kinds(names, cols):
+    # storage type of each column, from all of the values given
+    kinds = []
+    for name, values in zip(names, cols):
+        if name == "CHROM":
+            kinds.append("chrom")
+        elif name in ("BEGIN", "END"):
+            kinds.append("pos")
+        elif is_numeric(values):
+            kinds.append("float")
+        else:
+            kinds.append("text")
+    return kinds
+
+class ColumnWriter:
+    def __init__(self, outdir, base, name, source, kind):
+        self.name = name
+        self.source = source
+        self.kind = kind
+        self.file = base + ".bin"
+        self.f = open(os.path.join(outdir, self.file), "wb")
+        if kind == "text":
+            self.offsets_file = base + ".offsets.bin"
+            self.of = open(os.path.join(outdir, self.offsets_file), "wb")
+            self.of.write(np.zeros(1, dtype=np.uint64).tobytes())
+            self.nbytes = 0
+
+    def dtype(self):
+        return {"chrom": "<u2", "pos": "<u4", "float": "<f8", "text": "|u1"}[self.kind]
+
+    def write(self, arr):
+        if self.kind == "text":
+            data = [x.encode() for x in arr]
+            lengths = np.fromiter((len(x) for x in data), dtype=np.uint64, count=len(data))
+            offsets = np.cumsum(lengths, dtype=np.uint64) + np.uint64(self.nbytes)
+            self.f.write(b"".join(data))
+            self.of.write(offsets.astype("<u8").tobytes())
+            if len(offsets):
+                self.nbytes = int(offsets[-1])
+        else:
+            self.f.write(arr.astype(self.dtype()).tobytes())
+
+    def append_file(self, path, offsets_path=None):
+        # the data (and offsets) files of the same column of another store
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.f)
+        if self.kind == "text":
+            offsets = np.fromfile(offsets_path, dtype="<u8")[1:] + np.uint64(self.nbytes)
+            self.of.write(offsets.astype("<u8").tobytes())
+            if len(offsets):
+                self.nbytes = int(offsets[-1])
+
+    def close(self):
+        self.f.close()
+        if self.kind == "text":
+            self.of.close()
+
+    def describe(self):
+        desc = {"name": self.name, "source": self.source, "type": self.kind,
+            "file": self.file, "dtype": self.dtype()}
+        if self.kind == "text":
+            desc["offsets"] = self.offsets_file
+        return desc
+
+class ResultsStoreWriter:
+    '''
+    Column types are inferred from the first rows added unless kinds (see
+    column_kinds) are given. A float column that later gets a value that is
+    not a number is rewritten as text from the input lines. Stores written
+    in parts can be joined with add_store.
+    '''
+    def __init__(self, outdir, header, tile_width=10000, tile_factor=4, tile_levels=7, tile_top=5,
+            kinds=None, sorted_indexes=SORTED_INDEX_COLUMNS):
+        self.outdir = outdir
+        self.header = header
+        self.kinds = kinds
+        self.sorted_indexes = sorted_indexes
+        self.tile_width = tile_width
+        self.tile_factor = tile_factor
+        self.tile_levels = tile_levels
+        self.tile_top = tile_top
+        self.names = canonical_columns(header)
+        self.colpos = {x: i for i, x in enumerate(self.names)}
+        for col in ("CHROM", "BEGIN"):
+            if col not in self.colpos:
+                raise Exception("Column {} not found".format(col))
+        self.writers = None
+        self.chroms = []
+        self.chrom_codes = dict()
+        self.rows = 0
+
+    def __init_writers(self, cols):
+        kinds = self.kinds or column_kinds(self.names, cols)
+        self.writers = [ColumnWriter(self.outdir, "col{}".format(i), name, source, kind)
+            for i, (name, source, kind) in enumerate(zip(self.names, self.header, kinds))]
+        self.lines = ColumnWriter(self.outdir, "lines", None, None, "text")
+
+    def __add_chroms(self, chrom_values, pos):
+        codes = np.empty(len(chrom_values), dtype=np.uint16)
+        chrom_values = np.array(chrom_values)
+        breaks = np.flatnonzero(chrom_values[1:] != chrom_values[:-1]) + 1
+        for start, stop in zip([0] + breaks.tolist(), breaks.tolist() + [len(chrom_values)]):
+            chrom = str(chrom_values[start])
+            code = self.chrom_codes.get(chrom)
+            if code is None:
+                code = self.chrom_codes[chrom] = len(self.chroms)
+                self.chroms.append({"name": chrom, "start": self.rows + start,
+                    "stop": self.rows + start, "min_pos": int(pos[start]),
+                    "max_pos": 0, "max_span": 0, "sorted": True})
+            elif code != len(self.chroms) - 1 or self.chroms[code]["stop"] != self.rows + start:
+                raise Exception("Results are not grouped by chromosome ({})".format(chrom))
+            entry = self.chroms[code]
+            run = pos[start:stop]
+            if len(run) > 1 and np.any(run[1:] < run[:-1]):
+                entry["sorted"] = False
+            if entry["stop"] > entry["start"] and run[0] < entry["last_pos"]:
+                entry["sorted"] = False
+            entry["last_pos"] = int(run[-1])
+            entry["min_pos"] = min(entry["min_pos"], int(run.min()))
+            entry["max_pos"] = max(entry["max_pos"], int(run.max()))
+            entry["stop"] = self.rows + stop
+            codes[start:stop] = code
+        return codes
+
+    def add_rows(self, rows):
+        if not rows:
+            return
+        self.add_columns(list(zip(*rows)))
+
+    def add_columns(self, cols):
+        # one list of text values per column
+        if not cols or not len(cols[0]):
+            return
+        if self.writers is None:
+            self.__init_writers(cols)
+        pos = np.array(list(map(int, cols[self.colpos["BEGIN"]])), dtype=np.int64)
+        codes = self.__add_chroms(cols[self.colpos["CHROM"]], pos)
+        spans = None
+        if "END" in self.colpos:
+            end = np.array(list(map(int, cols[self.colpos["END"]])), dtype=np.int64)
+            spans = end - pos
+        for i, writer in enumerate(self.writers):
+            if writer.kind == "chrom":
+                writer.write(codes)
+            elif writer.kind == "pos":
+                writer.write(pos if i == self.colpos["BEGIN"] else end)
+            elif writer.kind == "float":
+                try:
+                    writer.write(parse_floats(cols[i]))
+                except ValueError:
+                    self.__to_text(i).write(cols[i])
+            else:
+                writer.write(cols[i])
+        # split on tabs, so joining the fields gives back the input line
+        self.lines.write(["\t".join(x) for x in zip(*cols)])
+        if spans is not None:
+            for entry in self.chroms:
+                if entry["stop"] > self.rows:
+                    lo = max(entry["start"] - self.rows, 0)
+                    hi = entry["stop"] - self.rows
+                    entry["max_span"] = max(entry["max_span"], int(spans[lo:hi].max()))
+        self.rows += len(cols[0])
+
+    def add_store(self, path):
+        # appends the rows of a store written by a writer with the same
+        # header and kinds
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if not meta["rows"]:
+            return
+        if "lines" not in meta:
+            raise Exception("Store has no input lines ({})".format(path))
+        if self.writers is None:
+            self.kinds = self.kinds or [x["type"] for x in meta["columns"]]
+            self.__init_writers(None)
+        if [x["name"] for x in meta["columns"]] != [w.name for w in self.writers]:
+            raise Exception("Columns differ ({})".format(path))
+        begin = np.fromfile(os.path.join(path, meta["columns"][self.colpos["BEGIN"]]["file"]), dtype="<u4")
+        codes = np.zeros(len(meta["chroms"]), dtype=np.uint16)
+        for i, part in enumerate(meta["chroms"]):
+            first, last = int(begin[part["start"]]), int(begin[part["stop"]-1])
+            code = self.chrom_codes.get(part["name"])
+            if code is None:
+                code = self.chrom_codes[part["name"]] = len(self.chroms)
+                self.chroms.append(dict(part, start=self.rows + part["start"],
+                    stop=self.rows + part["stop"], last_pos=last))
+            elif code != len(self.chroms) - 1 or self.chroms[code]["stop"] != self.rows + part["start"]:
+                raise Exception("Results are not grouped by chromosome ({})".format(part["name"]))
+            else:
+                entry = self.chroms[code]
+                entry["sorted"] = entry["sorted"] and part["sorted"] and first >= entry["last_pos"]
+                entry["min_pos"] = min(entry["min_pos"], part["min_pos"])
+                entry["max_pos"] = max(entry["max_pos"], part["max_pos"])
+                entry["max_span"] = max(entry["max_span"], part["max_span"])
+                entry["stop"] = self.rows + part["stop"]
+                entry["last_pos"] = last
+            codes[i] = code
+        for i, col in enumerate(meta["columns"]):
+            writer = self.writers[i]
+            if writer.kind == "float" and col["type"] == "text":
+                writer = self.__to_text(i)
+            if writer.kind == "chrom":
+                writer.write(codes[np.fromfile(os.path.join(path, col["file"]), dtype=col["dtype"])])
+            elif writer.kind == "text" and col["type"] == "float":
+                for values in line_fields(os.path.join(path, meta["lines"]["file"]),
+                        os.path.join(path, meta["lines"]["offsets"]), i):
+                    writer.write(values)
+            else:
+                writer.append_file(os.path.join(path, col["file"]),
+                    os.path.join(path, col["offsets"]) if writer.kind == "text" else None)
+        self.lines.append_file(os.path.join(path, meta["lines"]["file"]),
+            os.path.join(path, meta["lines"]["offsets"]))
+        self.rows += meta["rows"]
+
+    def __to_text(self, i):
+        # float column i as text, with the values of the rows written so far
+        # taken from the input lines
+        old = self.writers[i]
+        old.close()
+        self.lines.f.flush()
+        self.lines.of.flush()
+        writer = ColumnWriter(self.outdir, os.path.splitext(old.file)[0], old.name, old.source, "text")
+        for values in line_fields(os.path.join(self.outdir, self.lines.file),
+                os.path.join(self.outdir, self.lines.offsets_file), i):
+            writer.write(values)
+        self.writers[i] = writer
+        return writer
+
+    def __write_sorted_index(self, writer):
+        # rows ordered by value (NaN last) along with the sorted values, so
+        # threshold queries are a binary search
+        values = np.fromfile(os.path.join(self.outdir, writer.file), dtype=writer.dtype())
+        order = np.argsort(values, kind="stable").astype("<u4")
+        base = os.path.splitext(writer.file)[0]
+        index = {"order": base + ".order.bin", "order_dtype": "<u4",
+            "values": base + ".sorted.bin", "values_dtype": writer.dtype()}
+        order.tofile(os.path.join(self.outdir, index["order"]))
+        values[order].tofile(os.path.join(self.outdir, index["values"]))
+        return index
+
+    def __write_tiles(self):
+        colfile = {w.name: w for w in self.writers}
+        def load(name):
+            w = colfile[name]
+            return np.fromfile(os.path.join(self.outdir, w.file), dtype=w.dtype())
+        levels = build_tile_levels(load("CHROM"), load("BEGIN"), load("PVALUE"),
+            self.tile_width, self.tile_factor, self.tile_levels, self.tile_top)
+        desc = {"top_n": self.tile_top, "levels": []}
+        for i, level in enumerate(levels):
+            files = dict()
+            for field, dtype in (("chrom", "<u2"), ("bin", "<u4"), ("count", "<u4"),
+                    ("min_pvalue", "<f8"), ("top", "<i8")):
+                files[field] = {"file": "tiles{}.{}.bin".format(i, field), "dtype": dtype}
+                level[field].astype(dtype).tofile(os.path.join(self.outdir, files[field]["file"]))
+            chroms = level["chrom"]
+            bounds = np.searchsorted(chroms, np.arange(len(self.chroms) + 1))
+            desc["levels"].append({"width": level["width"],
+                "bins": int(len(chroms)),
+                "chrom_bins": [[int(a), int(b)] for a, b in zip(bounds[:-1], bounds[1:])],
+                "files": files})
+        return desc
+
+    def close(self):
+        if self.writers is None:
+            self.__init_writers([[] for _ in self.header])
+        for writer in self.writers:
+            writer.close()
+        self.lines.close()
+        for entry in self.chroms:
+            entry.pop("last_pos", None)
+        indexes = dict()
+        for writer in self.writers:
+            if writer.name in self.sorted_indexes and writer.kind == "float":
+                indexes[writer.name] = self.__write_sorted_index(writer)
+        tiles = None
+        if self.tile_levels > 0 and "PVALUE" in self.colpos and \
+                self.writers[self.colpos["PVALUE"]].kind == "float":
+            tiles = self.__write_tiles()
+        meta = {"version": STORE_VERSION,
+            "rows": self.rows,
+            "header": self.header,
+            "columns": [w.describe() for w in self.writers],
+            "lines": {"file": self.lines.file, "offsets": self.lines.offsets_file},
+            "chroms": self.chroms,
+            "indexes": indexes,
+            "tiles": tiles}
+        with open(os.path.join(self.outdir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=0)
+
+def open_results(path):
+    if path and path != "-":
+        if path.endswith(".gz"):
+            return gzip.open(path, "rt")
+        return open(path, "rt")
+    return sys.stdin
+
+def read_header(line):
+    if line.startswith("#"):
+        line = line[1:]
+    return line.rstrip("\n").split("\t")
+
+def process_file(infile, outdir, chunk_bytes=64*1024*1024, **tile_args):
+    tmpdir = outdir.rstrip("/") + ".tmp"
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    f = open_results(infile)
+    try:
+        header = read_header(f.readline())
+        writer = ResultsStoreWriter(tmpdir, header, **tile_args)
+        ncol = len(header)
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            rows = [x.rstrip("\n").split("\t") for x in lines]
+            rows = [x for x in rows if len(x) == ncol]
+            writer.add_rows(rows)
+        writer.close()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.rename(tmpdir, outdir)
+    return writer.rows
+
+if __name__ == "__main__":
+    import argparse
+    argp = argparse.ArgumentParser(description='Create columnar store of association results.')
+    argp.add_argument('--tile-width', help="Bin width (in bases) of the finest tile level",
+        type=int, default=10000)
+    argp.add_argument('--tile-factor', help="Bin width ratio between tile levels",
+        type=int, default=4)
+    argp.add_argument('--tile-levels', help="Number of tile levels (0 to skip tiles)",
+        type=int, default=7)
+    argp.add_argument('--tile-top', help="Number of top variants kept per tile bin",
+        type=int, default=5)
+    argp.add_argument('infile', help="Input file (use '-' for stdin)")
+    argp.add_argument('outdir', help="Output directory")
+    args = argp.parse_args()
+
+    rows = process_file(args.infile, args.outdir, tile_width=args.tile_width,
+        tile_factor=args.tile_factor, tile_levels=args.tile_levels, tile_top=args.tile_top)
+    print('{} -> {} ({} rows)'.format(args.infile, args.outdir, rows))
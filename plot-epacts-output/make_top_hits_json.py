@@ -10,6 +10,7 @@ import json
 import collections
 from bisect import bisect_right
 from extreme_collection import ExtremeCollection
+import assoc_chunks
 
 class NotSortedError(Exception):
     def __init___(self,dErrorArguments):
@@ -145,11 +146,39 @@ class JSONOutFile:
     def write(self, data):
         json.dump(data, self.f, indent=0)
 
-def is_in_bin(rbin, result, window=3e6):
-    if result.chrom == rbin['chrom'] or "chr" + result.chrom == rbin['chrom']:
-        if rbin['start'] <= result.pos <= rbin['stop']:
-            return True
-    return False
+class BinIndex:
+    '''
+    Peak bins of each chromosome sorted by start, so the first bin
+    (in creation order) holding a position is found with a binary search
+    '''
+    def __init__(self):
+        self.starts = dict()
+        self.entries = dict()
+        self.max_width = 0
+
+    def find(self, chrom, pos):
+        found = None
+        for key in (chrom, "chr" + chrom):
+            starts = self.starts.get(key)
+            if not starts:
+                continue
+            entries = self.entries[key]
+            i = bisect_right(starts, pos)
+            # only bins starting within max_width of pos can hold it
+            while i > 0 and starts[i-1] >= pos - self.max_width:
+                i -= 1
+                order, rbin = entries[i]
+                if rbin['stop'] >= pos and (found is None or order < found[0]):
+                    found = entries[i]
+        return found[1] if found else None
+
+    def add(self, order, rbin):
+        chrom = rbin['chrom']
+        starts = self.starts.setdefault(chrom, [])
+        i = bisect_right(starts, rbin['start'])
+        starts.insert(i, rbin['start'])
+        self.entries.setdefault(chrom, []).insert(i, (order, rbin))
+        self.max_width = max(self.max_width, rbin['stop'] - rbin['start'])
 
 def process_file(results, window=5e5, sig_pvalue=5e-8, max_sites = 5000, max_bins=500, nearest_gene=None):
     bins=[]
@@ -159,15 +188,15 @@ def process_file(results, window=5e5, sig_pvalue=5e-8, max_sites = 5000, max_bin
     if nearest_gene is not None:
         exported_cols += ["gene"]
     if window>0:
+        bin_index = BinIndex()
         for result in best_results:
             if last_pval is not None:
                 if result.pval < last_pval:
                     raise NotSortedError("input must be sorted by p-value")
             last_pval = result.pval
-            for rbin in bins:
-                if is_in_bin(rbin, result, window=window):
-                    rbin['assoc'].append(result)
-                    break 
+            rbin = bin_index.find(result.chrom, result.pos)
+            if rbin is not None:
+                rbin['assoc'].append(result)
             else:
                 if len(bins) >= max_bins:
                     break
@@ -175,6 +204,7 @@ def process_file(results, window=5e5, sig_pvalue=5e-8, max_sites = 5000, max_bin
                     start = int(result.pos-window), 
                     stop = int(result.pos+window),
                     assoc = [result])
+                bin_index.add(len(bins), newbin)
                 bins.append(newbin)
         for rbin in bins:
             rbin['pos'] = rbin['assoc'][0].pos
@@ -197,6 +227,14 @@ def process_file(results, window=5e5, sig_pvalue=5e-8, max_sites = 5000, max_bin
     meta = {"cols": exported_cols}
     return bins, meta
 
+def top_results(reader, max_sites):
+    # the max_sites results with the smallest p-values, smallest first
+    best_results = assoc_chunks.TopResults(max_sites)
+    with reader as f:
+        for chunk in f:
+            best_results.add(chunk)
+    return best_results.results
+
 if __name__ == "__main__":
     import argparse
     argp = argparse.ArgumentParser(description='Create JSON file of top hits.')
@@ -218,7 +256,8 @@ if __name__ == "__main__":
     else:
         nearest_gene = None
 
-    with AssocResultReader(args.infile) as inf, JSONOutFile(args.outfile) as outf:
-        bins, meta = process_file(inf, args.window, args.sig_pvalue, args.sites, args.bins, nearest_gene)
+    with JSONOutFile(args.outfile) as outf:
+        best_results = top_results(assoc_chunks.AssocChunkReader(args.infile), args.sites)
+        bins, meta = process_file(best_results, args.window, args.sig_pvalue, args.sites, args.bins, nearest_gene)
         outf.write({"header": meta, "data": bins})
 
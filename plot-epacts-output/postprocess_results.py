@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+'''
+This script takes an input filename (the output of epacts or saige with a
+single phenotype) and writes every requested postprocessing output from a
+single read of that file:
+- `--filtered`: rows with PVALUE < 0.001 (and `--filter-column` > 0)
+- `--manhattan`: same json as make_manhattan_json.py
+- `--qq`: same json as make_qq_json.py
+- `--tophits`: same json as make_top_hits_json.py
+- `--store`: columnar results store, as make_results_store.py
+
+With `--jobs` > 1 and a tabix-indexed input, the chromosomes are processed
+in parallel and the partial results merged.
+'''
+
+
+
+import os
+import gzip
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+import assoc_chunks
+import make_manhattan_json
+import make_qq_json
+import make_top_hits_json
+import make_results_store
+
+MAX_SITES = 5000
+
+class StoreOutput:
+    def __init__(self, outdir, header, kinds=None):
+        self.outdir = outdir
+        self.tmpdir = outdir.rstrip("/") + ".tmp"
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        os.makedirs(self.tmpdir)
+        self.writer = make_results_store.ResultsStoreWriter(self.tmpdir,
+            make_results_store.read_header(header), kinds=kinds)
+
+    def close(self):
+        self.writer.close()
+        if os.path.exists(self.outdir):
+            shutil.rmtree(self.outdir)
+        os.rename(self.tmpdir, self.outdir)
+
+def new_binner():
+    return make_manhattan_json.VariantBinner(3e6, 1, 500, 0.05, 2)
+
+def filtered_lines(chunk, filter_column, filter_pvalue):
+    keep = chunk.pval < filter_pvalue
+    if filter_column:
+        keep &= chunk.float_column(filter_column) > 0
+    return [chunk.line(i) for i in np.flatnonzero(keep).tolist()]
+
+def write_json_outputs(binner, manhattan, qq_builder, qq, fetch_variants,
+        best_results, tophits, nearest_gene, window):
+    if binner:
+        variant_bins, unbinned_variants = binner.finish()
+        with make_manhattan_json.JSONOutFile(manhattan) as outf:
+            outf.write({'variant_bins': variant_bins, 'unbinned_variants': unbinned_variants})
+    if qq_builder:
+        with make_qq_json.JSONOutFile(qq) as outf:
+            outf.write(qq_builder.finish(fetch_variants))
+    if best_results is not None:
+        with make_top_hits_json.JSONOutFile(tophits) as outf:
+            bins, meta = make_top_hits_json.process_file(best_results.results, window, 5e-8, MAX_SITES, 250, nearest_gene)
+            outf.write({"header": meta, "data": bins})
+
+def process_file(infile, filtered=None, filter_column=None, filter_pvalue=0.001,
+        manhattan=None, qq=None, tophits=None, store=None, nearest_gene=None,
+        window=5e6, chunk_bytes=2*1024*1024):
+    reader = assoc_chunks.AssocChunkReader(infile, chunk_bytes)
+    count = 0
+    with reader:
+        filecols = reader.filecols
+        filtered_out = None
+        if filtered:
+            filtered_out = gzip.open(filtered, "wt")
+            filtered_out.write(reader.header)
+        binner = new_binner() if manhattan else None
+        qq_builder = make_qq_json.QQBuilder(filecols, 50, 1000) if qq else None
+        best_results = assoc_chunks.TopResults(MAX_SITES) if tophits else None
+        store_out = StoreOutput(store, reader.header) if store else None
+        try:
+            for chunk in reader:
+                if filtered_out:
+                    filtered_out.writelines(filtered_lines(chunk, filter_column, filter_pvalue))
+                if binner:
+                    make_manhattan_json.bin_chunk(binner, chunk, reader.chroms.names)
+                if qq_builder:
+                    qq_builder.add_chunk(chunk)
+                if best_results is not None:
+                    best_results.add(chunk)
+                if store_out:
+                    store_out.writer.add_columns(chunk.columns())
+                count += chunk.rows
+        finally:
+            if filtered_out:
+                filtered_out.close()
+
+    if store_out:
+        store_out.close()
+    write_json_outputs(binner, manhattan, qq_builder, qq,
+        lambda rows: make_qq_json.read_variants(infile, rows),
+        best_results, tophits, nearest_gene, window)
+    return count
+
+def process_part(task):
+    # worker: partial outputs for one region of the input (see process_parallel)
+    infile, region, workdir, index, options = task
+    part = {"rows": 0, "pval_rows": 0, "filtered": None, "binner": None, "top": None,
+        "qq": None, "store": None}
+    binner = new_binner() if options["manhattan"] else None
+    best_results = assoc_chunks.TopResults(MAX_SITES) if options["tophits"] else None
+    qq_files = None
+    store_writer = None
+    filtered_out = None
+    with assoc_chunks.AssocChunkReader(infile, options["chunk_bytes"], region=region) as reader:
+        if options["filtered"]:
+            # gzip members can be concatenated, so parts are compressed here
+            part["filtered"] = os.path.join(workdir, "part{}.filtered.gz".format(index))
+            filtered_out = gzip.open(part["filtered"], "wt")
+        if options["qq"]:
+            part["qq"] = [os.path.join(workdir, "part{}.pvals".format(index))]
+            if "MAF" in reader.filecols:
+                part["qq"].append(os.path.join(workdir, "part{}.mafs".format(index)))
+            qq_files = [open(x, "wb") for x in part["qq"]]
+        if options["store_kinds"]:
+            part["store"] = os.path.join(workdir, "part{}.store".format(index))
+            os.makedirs(part["store"])
+            store_writer = make_results_store.ResultsStoreWriter(part["store"],
+                make_results_store.read_header(reader.header), tile_levels=0,
+                kinds=options["store_kinds"], sorted_indexes=())
+        try:
+            for chunk in reader:
+                if filtered_out:
+                    filtered_out.writelines(filtered_lines(chunk, options["filter_column"],
+                        options["filter_pvalue"]))
+                if binner:
+                    make_manhattan_json.bin_chunk(binner, chunk, reader.chroms.names)
+                if qq_files:
+                    idx = np.flatnonzero(~np.isnan(chunk.pval))
+                    np.maximum(chunk.pval[idx], 1e-308).tofile(qq_files[0])
+                    if len(qq_files) > 1:
+                        chunk.float_column("MAF")[idx].tofile(qq_files[1])
+                if best_results is not None:
+                    best_results.add(chunk)
+                if store_writer:
+                    store_writer.add_columns(chunk.columns())
+                part["rows"] += chunk.rows
+                part["pval_rows"] += int(np.count_nonzero(~np.isnan(chunk.pval)))
+        finally:
+            for f in qq_files or []:
+                f.close()
+            if filtered_out:
+                filtered_out.close()
+    if binner:
+        binner.flush()
+    if store_writer:
+        store_writer.close()
+    part["binner"] = binner
+    part["top"] = best_results
+    return part
+
+def fetch_part_variants(task):
+    infile, region, rows = task
+    return make_qq_json.read_variants(infile, rows, region)
+
+def read_spilled(path, count=1<<20):
+    with open(path, "rb") as f:
+        while True:
+            values = np.fromfile(f, dtype=np.float64, count=count)
+            if len(values) == 0:
+                break
+            yield values
+
+def process_parallel(infile, jobs, filtered=None, filter_column=None, filter_pvalue=0.001,
+        manhattan=None, qq=None, tophits=None, store=None, nearest_gene=None,
+        window=5e6, chunk_bytes=2*1024*1024, part_bytes=None):
+    '''
+    The same outputs as process_file, with regions of a bgzip-compressed,
+    tabix-indexed input (one per chromosome, large chromosomes split into
+    parts of about part_bytes of compressed data) processed by a pool of
+    jobs worker processes and merged in file order. Falls back to
+    process_file when the input has no index.
+    '''
+    parts = None
+    if jobs > 1 and os.path.isfile(infile):
+        if part_bytes is None:
+            part_bytes = max(os.path.getsize(infile) // (4 * jobs), 1<<20)
+        parts = assoc_chunks.tabix_parts(infile, part_bytes)
+    if not parts:
+        return process_file(infile, filtered=filtered, filter_column=filter_column,
+            filter_pvalue=filter_pvalue, manhattan=manhattan, qq=qq, tophits=tophits,
+            store=store, nearest_gene=nearest_gene, window=window, chunk_bytes=chunk_bytes)
+    with assoc_chunks.AssocChunkReader(infile, chunk_bytes) as reader:
+        header = reader.header
+        filecols = reader.filecols
+        # column types come from the first chunk, as when writing in one pass
+        first = next(iter(reader), None)
+        store_kinds = None
+        if store:
+            store_kinds = make_results_store.column_kinds(
+                make_results_store.canonical_columns(make_results_store.read_header(header)),
+                first.columns() if first else [[] for _ in filecols])
+    options = {"filtered": bool(filtered), "filter_column": filter_column,
+        "filter_pvalue": filter_pvalue, "manhattan": bool(manhattan), "qq": bool(qq),
+        "tophits": bool(tophits), "store_kinds": store_kinds, "chunk_bytes": chunk_bytes}
+    workdir = tempfile.mkdtemp()
+    count = 0
+    pval_rows = []
+    binner = None
+    qq_builder = make_qq_json.QQBuilder(filecols, 50, 1000) if qq else None
+    best_results = assoc_chunks.TopResults(MAX_SITES) if tophits else None
+    store_out = StoreOutput(store, header, store_kinds) if store else None
+    filtered_out = None
+    try:
+        if filtered:
+            with gzip.open(filtered, "wt") as f:
+                f.write(header)
+            filtered_out = open(filtered, "ab")
+        with multiprocessing.Pool(jobs) as pool:
+            tasks = [(infile, region, workdir, i, options) for i, region in enumerate(parts)]
+            for part in pool.imap(process_part, tasks):
+                if filtered_out:
+                    with open(part["filtered"], "rb") as f:
+                        shutil.copyfileobj(f, filtered_out)
+                    os.remove(part["filtered"])
+                if manhattan:
+                    if binner is None:
+                        binner = part["binner"]
+                    else:
+                        binner.merge(part["binner"])
+                if qq_builder:
+                    for values in zip(*[read_spilled(x) for x in part["qq"]]):
+                        qq_builder.add_values(*values)
+                    for x in part["qq"]:
+                        os.remove(x)
+                if best_results is not None:
+                    best_results.merge(part["top"], count)
+                if store_out:
+                    store_out.writer.add_store(part["store"])
+                    shutil.rmtree(part["store"])
+                count += part["rows"]
+                pval_rows.append(part["pval_rows"])
+            if filtered_out:
+                filtered_out.close()
+                filtered_out = None
+            if store_out:
+                store_out.close()
+
+            part_starts = np.cumsum([0] + pval_rows)
+            def fetch_variants(rows):
+                # rows are looked up in the parts that hold them
+                rows = np.array(sorted(set(rows)), dtype=np.int64)
+                part_of = np.searchsorted(part_starts, rows, side="right") - 1
+                wanted = sorted(set(part_of.tolist()))
+                found = dict()
+                fetched = pool.map(fetch_part_variants,
+                    [(infile, parts[i], (rows[part_of == i] - part_starts[i]).tolist()) for i in wanted])
+                for i, variants in zip(wanted, fetched):
+                    found.update({int(part_starts[i]) + row: v for row, v in variants.items()})
+                return found
+            if manhattan and binner is None:
+                binner = new_binner()
+            write_json_outputs(binner, manhattan, qq_builder, qq, fetch_variants,
+                best_results, tophits, nearest_gene, window)
+    finally:
+        if filtered_out:
+            filtered_out.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return count
+
+if __name__ == "__main__":
+    import argparse
+    argp = argparse.ArgumentParser(description='Create all postprocessing outputs in one pass.')
+    argp.add_argument('--filtered', help="Output file for rows below --filter-pvalue (gzipped)")
+    argp.add_argument('--filter-column', help="Column that must also be > 0 for filtered rows")
+    argp.add_argument('--filter-pvalue', help="P-value threshold for filtered rows",
+        type=float, default=0.001)
+    argp.add_argument('--manhattan', help="Output file for manhattan plot json")
+    argp.add_argument('--qq', help="Output file for QQ plot json")
+    argp.add_argument('--tophits', help="Output file for top hits json")
+    argp.add_argument('--store', help="Output directory for columnar results store")
+    argp.add_argument('--window', '-w', help="Window size (in bases) to collapse top hit peaks",
+        type=float, default = 5e6)
+    argp.add_argument('--gene', '-g', help="BED file for nearest gene")
+    argp.add_argument('--jobs', '-j', help="Number of worker processes (needs a tabix-indexed input)",
+        type=int, default=1)
+    argp.add_argument('infile', help="Input file (use '-' for stdin)")
+    args = argp.parse_args()
+
+    nearest_gene = make_top_hits_json.BEDReader(args.gene) if args.gene else None
+    infile = make_qq_json.spool_stdin() if args.infile == "-" and args.qq else args.infile
+    try:
+        count = process_parallel(infile, args.jobs, filtered=args.filtered, filter_column=args.filter_column,
+            filter_pvalue=args.filter_pvalue, manhattan=args.manhattan, qq=args.qq,
+            tophits=args.tophits, store=args.store, nearest_gene=nearest_gene, window=args.window)
+    finally:
+        if infile != args.infile:
+            os.remove(infile)
+    print('{} ({} rows)'.format(args.infile, count))